@@ -8,6 +8,9 @@ from datetime import datetime, timedelta
 import csv
 
 from .models import (
+    AnalyticsEvent,
+    AnalyticsWatermark,
+    UniqueUserSketch,
     StoreAnalytics,
     ProductAnalytics,
     UserActivityLog,
@@ -15,6 +18,7 @@ from .models import (
     UserStoreActivity
 )
 from .services import AnalyticsService
+from .sketches import HyperLogLog
 
 
 class AnalyticsDashboardAdmin(admin.ModelAdmin):
@@ -207,6 +211,7 @@ class UserActivityLogAdmin(admin.ModelAdmin):
         'new_users',
         'total_points_earned',
         'total_points_redeemed',
+        'total_revenue',
         'new_products_scanned'
     ]
     list_filter = ['date']
@@ -216,6 +221,7 @@ class UserActivityLogAdmin(admin.ModelAdmin):
         'total_scans',
         'total_points_earned',
         'total_points_redeemed',
+        'total_revenue',
         'active_users',
         'new_users',
         'new_products_scanned',
@@ -238,7 +244,7 @@ class UserActivityLogAdmin(admin.ModelAdmin):
         writer = csv.writer(response)
         writer.writerow([
             'Date', 'Total Scans', 'Active Users', 'New Users',
-            'Points Earned', 'Points Redeemed', 'New Products'
+            'Points Earned', 'Points Redeemed', 'Revenue', 'New Products'
         ])
 
         for obj in queryset:
@@ -249,6 +255,7 @@ class UserActivityLogAdmin(admin.ModelAdmin):
                 obj.new_users,
                 obj.total_points_earned,
                 obj.total_points_redeemed,
+                obj.total_revenue,
                 obj.new_products_scanned
             ])
 
@@ -412,6 +419,68 @@ class UserStoreActivityAdmin(admin.ModelAdmin):
     export_to_csv.short_description = "Export to CSV"
 
 
+@admin.register(AnalyticsEvent)
+class AnalyticsEventAdmin(admin.ModelAdmin):
+    """Read-only view of the analytics change log."""
+
+    list_display = ['id', 'kind', 'transaction_id', 'created_at', 'applied_at']
+    list_filter = ['kind', 'applied_at']
+    search_fields = ['id', 'transaction_id']
+    readonly_fields = ['id', 'kind', 'transaction_id', 'payload', 'created_at', 'applied_at']
+    ordering = ['-created_at']
+    actions = ['apply_pending']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def apply_pending(self, request, queryset):
+        """Apply all pending events (not only the selected ones)."""
+        from .events import AnalyticsEventService
+        applied = AnalyticsEventService.apply_pending_events()
+        self.message_user(request, f"{applied} pending event(s) applied.")
+    apply_pending.short_description = "Apply all pending events"
+
+
+@admin.register(UniqueUserSketch)
+class UniqueUserSketchAdmin(admin.ModelAdmin):
+    """Daily unique user sketches, with the estimate next to the exact count for audits."""
+
+    list_display = ['date', 'scope', 'key', 'exact_count', 'estimate', 'last_updated']
+    list_filter = ['scope', 'date']
+    search_fields = ['key']
+    date_hierarchy = 'date'
+    readonly_fields = ['scope', 'key', 'date', 'exact_count', 'estimate', 'last_updated']
+    exclude = ['registers']
+    ordering = ['-date', 'scope', 'key']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def estimate(self, obj):
+        return HyperLogLog.from_bytes(obj.registers).count()
+    estimate.short_description = 'Estimated Users'
+
+
+@admin.register(AnalyticsWatermark)
+class AnalyticsWatermarkAdmin(admin.ModelAdmin):
+    """Progress of watermarked refresh jobs; delete a watermark to force a full rebuild next run."""
+
+    list_display = ['key', 'value', 'updated_at']
+    readonly_fields = ['key', 'value', 'updated_at']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 # Custom admin site configuration for Analytics section
 class AnalyticsAdminSite(admin.AdminSite):
     site_header = "Loyalty App Analytics"
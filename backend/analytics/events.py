@@ -0,0 +1,362 @@
+"""
+Incremental, event-driven analytics.
+
+Every committed receipt scan and every review approval that changes points
+writes an AnalyticsEvent in the same database transaction (a durable change
+log). `apply_pending_events` claims pending events in batches, folds them
+into per-row deltas and applies those to StoreAnalytics, ProductAnalytics,
+StoreProductRanking and UserStoreActivity with one UPDATE per affected row,
+marking the events applied in the same transaction - so the cost follows new
+activity, not the size of the history.
+
+UserStoreActivity only takes the points of approvals from here; scans are
+merged into it by AnalyticsService.update_user_store_activities, from a
+watermark on Transaction.scanned_at, counting scan-time points only.
+
+The full recomputation in AnalyticsService (`update_analytics --type all`)
+remains the repair path: it marks the pending events applied in the same
+database transaction as its upserts, since the rebuild covers them, and
+single-table rebuilds apply pending events first. Events committed after
+that point stay pending, so every rebuild leaves out what they will add
+(`pending_scans` / `pending_approvals`) to not count it twice.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, Iterable, List
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import F
+from django.db.models.fields.json import KeyTextTransform
+from django.utils import timezone
+
+from .models import (
+    AnalyticsEvent, ProductAnalytics, StoreAnalytics, StoreProductRanking, UserStoreActivity
+)
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_ANALYTICS_EVENTS_SETTINGS = {
+    'ENABLED': True,
+    'BATCH_SIZE': 500,
+    # Applied events are kept this long (for auditing) before being deleted
+    'RETENTION_DAYS': 7,
+}
+
+
+class AnalyticsEventService:
+    """Record analytics events and apply them to the analytics tables in batches."""
+
+    @staticmethod
+    def config() -> Dict:
+        config = dict(DEFAULT_ANALYTICS_EVENTS_SETTINGS)
+        config.update(getattr(settings, 'ANALYTICS_EVENTS', {}))
+        return config
+
+    # ==================== RECORDING ====================
+
+    @classmethod
+    def record_scan(cls, transaction, items: Iterable) -> None:
+        """Log a saved receipt scan; call inside the transaction that saved it."""
+        if not cls.config()['ENABLED']:
+            return
+        AnalyticsEvent.objects.create(
+            kind=AnalyticsEvent.SCAN,
+            transaction_id=transaction.id,
+            payload={
+                'user_id': transaction.user_id,
+                'store_id': transaction.store_id,
+                'scanned_at': (transaction.scanned_at or timezone.now()).isoformat(),
+                'total_points': transaction.total_points,
+                'total_amount': transaction.total_amount or 0.0,
+                'items': [
+                    [item.product_id, item.product_name, item.quantity, item.price or 0.0, item.matched]
+                    for item in items
+                ],
+            }
+        )
+
+    @classmethod
+    def record_review_approval(cls, item, points: int, newly_matched: bool) -> None:
+        """
+        Log an approved review item that awarded `points`; `newly_matched` is
+        True when the approval linked a previously unmatched line to a product.
+        Call inside the transaction that saved the approval.
+        """
+        if not cls.config()['ENABLED']:
+            return
+        transaction = item.transaction
+        AnalyticsEvent.objects.create(
+            kind=AnalyticsEvent.REVIEW_APPROVED,
+            transaction_id=transaction.id,
+            payload={
+                'user_id': transaction.user_id,
+                'store_id': transaction.store_id,
+                'scanned_at': transaction.scanned_at.isoformat(),
+                'points': points,
+                'newly_matched': newly_matched,
+                'item_id': item.id,
+                'item': [item.product_id, item.product_name, item.quantity, item.price or 0.0, True],
+            }
+        )
+
+    # ==================== APPLYING ====================
+
+    @classmethod
+    def apply_pending_events(cls, batch_size: int = None, max_batches: int = None) -> int:
+        """
+        Apply pending events batch by batch until none are left (or `max_batches`
+        were applied). Safe to run from several processes at once. Returns the
+        number of events applied.
+        """
+        batch_size = batch_size or cls.config()['BATCH_SIZE']
+        applied = batches = 0
+        while max_batches is None or batches < max_batches:
+            count = cls.apply_batch(batch_size)
+            if not count:
+                break
+            applied += count
+            batches += 1
+        cls.prune_applied()
+        return applied
+
+    @classmethod
+    def apply_batch(cls, batch_size: int) -> int:
+        """Claim up to `batch_size` pending events and apply them in one transaction."""
+        with db_transaction.atomic():
+            events = list(
+                AnalyticsEvent.objects
+                .select_for_update(skip_locked=True)
+                .filter(applied_at__isnull=True)
+                .order_by('created_at', 'id')[:batch_size]
+            )
+            if not events:
+                return 0
+
+            cls._apply(events)
+            AnalyticsEvent.objects.filter(id__in=[event.id for event in events]).update(applied_at=timezone.now())
+
+        logger.info('Applied %d analytics event(s)', len(events))
+        return len(events)
+
+    @classmethod
+    def mark_all_applied(cls) -> int:
+        """
+        Mark every pending event applied without applying it (a full rebuild covers
+        them). Call in the transaction that writes the rebuilt rows: the rebuild then
+        covers exactly the events marked here, which commit with it.
+        """
+        return AnalyticsEvent.objects.filter(applied_at__isnull=True).update(applied_at=timezone.now())
+
+    @staticmethod
+    def pending_scans():
+        """Subquery of the transaction ids whose scan event is not applied yet."""
+        return AnalyticsEvent.objects.filter(
+            kind=AnalyticsEvent.SCAN, applied_at__isnull=True
+        ).values('transaction_id')
+
+    @staticmethod
+    def pending_approvals(newly_matched_only: bool = False):
+        """Subquery of the transaction item ids whose review approval event is not applied yet."""
+        events = AnalyticsEvent.objects.filter(kind=AnalyticsEvent.REVIEW_APPROVED, applied_at__isnull=True)
+        if newly_matched_only:
+            events = events.filter(payload__newly_matched=True)
+        # Events logged before approvals recorded their item have none (NULL would
+        # make every NOT IN against this subquery unknown)
+        return events.annotate(
+            item_id=KeyTextTransform('item_id', 'payload')
+        ).filter(item_id__isnull=False).values('item_id')
+
+    @classmethod
+    def prune_applied(cls) -> int:
+        cutoff = timezone.now() - timedelta(days=cls.config()['RETENTION_DAYS'])
+        deleted, _ = AnalyticsEvent.objects.filter(applied_at__lt=cutoff).delete()
+        return deleted
+
+    @staticmethod
+    def pending_count() -> int:
+        return AnalyticsEvent.objects.filter(applied_at__isnull=True).count()
+
+    @classmethod
+    def _apply(cls, events: List[AnalyticsEvent]):
+        from django.contrib.auth import get_user_model
+        from products.models import Product, Store
+        from transactions.models import Transaction, TransactionItem
+
+        payloads = [(event.kind, event.payload) for event in events]
+
+        # Rows of deleted stores, products or users are skipped
+        store_ids = set(Store.objects.filter(
+            id__in={payload['store_id'] for _, payload in payloads}
+        ).values_list('id', flat=True))
+        user_ids = set(get_user_model().objects.filter(
+            id__in={payload['user_id'] for _, payload in payloads}
+        ).values_list('id', flat=True))
+        product_ids = set(Product.objects.filter(
+            id__in={line[0] for _, payload in payloads for line in cls._matched_lines(payload)}
+        ).values_list('id', flat=True))
+
+        # A user is new to a store when no other transaction of theirs there has been
+        # counted yet, i.e. had its scan event applied (the earliest by date is not
+        # enough: an older transaction can commit after a newer one was applied, and
+        # two can share a timestamp).
+        store_transactions = defaultdict(list)
+        for transaction_id, user_id, store_id in Transaction.objects.filter(
+            user_id__in=user_ids, store_id__in=store_ids
+        ).values_list('id', 'user_id', 'store_id'):
+            store_transactions[(user_id, store_id)].append(transaction_id)
+
+        # Likewise a user is new to a product when no other matched line of theirs for
+        # it has been counted yet. A line is counted once the event that matched it is
+        # applied: the scan event of its transaction, or the approval event of the
+        # item when a review linked it later (approvals can match lines older than
+        # lines already counted, so the first line by date is not enough).
+        product_lines = defaultdict(list)
+        for item_id, product_id, user_id, transaction_id in TransactionItem.objects.filter(
+            matched=True, product_id__in=product_ids, transaction__user_id__in=user_ids
+        ).values_list('id', 'product_id', 'transaction__user_id', 'transaction_id'):
+            product_lines[(user_id, product_id)].append((item_id, transaction_id))
+        pending_scans, pending_approvals = set(), set()
+        for kind, transaction_id, payload in AnalyticsEvent.objects.filter(
+            applied_at__isnull=True,
+            transaction_id__in={
+                transaction_id for transaction_ids in store_transactions.values() for transaction_id in transaction_ids
+            } | {transaction_id for lines in product_lines.values() for _, transaction_id in lines}
+        ).values_list('kind', 'transaction_id', 'payload'):
+            if kind == AnalyticsEvent.SCAN:
+                pending_scans.add(transaction_id)
+            elif payload.get('newly_matched') and payload.get('item_id'):
+                pending_approvals.add(payload['item_id'])
+
+        def store_counted_elsewhere(pair, own_transaction_id) -> bool:
+            return any(
+                transaction_id not in pending_scans
+                for transaction_id in store_transactions[pair] if transaction_id != own_transaction_id
+            )
+
+        def counted_elsewhere(pair, own_line) -> bool:
+            return any(
+                transaction_id not in pending_scans and item_id not in pending_approvals
+                for item_id, transaction_id in product_lines[pair] if not own_line(item_id, transaction_id)
+            )
+
+        stores = defaultdict(lambda: defaultdict(int))
+        products = defaultdict(lambda: defaultdict(int))
+        rankings = defaultdict(lambda: defaultdict(int))
+        activities = defaultdict(lambda: defaultdict(int))
+        ranking_products = {}
+
+        for event, (kind, payload) in zip(events, payloads):
+            user_id, store_id = payload['user_id'], payload['store_id']
+            if store_id not in store_ids or user_id not in user_ids:
+                continue
+
+            if kind == AnalyticsEvent.SCAN:
+                store = stores[store_id]
+                store['total_scans'] += 1
+                store['total_points_earned'] += payload['total_points']
+                store['total_revenue'] += payload['total_amount']
+                if not store_counted_elsewhere((user_id, store_id), event.transaction_id):
+                    store['unique_users'] += 1
+
+                # A receipt can repeat a product on several lines: one user per pair
+                new_buyers = set()
+                for product_id, product_name, quantity, price, matched in payload['items']:
+                    ranking = rankings[(store_id, product_name)]
+                    ranking['scan_count'] += 1
+                    ranking['total_quantity'] += quantity
+                    ranking['total_revenue'] += price
+                    if matched and product_id:
+                        ranking_products[(store_id, product_name)] = product_id
+                    if matched and product_id in product_ids:
+                        pair = (user_id, product_id)
+                        new_user = pair not in new_buyers and not counted_elsewhere(
+                            pair, lambda _, transaction_id: transaction_id == event.transaction_id
+                        )
+                        if new_user:
+                            new_buyers.add(pair)
+                        cls._add_purchase(products[product_id], quantity, price, new_user=new_user)
+                pending_scans.discard(event.transaction_id)
+
+            elif kind == AnalyticsEvent.REVIEW_APPROVED:
+                stores[store_id]['total_points_earned'] += payload['points']
+                activities[(user_id, store_id)]['total_points_earned'] += payload['points']
+
+                product_id, product_name, quantity, price, _ = payload['item']
+                if product_id:
+                    ranking_products[(store_id, product_name)] = product_id
+                if payload['newly_matched'] and product_id in product_ids:
+                    approved_item_id = payload.get('item_id')
+                    new_user = not counted_elsewhere(
+                        (user_id, product_id), lambda item_id, _: item_id == approved_item_id
+                    )
+                    cls._add_purchase(products[product_id], quantity, price, new_user=new_user)
+                    pending_approvals.discard(approved_item_id)
+
+        now = timezone.now()
+        cls._upsert(StoreAnalytics, 'store_id', stores, now)
+        cls._upsert(ProductAnalytics, 'product_id', products, now)
+        cls._upsert_rankings(rankings, ranking_products, now)
+        cls._upsert_activities(activities, now)
+
+    @staticmethod
+    def _matched_lines(payload: Dict) -> List[list]:
+        lines = payload['items'] if 'items' in payload else [payload['item']]
+        return [line for line in lines if line[4] and line[0]]
+
+    @staticmethod
+    def _add_purchase(delta, quantity, price, new_user: bool):
+        delta['total_scans'] += 1
+        delta['total_quantity'] += quantity
+        delta['total_revenue'] += price
+        if new_user:
+            delta['unique_users'] += 1
+
+    @staticmethod
+    def _increments(delta: Dict) -> Dict:
+        return {field: F(field) + value for field, value in delta.items() if value}
+
+    @classmethod
+    def _upsert(cls, model, key_field: str, deltas: Dict, now):
+        """Create missing one-per-key rows, then add each key's deltas with a single UPDATE."""
+        if not deltas:
+            return
+        model.objects.bulk_create([model(**{key_field: key}) for key in deltas], ignore_conflicts=True)
+        for key, delta in deltas.items():
+            model.objects.filter(**{key_field: key}).update(last_updated=now, **cls._increments(delta))
+
+    @classmethod
+    def _upsert_rankings(cls, deltas: Dict, ranking_products: Dict, now):
+        if not deltas and not ranking_products:
+            return
+        StoreProductRanking.objects.bulk_create(
+            [
+                StoreProductRanking(store_id=store_id, product_name=product_name)
+                for store_id, product_name in set(deltas) | set(ranking_products)
+            ],
+            ignore_conflicts=True
+        )
+        for key in set(deltas) | set(ranking_products):
+            store_id, product_name = key
+            updates = cls._increments(deltas.get(key, {}))
+            if key in ranking_products:
+                updates['product_id'] = ranking_products[key]
+            StoreProductRanking.objects.filter(store_id=store_id, product_name=product_name).update(
+                last_updated=now, **updates
+            )
+
+    @classmethod
+    def _upsert_activities(cls, deltas: Dict, now):
+        """Add approval points; the scan itself is merged by update_user_store_activities."""
+        if not deltas:
+            return
+        UserStoreActivity.objects.bulk_create(
+            [UserStoreActivity(user_id=user_id, store_id=store_id) for user_id, store_id in deltas],
+            ignore_conflicts=True
+        )
+        for (user_id, store_id), delta in deltas.items():
+            UserStoreActivity.objects.filter(user_id=user_id, store_id=store_id).update(
+                last_updated=now, **cls._increments(delta)
+            )
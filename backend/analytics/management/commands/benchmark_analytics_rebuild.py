@@ -0,0 +1,105 @@
+"""
+Django management command that benchmarks the store and product analytics rebuilds.
+
+For each catalog size it generates a synthetic workload (see
+`generate_workload`), runs `update_store_analytics` and
+`update_product_analytics` and reports the number of SQL queries and the time
+each took. Both rebuilds are one GROUP BY query plus one bulk upsert, so the
+query count must stay the same at every size; the command fails if it does not.
+On PostgreSQL the upsert is a single INSERT ... ON CONFLICT statement; backends
+with a bind parameter limit (SQLite) split it into batches, which are reported
+separately and left out of the comparison.
+
+Everything runs in a transaction that is rolled back, so the database is left
+unchanged - but run it against a development database, not production.
+
+Usage:
+    python manage.py benchmark_analytics_rebuild
+    python manage.py benchmark_analytics_rebuild --sizes 100 1000 10000 --transactions-per-store 20
+"""
+
+import io
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction as db_transaction
+from django.test.utils import CaptureQueriesContext
+
+from analytics.events import AnalyticsEventService
+from analytics.services import AnalyticsService
+
+REBUILDS = (
+    ('store', AnalyticsService.update_store_analytics),
+    ('product', AnalyticsService.update_product_analytics),
+)
+
+
+class Command(BaseCommand):
+    help = 'Show that the store/product analytics rebuilds use a constant number of queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=int,
+            nargs='+',
+            default=[50, 500, 2000],
+            help='Numbers of stores to benchmark with (products: 5x, users: 2x)'
+        )
+        parser.add_argument(
+            '--transactions-per-store',
+            type=int,
+            default=10,
+            help='Generated transactions per store'
+        )
+        parser.add_argument('--seed', type=int, default=900000000000, help='Seed of the generated workloads')
+
+    def handle(self, *args, **options):
+        results = []
+        for offset, size in enumerate(sorted(options['sizes'])):
+            results.append((size, self.run_size(size, options['seed'] + offset, options)))
+
+        self.stdout.write(
+            f"\n{'stores':>8} {'products':>9} {'rebuild':>8} {'queries':>8} {'upsert batches':>15} {'time':>9}"
+        )
+        for size, measurements in results:
+            for name, queries, batches, seconds in measurements:
+                self.stdout.write(
+                    f'{size:>8} {size * 5:>9} {name:>8} {queries:>8} {batches:>15} {seconds * 1000:>7.1f}ms'
+                )
+
+        for name, _ in REBUILDS:
+            counts = {
+                queries for _, measurements in results
+                for rebuild, queries, _, _ in measurements if rebuild == name
+            }
+            if len(counts) > 1:
+                raise CommandError(f'{name} rebuild query count grows with catalog size: {sorted(counts)}')
+        self.stdout.write(self.style.SUCCESS('\nQuery counts are constant across catalog sizes'))
+
+    def run_size(self, size: int, seed: int, options):
+        measurements = []
+        with db_transaction.atomic():
+            call_command(
+                'generate_workload',
+                seed=seed,
+                users=size * 2,
+                stores=size,
+                products=size * 5,
+                transactions=size * options['transactions_per_store'],
+                days=30,
+                stdout=self.stdout if options['verbosity'] > 1 else io.StringIO(),
+            )
+            # Keep pending events out of the measurement
+            AnalyticsEventService.mark_all_applied()
+
+            for name, rebuild in REBUILDS:
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    rebuild()
+                    seconds = time.perf_counter() - started
+                batches = sum(1 for query in queries.captured_queries if query['sql'].startswith('INSERT'))
+                measurements.append((name, len(queries) - batches, batches, seconds))
+
+            db_transaction.set_rollback(True)
+        return measurements
@@ -2,13 +2,26 @@
 Django management command to update analytics data.
 Run this periodically (e.g., via cron job) to keep analytics fresh.
 
+`--type incremental` applies the pending analytics events (the change log
+written by every scan and review approval) in batches; run it often. The
+other types recompute tables from scratch and are the repair path.
+
 Usage:
+    python manage.py update_analytics --type incremental
     python manage.py update_analytics
     python manage.py update_analytics --type store
     python manage.py update_analytics --type product
+    python manage.py update_analytics --type rankings          # only stores changed since the last run
+    python manage.py update_analytics --type rankings --full
+    python manage.py update_analytics --type activities        # merge transactions since the last run
+    python manage.py update_analytics --type rollup            # roll closed days into UserActivityLog and sketches
 """
 
+from contextlib import nullcontext
+
 from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+from analytics.events import AnalyticsEventService
 from analytics.services import AnalyticsService
 
 
@@ -19,10 +32,21 @@ class Command(BaseCommand):
         parser.add_argument(
             '--type',
             type=str,
-            choices=['all', 'store', 'product', 'rankings', 'activities'],
+            choices=['all', 'incremental', 'store', 'product', 'rankings', 'activities', 'rollup'],
             default='all',
             help='Type of analytics to update'
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=None,
+            help='Events applied per transaction with --type incremental'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='With --type rankings, activities or rollup, rebuild from scratch instead of only processing changes since the last run'
+        )
 
     def handle(self, *args, **options):
         update_type = options['type']
@@ -30,25 +54,42 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(f'\nStarting analytics update: {update_type}\n'))
 
         try:
-            if update_type in ['all', 'store']:
-                self.stdout.write('Updating store analytics...')
-                AnalyticsService.update_store_analytics()
-                self.stdout.write(self.style.SUCCESS(' Store analytics updated\n'))
-
-            if update_type in ['all', 'product']:
-                self.stdout.write('Updating product analytics...')
-                AnalyticsService.update_product_analytics()
-                self.stdout.write(self.style.SUCCESS(' Product analytics updated\n'))
-
-            if update_type in ['all', 'rankings']:
-                self.stdout.write('Updating store-product rankings...')
-                AnalyticsService.update_store_product_rankings()
-                self.stdout.write(self.style.SUCCESS(' Store-product rankings updated\n'))
-
-            if update_type in ['all', 'activities']:
-                self.stdout.write('Updating user-store activities...')
-                AnalyticsService.update_user_store_activities()
-                self.stdout.write(self.style.SUCCESS(' User-store activities updated\n'))
+            if update_type == 'incremental':
+                applied = AnalyticsEventService.apply_pending_events(batch_size=options['batch_size'])
+                self.stdout.write(self.style.SUCCESS(f' Applied {applied} analytics event(s)\n'))
+
+            # A full rebuild marks the pending events applied in the transaction that
+            # writes its rows, so they commit together; events logged later stay pending
+            # and the rebuilds leave out what those will add
+            with db_transaction.atomic() if update_type == 'all' else nullcontext():
+                if update_type == 'all':
+                    AnalyticsEventService.mark_all_applied()
+
+                if update_type in ['all', 'store']:
+                    self.stdout.write('Updating store analytics...')
+                    AnalyticsService.update_store_analytics()
+                    self.stdout.write(self.style.SUCCESS(' Store analytics updated\n'))
+
+                if update_type in ['all', 'product']:
+                    self.stdout.write('Updating product analytics...')
+                    AnalyticsService.update_product_analytics()
+                    self.stdout.write(self.style.SUCCESS(' Product analytics updated\n'))
+
+                if update_type in ['all', 'rankings']:
+                    self.stdout.write('Updating store-product rankings...')
+                    AnalyticsService.update_store_product_rankings(full=update_type == 'all' or options['full'])
+                    self.stdout.write(self.style.SUCCESS(' Store-product rankings updated\n'))
+
+                if update_type in ['all', 'activities']:
+                    self.stdout.write('Updating user-store activities...')
+                    AnalyticsService.update_user_store_activities(full=update_type == 'all' or options['full'])
+                    self.stdout.write(self.style.SUCCESS(' User-store activities updated\n'))
+
+            if update_type in ['all', 'rollup']:
+                self.stdout.write('Updating daily activity rollup...')
+                days = AnalyticsService.update_user_activity_logs(full=update_type == 'all' or options['full'])
+                AnalyticsService.update_unique_user_sketches(full=update_type == 'all' or options['full'])
+                self.stdout.write(self.style.SUCCESS(f' Daily activity rollup updated ({days} day(s))\n'))
 
             self.stdout.write(self.style.SUCCESS(f'\n Analytics update complete: {update_type}\n'))
 
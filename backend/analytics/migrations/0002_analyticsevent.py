@@ -0,0 +1,32 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:29
+
+import analytics.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsEvent',
+            fields=[
+                ('id', models.CharField(default=analytics.models.generate_cuid, editable=False, max_length=30, primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('scan', 'Receipt scanned'), ('review_approved', 'Review approved')], max_length=20)),
+                ('transaction_id', models.CharField(help_text='Transaction the event belongs to (not a foreign key)', max_length=30)),
+                ('payload', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'Analytics Event',
+                'verbose_name_plural': 'Analytics Events',
+                'db_table': 'analytics_events',
+                'ordering': ['created_at'],
+                'indexes': [models.Index(condition=models.Q(('applied_at__isnull', True)), fields=['created_at'], name='analytics_event_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0003_analyticswatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='useractivitylog',
+            name='total_revenue',
+            field=models.FloatField(default=0.0, help_text='Total amount spent in RSD'),
+        ),
+    ]
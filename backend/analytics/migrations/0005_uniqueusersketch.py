@@ -0,0 +1,33 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:44
+
+import analytics.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0004_useractivitylog_total_revenue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UniqueUserSketch',
+            fields=[
+                ('id', models.CharField(default=analytics.models.generate_cuid, editable=False, max_length=30, primary_key=True, serialize=False)),
+                ('scope', models.CharField(choices=[('store', 'Store'), ('product', 'Product'), ('global', 'All activity')], max_length=10)),
+                ('key', models.CharField(blank=True, help_text="Store or product id ('' for global)", max_length=30)),
+                ('date', models.DateField()),
+                ('registers', models.BinaryField(help_text='zlib-compressed HyperLogLog registers')),
+                ('exact_count', models.IntegerField(default=0, help_text='Exact distinct users of this day, for audits')),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Unique User Sketch',
+                'verbose_name_plural': 'Unique User Sketches',
+                'db_table': 'unique_user_sketches',
+                'ordering': ['-date'],
+                'unique_together': {('scope', 'key', 'date')},
+            },
+        ),
+    ]
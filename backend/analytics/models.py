@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from products.models import Store, Product
 import secrets
 import time
@@ -64,13 +65,17 @@ class ProductAnalytics(models.Model):
 
 
 class UserActivityLog(models.Model):
-    """Daily aggregated user activity for trend analysis."""
+    """
+    Daily aggregated user activity for trend analysis, one row per closed day
+    (see AnalyticsService.update_user_activity_logs).
+    """
 
     id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
     date = models.DateField(db_index=True, help_text="Date of activity")
     total_scans = models.IntegerField(default=0, help_text="Total scans on this date")
     total_points_earned = models.IntegerField(default=0, help_text="Total points earned")
     total_points_redeemed = models.IntegerField(default=0, help_text="Total points redeemed")
+    total_revenue = models.FloatField(default=0.0, help_text="Total amount spent in RSD")
     active_users = models.IntegerField(default=0, help_text="Number of active users")
     new_users = models.IntegerField(default=0, help_text="Number of new registrations")
     new_products_scanned = models.IntegerField(default=0, help_text="New unique products scanned")
@@ -160,3 +165,129 @@ class UserStoreActivity(models.Model):
 
     def __str__(self):
         return f"{self.user.email} - {self.store.name} ({self.scan_count} scans)"
+
+
+class AnalyticsEvent(models.Model):
+    """
+    Durable change log feeding the incremental analytics (see analytics/events.py).
+
+    One row is written in the same database transaction as every committed
+    receipt scan and every review approval that changes points. The payload
+    holds everything needed to apply the event, as of when it happened, so
+    events can be applied later, in batches, exactly once.
+    """
+
+    SCAN = 'scan'
+    REVIEW_APPROVED = 'review_approved'
+    KIND_CHOICES = [
+        (SCAN, 'Receipt scanned'),
+        (REVIEW_APPROVED, 'Review approved'),
+    ]
+
+    id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    transaction_id = models.CharField(max_length=30, help_text="Transaction the event belongs to (not a foreign key)")
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    applied_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'analytics_events'
+        verbose_name = 'Analytics Event'
+        verbose_name_plural = 'Analytics Events'
+        ordering = ['created_at']
+        indexes = [
+            # Pending events, oldest first
+            models.Index(
+                fields=['created_at'],
+                condition=models.Q(applied_at__isnull=True),
+                name='analytics_event_pending_idx'
+            ),
+        ]
+
+    def __str__(self):
+        state = 'applied' if self.applied_at else 'pending'
+        return f"{self.get_kind_display()} {self.transaction_id[:8]} ({state})"
+
+
+class UniqueUserSketch(models.Model):
+    """
+    HyperLogLog sketch of the users active in one scope (a store, a product or
+    everything) on one day, see analytics/sketches.py. Sketches of any set of
+    days merge into the approximate number of distinct users over those days.
+    """
+
+    STORE = 'store'
+    PRODUCT = 'product'
+    GLOBAL = 'global'
+    SCOPE_CHOICES = [
+        (STORE, 'Store'),
+        (PRODUCT, 'Product'),
+        (GLOBAL, 'All activity'),
+    ]
+
+    id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
+    scope = models.CharField(max_length=10, choices=SCOPE_CHOICES)
+    key = models.CharField(max_length=30, blank=True, help_text="Store or product id ('' for global)")
+    date = models.DateField()
+    registers = models.BinaryField(help_text="zlib-compressed HyperLogLog registers")
+    exact_count = models.IntegerField(default=0, help_text="Exact distinct users of this day, for audits")
+    last_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'unique_user_sketches'
+        verbose_name = 'Unique User Sketch'
+        verbose_name_plural = 'Unique User Sketches'
+        ordering = ['-date']
+        unique_together = ['scope', 'key', 'date']
+
+    def __str__(self):
+        return f"{self.get_scope_display()} {self.key or '-'} on {self.date}"
+
+
+class AnalyticsWatermark(models.Model):
+    """
+    High-water mark of an analytics refresh job: data up to `value` has been
+    folded into the job's table. The next run only looks at what arrived after
+    it (see AnalyticsService.update_store_product_rankings and
+    update_user_store_activities).
+    """
+
+    STORE_PRODUCT_RANKINGS = 'store_product_rankings'
+    USER_STORE_ACTIVITIES = 'user_store_activities'
+
+    key = models.CharField(max_length=50, primary_key=True)
+    value = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'analytics_watermarks'
+        verbose_name = 'Analytics Watermark'
+        verbose_name_plural = 'Analytics Watermarks'
+
+    def __str__(self):
+        return f"{self.key} @ {self.value:%Y-%m-%d %H:%M:%S}" if self.value else f"{self.key} (never run)"
+
+    @classmethod
+    def get(cls, key):
+        """Watermark value, or None if the job has never completed."""
+        return cls.objects.filter(key=key).values_list('value', flat=True).first()
+
+    @classmethod
+    def advance(cls, key, value):
+        """Move the watermark to `value` (never backwards)."""
+        updated = cls.objects.filter(key=key).filter(
+            models.Q(value__isnull=True) | models.Q(value__lt=value)
+        ).update(value=value, updated_at=timezone.now())
+        if not updated:
+            cls.objects.get_or_create(key=key, defaults={'value': value})
+
+    @classmethod
+    def set(cls, key, value):
+        """Move the watermark to `value`, also backwards (after a rebuild)."""
+        cls.objects.update_or_create(key=key, defaults={'value': value})
+
+    @classmethod
+    def lock(cls, key):
+        """Lock the watermark row until the end of the transaction and return its value."""
+        return cls.objects.select_for_update().filter(key=key).values_list('value', flat=True).first()
@@ -64,6 +64,7 @@ class UserActivityLogSerializer(serializers.ModelSerializer):
             'total_scans',
             'total_points_earned',
             'total_points_redeemed',
+            'total_revenue',
             'active_users',
             'new_users',
             'new_products_scanned',
@@ -3,8 +3,10 @@ Analytics service for computing statistics with optimized queries.
 This service uses Django ORM aggregations and annotations for efficient data retrieval.
 """
 
-from django.db.models import Count, Sum, Q, F, Max, Min, Avg
-from django.db.models.functions import TruncDate, TruncWeek, TruncMonth
+from django.conf import settings
+from django.db import connection, transaction as db_transaction
+from django.db.models import Count, Sum, Q, F, Max, Min, Avg, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce, TruncDate, TruncWeek, TruncMonth
 from django.utils import timezone
 from datetime import datetime, timedelta
 from collections import defaultdict
@@ -17,8 +19,28 @@ from .models import (
     ProductAnalytics,
     UserActivityLog,
     StoreProductRanking,
-    UserStoreActivity
+    UserStoreActivity,
+    AnalyticsEvent,
+    AnalyticsWatermark,
+    UniqueUserSketch,
+    generate_cuid
 )
+from .events import AnalyticsEventService
+from .sketches import HyperLogLog, UniqueUserSketchService
+
+
+DEFAULT_ANALYTICS_REFRESH_SETTINGS = {
+    # Watermarked refreshes re-read this much data before their watermark, so rows
+    # committed late by slow transactions (scanned_at is set before commit) are not missed
+    'WATERMARK_OVERLAP_SECONDS': 300,
+    # User-store activities merge transactions once they are this old, so a
+    # transaction is never committed behind the watermark
+    'ACTIVITY_LAG_SECONDS': 300,
+    # Transactions merged (or activity rows rebuilt) per database transaction
+    'ACTIVITY_BATCH_SIZE': 5000,
+    # The daily activity rollup recomputes this many of its latest days every run
+    'ROLLUP_RECOMPUTE_DAYS': 2,
+}
 
 
 class AnalyticsService:
@@ -52,9 +74,10 @@ class AnalyticsService:
         return list(results)
 
     @staticmethod
-    def get_store_rankings_by_scans(limit=10):
+    def get_store_rankings_by_scans(limit=10, exact=False):
         """
         Get stores ranked by total number of scans.
+        Unique users are estimated from the daily sketches unless `exact`.
         """
         results = Transaction.objects.values(
             'store_id',
@@ -62,17 +85,17 @@ class AnalyticsService:
             'store__location'
         ).annotate(
             total_scans=Count('id'),
-            unique_users=Count('user', distinct=True),
             total_points=Sum('total_points'),
             total_revenue=Sum('total_amount')
         ).order_by('-total_scans')[:limit]
 
-        return list(results)
+        return AnalyticsService._with_unique_users(list(results), UniqueUserSketch.STORE, 'store_id', exact=exact)
 
     @staticmethod
-    def get_store_rankings_by_points(limit=10):
+    def get_store_rankings_by_points(limit=10, exact=False):
         """
         Get stores ranked by total points earned (redemption activity).
+        Unique users are estimated from the daily sketches unless `exact`.
         """
         results = Transaction.objects.values(
             'store_id',
@@ -80,63 +103,125 @@ class AnalyticsService:
             'store__location'
         ).annotate(
             total_scans=Count('id'),
-            total_points_earned=Sum('total_points'),
-            unique_users=Count('user', distinct=True)
+            total_points_earned=Sum('total_points')
         ).order_by('-total_points_earned')[:limit]
 
-        return list(results)
+        return AnalyticsService._with_unique_users(list(results), UniqueUserSketch.STORE, 'store_id', exact=exact)
+
+    @staticmethod
+    def _with_unique_users(rows, scope, key_field, field='unique_users', exact=False):
+        """
+        Set `field` of each ranked row to the distinct users of its store or
+        product, read for all rows at once from the sketches (or counted if `exact`).
+        """
+        counts = UniqueUserSketchService.unique_users_by_key(
+            scope, keys=[row[key_field] for row in rows], exact=exact
+        )
+        for row in rows:
+            row[field] = counts.get(row[key_field], 0)
+        return rows
 
     # ==================== USER ACTIVITY TRENDS ====================
 
     @staticmethod
-    def get_weekly_activity_trend(weeks=12):
+    def get_weekly_activity_trend(weeks=12, exact=False):
         """
         Get weekly user activity trend for the last N weeks.
         """
-        start_date = timezone.now() - timedelta(weeks=weeks)
-
-        weekly_data = Transaction.objects.filter(
-            scanned_at__gte=start_date
-        ).annotate(
-            week=TruncWeek('scanned_at')
-        ).values('week').annotate(
-            total_scans=Count('id'),
-            active_users=Count('user', distinct=True),
-            total_points=Sum('total_points'),
-            total_revenue=Sum('total_amount')
-        ).order_by('week')
-
-        return list(weekly_data)
+        start_date = timezone.localdate() - timedelta(weeks=weeks)
+        return AnalyticsService._activity_trend(
+            start_date, 'week', lambda day: day - timedelta(days=day.weekday()), TruncWeek, exact
+        )
 
     @staticmethod
-    def get_monthly_activity_trend(months=12):
+    def get_monthly_activity_trend(months=12, exact=False):
         """
         Get monthly user activity trend for the last N months.
         """
-        start_date = timezone.now() - timedelta(days=months*30)
-
-        monthly_data = Transaction.objects.filter(
-            scanned_at__gte=start_date
-        ).annotate(
-            month=TruncMonth('scanned_at')
-        ).values('month').annotate(
-            total_scans=Count('id'),
-            active_users=Count('user', distinct=True),
-            total_points=Sum('total_points'),
-            total_revenue=Sum('total_amount')
-        ).order_by('month')
-
-        return list(monthly_data)
+        start_date = timezone.localdate() - timedelta(days=months*30)
+        return AnalyticsService._activity_trend(
+            start_date, 'month', lambda day: day.replace(day=1), TruncMonth, exact
+        )
 
     @staticmethod
     def get_daily_activity_trend(days=30):
         """
         Get daily user activity trend for the last N days.
         """
-        start_date = timezone.now() - timedelta(days=days)
+        start_date = timezone.localdate() - timedelta(days=days)
+        return [
+            {'date': day, **totals}
+            for day, totals in AnalyticsService._daily_activity(start_date)
+        ]
 
-        daily_data = Transaction.objects.filter(
-            scanned_at__gte=start_date
+    @staticmethod
+    def _activity_trend(start_date, period, period_start, trunc, exact=False):
+        """
+        Re-aggregate daily activity into weeks or months. Active users are distinct
+        per period and do not add up over days: they come from merging the daily
+        unique user sketches of each period, or with `exact` from the transactions.
+        """
+        periods = {}
+        for day, totals in AnalyticsService._daily_activity(start_date):
+            bucket = periods.setdefault(period_start(day), defaultdict(int))
+            for field in ('total_scans', 'total_points', 'total_revenue'):
+                bucket[field] += totals[field]
+
+        if exact:
+            active_users = {
+                timezone.localdate(moment): count
+                for moment, count in Transaction.objects.filter(
+                    scanned_at__gte=AnalyticsService._day_start(start_date)
+                ).annotate(
+                    period=trunc('scanned_at')
+                ).values('period').annotate(
+                    active_users=Count('user', distinct=True)
+                ).order_by().values_list('period', 'active_users')
+            }
+        else:
+            sketches = {}
+            daily = UniqueUserSketchService.daily_sketches(UniqueUserSketch.GLOBAL, start=start_date)
+            for day, sketch in daily.items():
+                sketches.setdefault(period_start(day), HyperLogLog()).merge(sketch)
+            active_users = {day: sketch.count() for day, sketch in sketches.items()}
+
+        trend = []
+        for day, totals in sorted(periods.items()):
+            trend.append({
+                period: AnalyticsService._day_start(day),
+                'total_scans': totals['total_scans'],
+                'active_users': active_users.get(day, 0),
+                'total_points': totals['total_points'],
+                'total_revenue': totals['total_revenue']
+            })
+        return trend
+
+    @staticmethod
+    def get_unique_users(scope, key='', start=None, end=None, exact=False):
+        """
+        Distinct users of a store, a product or all activity between two dates
+        (inclusive), merged from the daily unique user sketches. Approximate
+        (relative standard error ~1.6%, see analytics/sketches.py) unless `exact`.
+        """
+        return UniqueUserSketchService.unique_users(scope, key, start=start, end=end, exact=exact)
+
+    @staticmethod
+    def _daily_activity(start_date):
+        """
+        [(date, totals)] for days with scans from `start_date` through today: closed
+        days from the UserActivityLog rollup, days after the last rolled-up one
+        (normally just today) from the transactions.
+        """
+        days = {
+            row.pop('date'): row
+            for row in UserActivityLog.objects.filter(date__gte=start_date).values(
+                'date', 'total_scans', 'active_users', 'total_revenue', total_points=F('total_points_earned')
+            )
+        }
+        raw_from = max(days) + timedelta(days=1) if days else start_date
+
+        raw = Transaction.objects.filter(
+            scanned_at__gte=AnalyticsService._day_start(raw_from)
         ).annotate(
             date=TruncDate('scanned_at')
         ).values('date').annotate(
@@ -144,9 +229,18 @@ class AnalyticsService:
             active_users=Count('user', distinct=True),
             total_points=Sum('total_points'),
             total_revenue=Sum('total_amount')
-        ).order_by('date')
+        ).order_by()
+        for row in raw:
+            days[row.pop('date')] = {
+                **row, 'total_points': row['total_points'] or 0, 'total_revenue': row['total_revenue'] or 0.0
+            }
 
-        return list(daily_data)
+        return [(day, totals) for day, totals in sorted(days.items()) if totals['total_scans']]
+
+    @staticmethod
+    def _day_start(day):
+        """Start of a local calendar day as an aware datetime."""
+        return timezone.make_aware(datetime.combine(day, datetime.min.time()))
 
     @staticmethod
     def get_new_products_growth(days=30):
@@ -172,9 +266,10 @@ class AnalyticsService:
     # ==================== STORE-SPECIFIC REPORTS ====================
 
     @staticmethod
-    def get_store_detailed_report(store_id, days=30):
+    def get_store_detailed_report(store_id, days=30, exact=False):
         """
         Get comprehensive report for a specific store.
+        Unique users are estimated from the daily sketches unless `exact`.
         """
         start_date = timezone.now() - timedelta(days=days)
 
@@ -184,11 +279,13 @@ class AnalyticsService:
             scanned_at__gte=start_date
         ).aggregate(
             total_scans=Count('id'),
-            unique_users=Count('user', distinct=True),
             total_points_earned=Sum('total_points'),
             total_revenue=Sum('total_amount'),
             avg_transaction_value=Avg('total_amount')
         )
+        store_stats['unique_users'] = UniqueUserSketchService.unique_users(
+            UniqueUserSketch.STORE, store_id, start=timezone.localdate(start_date), exact=exact
+        )
 
         # Top products
         top_products = AnalyticsService.get_most_scanned_products_by_store(
@@ -295,31 +392,36 @@ class AnalyticsService:
         } for user in leaderboard]
 
     @staticmethod
-    def get_store_leaderboard(limit=20):
+    def get_store_leaderboard(limit=20, exact=False):
         """
         Get comprehensive store leaderboard.
+        Unique customers are estimated from the daily sketches unless `exact`.
         """
         stores = Store.objects.annotate(
             total_scans=Count('transactions'),
-            unique_customers=Count('transactions__user', distinct=True),
             total_points_distributed=Sum('transactions__total_points'),
             total_revenue=Sum('transactions__total_amount')
         ).order_by('-total_scans')[:limit]
 
-        return [{
+        leaderboard = [{
             'store_id': store.id,
             'name': store.name,
             'location': store.location,
             'total_scans': store.total_scans,
-            'unique_customers': store.unique_customers,
+            'unique_customers': 0,
             'total_points_distributed': store.total_points_distributed or 0,
             'total_revenue': store.total_revenue or 0.0
         } for store in stores]
 
+        return AnalyticsService._with_unique_users(
+            leaderboard, UniqueUserSketch.STORE, 'store_id', field='unique_customers', exact=exact
+        )
+
     @staticmethod
-    def get_product_leaderboard(limit=20):
+    def get_product_leaderboard(limit=20, exact=False):
         """
         Get top products by scan count.
+        Unique users are estimated from the daily sketches unless `exact`.
         """
         products = TransactionItem.objects.filter(
             matched=True
@@ -330,158 +432,517 @@ class AnalyticsService:
         ).annotate(
             scan_count=Count('id'),
             total_quantity=Sum('quantity'),
-            total_revenue=Sum('price'),
-            unique_users=Count('transaction__user', distinct=True)
+            total_revenue=Sum('price')
         ).order_by('-scan_count')[:limit]
 
-        return list(products)
+        return AnalyticsService._with_unique_users(list(products), UniqueUserSketch.PRODUCT, 'product_id', exact=exact)
 
     # ==================== CACHE UPDATE METHODS ====================
 
     @staticmethod
-    def update_store_analytics(store_id=None):
+    def apply_pending_events():
+        """
+        Apply the pending analytics events before a table is recomputed, so events
+        logged before the rebuild are not applied on top of it afterwards (events
+        logged during it stay pending, and the rebuild leaves their rows out).
+        """
+        return AnalyticsEventService.apply_pending_events()
+
+    @staticmethod
+    def update_store_analytics(store_id=None, exact=False):
         """
         Update cached store analytics. Can update specific store or all stores.
+
+        Every row is computed by one GROUP BY query (stores LEFT JOIN transactions,
+        so stores without scans get zeros) and written by one bulk upsert, so the
+        number of queries does not grow with the number of stores. Unique users
+        are estimated from the daily sketches (a fixed number of queries more)
+        unless `exact`, which counts them in the GROUP BY.
         """
+        AnalyticsService.apply_pending_events()
+
+        stores = Store.objects.all()
         if store_id:
-            stores = Store.objects.filter(id=store_id)
+            stores = stores.filter(id=store_id)
+
+        # Leave out what events still pending will add: their transactions, and the
+        # points of their approvals (read in the same statement, see analytics/events.py)
+        pending_scans = AnalyticsEventService.pending_scans()
+        settled = ~Q(transactions__id__in=pending_scans)
+        pending_approval_points = TransactionItem.objects.filter(
+            transaction__store_id=OuterRef('id'), id__in=AnalyticsEventService.pending_approvals()
+        ).exclude(transaction_id__in=pending_scans).values('transaction__store_id').annotate(
+            points=Sum('points')
+        ).values('points')
+
+        stats = stores.values('id').annotate(
+            total_scans=Count('transactions', filter=settled),
+            total_points_earned=Sum('transactions__total_points', filter=settled),
+            total_revenue=Sum('transactions__total_amount', filter=settled),
+            pending_approval_points=Subquery(pending_approval_points)
+        ).order_by()
+        if exact:
+            stats = stats.annotate(unique_users=Count('transactions__user', filter=settled, distinct=True))
         else:
-            stores = Store.objects.all()
-
-        for store in stores:
-            # Get aggregated data
-            stats = Transaction.objects.filter(store=store).aggregate(
-                total_scans=Count('id'),
-                total_points_earned=Sum('total_points'),
-                unique_users=Count('user', distinct=True),
-                total_revenue=Sum('total_amount')
+            sketched = UniqueUserSketchService.unique_users_by_key(
+                UniqueUserSketch.STORE, keys=[store_id] if store_id else None, exclude_transactions=pending_scans
             )
 
-            # Update or create analytics record
-            StoreAnalytics.objects.update_or_create(
-                store=store,
-                defaults={
-                    'total_scans': stats['total_scans'] or 0,
-                    'total_points_earned': stats['total_points_earned'] or 0,
-                    'unique_users': stats['unique_users'] or 0,
-                    'total_revenue': stats['total_revenue'] or 0.0,
-                    'total_points_redeemed': 0  # To be implemented with redemption tracking
-                }
-            )
+        StoreAnalytics.objects.bulk_create(
+            [
+                StoreAnalytics(
+                    store_id=row['id'],
+                    total_scans=row['total_scans'],
+                    total_points_earned=(row['total_points_earned'] or 0) - (row['pending_approval_points'] or 0),
+                    unique_users=row['unique_users'] if exact else sketched.get(row['id'], 0),
+                    total_revenue=row['total_revenue'] or 0.0,
+                    total_points_redeemed=0  # To be implemented with redemption tracking
+                )
+                for row in stats
+            ],
+            update_conflicts=True,
+            unique_fields=['store'],
+            update_fields=[
+                'total_scans', 'total_points_earned', 'unique_users',
+                'total_revenue', 'total_points_redeemed', 'last_updated'
+            ]
+        )
 
     @staticmethod
     def update_product_analytics(product_id=None):
         """
         Update cached product analytics. Can update specific product or all products.
+
+        Like update_store_analytics: one GROUP BY query over products LEFT JOIN
+        matched transaction items, and one bulk upsert.
         """
+        AnalyticsService.apply_pending_events()
+
+        products = Product.objects.all()
         if product_id:
-            products = Product.objects.filter(id=product_id)
-        else:
-            products = Product.objects.all()
-
-        for product in products:
-            # Get aggregated data
-            stats = TransactionItem.objects.filter(
-                product=product,
-                matched=True
-            ).aggregate(
-                total_scans=Count('id'),
-                total_quantity=Sum('quantity'),
-                total_revenue=Sum('price'),
-                unique_users=Count('transaction__user', distinct=True)
-            )
+            products = products.filter(id=product_id)
 
-            # Update or create analytics record
-            ProductAnalytics.objects.update_or_create(
-                product=product,
-                defaults={
-                    'total_scans': stats['total_scans'] or 0,
-                    'total_quantity': stats['total_quantity'] or 0,
-                    'total_revenue': stats['total_revenue'] or 0.0,
-                    'unique_users': stats['unique_users'] or 0
-                }
-            )
+        # Leave out lines that pending scan or approval events will add
+        matched = (
+            Q(transaction_items__matched=True)
+            & ~Q(transaction_items__transaction_id__in=AnalyticsEventService.pending_scans())
+            & ~Q(transaction_items__id__in=AnalyticsEventService.pending_approvals(newly_matched_only=True))
+        )
+        stats = products.values('id').annotate(
+            total_scans=Count('transaction_items', filter=matched),
+            total_quantity=Sum('transaction_items__quantity', filter=matched),
+            total_revenue=Sum('transaction_items__price', filter=matched),
+            unique_users=Count('transaction_items__transaction__user', filter=matched, distinct=True)
+        ).order_by()
+
+        ProductAnalytics.objects.bulk_create(
+            [
+                ProductAnalytics(
+                    product_id=row['id'],
+                    total_scans=row['total_scans'],
+                    total_quantity=row['total_quantity'] or 0,
+                    total_revenue=row['total_revenue'] or 0.0,
+                    unique_users=row['unique_users']
+                )
+                for row in stats
+            ],
+            update_conflicts=True,
+            unique_fields=['product'],
+            update_fields=['total_scans', 'total_quantity', 'total_revenue', 'unique_users', 'last_updated']
+        )
 
     @staticmethod
-    def update_store_product_rankings(store_id=None):
+    def update_store_product_rankings(store_id=None, full=False):
         """
         Update store-product ranking cache.
+
+        Only stores that received transactions (or review approvals) since the
+        last refresh are rebuilt; `full=True`, a first run, or `store_id` rebuild
+        regardless. Rows are written with one bulk upsert and rows that no longer
+        exist are deleted afterwards, so readers never see a store's rankings empty.
         """
+        AnalyticsService.apply_pending_events()
+
+        started = timezone.now()
+        key = AnalyticsWatermark.STORE_PRODUCT_RANKINGS
+        watermark = AnalyticsWatermark.get(key)
+
+        items = TransactionItem.objects.all()
         if store_id:
-            stores = Store.objects.filter(id=store_id)
+            store_ids = [store_id]
+        elif full or watermark is None:
+            store_ids = None
         else:
-            stores = Store.objects.all()
-
-        for store in stores:
-            # Get product rankings for this store
-            rankings = TransactionItem.objects.filter(
-                transaction__store=store
-            ).values('product_name', 'product_id').annotate(
-                scan_count=Count('id'),
-                total_quantity=Sum('quantity'),
-                total_revenue=Sum('price')
-            ).order_by('-scan_count')
-
-            # Clear old rankings for this store
-            StoreProductRanking.objects.filter(store=store).delete()
-
-            # Create new rankings
-            for rank in rankings:
-                StoreProductRanking.objects.create(
-                    store=store,
-                    product_id=rank['product_id'],
-                    product_name=rank['product_name'],
-                    scan_count=rank['scan_count'],
-                    total_quantity=rank['total_quantity'],
-                    total_revenue=rank['total_revenue'] or 0.0
-                )
+            store_ids = AnalyticsService.stores_changed_since(
+                watermark - timedelta(seconds=AnalyticsService.refresh_config()['WATERMARK_OVERLAP_SECONDS'])
+            )
+            if not store_ids:
+                AnalyticsWatermark.advance(key, started)
+                return
+        if store_ids is not None:
+            items = items.filter(transaction__store_id__in=store_ids)
+        # Lines of scans whose events are still pending are added by those events
+        items = items.exclude(transaction_id__in=AnalyticsEventService.pending_scans())
+
+        # One row per store and receipt line name (unique per store); a name approved as
+        # a product later has both linked and unlinked lines, so take the linked product
+        rankings = items.values('transaction__store_id', 'product_name').annotate(
+            product_id=Max('product_id'),
+            scan_count=Count('id'),
+            total_quantity=Sum('quantity'),
+            total_revenue=Sum('price')
+        ).order_by()
+
+        with db_transaction.atomic():
+            StoreProductRanking.objects.bulk_create(
+                [
+                    StoreProductRanking(
+                        store_id=rank['transaction__store_id'],
+                        product_id=rank['product_id'],
+                        product_name=rank['product_name'],
+                        scan_count=rank['scan_count'],
+                        total_quantity=rank['total_quantity'] or 0,
+                        total_revenue=rank['total_revenue'] or 0.0
+                    )
+                    for rank in rankings
+                ],
+                update_conflicts=True,
+                unique_fields=['store', 'product_name'],
+                update_fields=['product', 'scan_count', 'total_quantity', 'total_revenue', 'last_updated']
+            )
+
+            # Every current row was just written; older ones belong to deleted lines
+            stale = StoreProductRanking.objects.filter(last_updated__lt=started)
+            if store_ids is not None:
+                stale = stale.filter(store_id__in=store_ids)
+            stale.delete()
+
+        if not store_id:
+            AnalyticsWatermark.advance(key, started)
+
+    @staticmethod
+    def stores_changed_since(since):
+        """Ids of stores with transactions scanned or review approvals logged after `since`."""
+        store_ids = set(
+            Transaction.objects.filter(scanned_at__gte=since)
+            .values_list('store_id', flat=True).distinct()
+        )
+        store_ids.update(
+            AnalyticsEvent.objects.filter(kind=AnalyticsEvent.REVIEW_APPROVED, created_at__gte=since)
+            .values_list('payload__store_id', flat=True).distinct()
+        )
+        return store_ids
 
     @staticmethod
-    def update_user_store_activities():
+    def refresh_config():
+        config = dict(DEFAULT_ANALYTICS_REFRESH_SETTINGS)
+        config.update(getattr(settings, 'ANALYTICS_REFRESH', {}))
+        return config
+
+    @staticmethod
+    def update_user_store_activities(full=False):
         """
         Update user-store activity cache for repeat customer analysis.
+
+        Transactions scanned since the last run (up to ACTIVITY_LAG_SECONDS ago, so
+        slow commits land before the watermark passes them) are merged into the
+        existing rows in batches with additive upserts. Rows count scan-time points;
+        points of later review approvals are added by the analytics events. A first
+        run or `full=True` recomputes the table (the repair path).
+        """
+        AnalyticsService.apply_pending_events()
+
+        config = AnalyticsService.refresh_config()
+        key = AnalyticsWatermark.USER_STORE_ACTIVITIES
+        until = timezone.now() - timedelta(seconds=config['ACTIVITY_LAG_SECONDS'])
+        since = AnalyticsWatermark.get(key)
+
+        if full or since is None:
+            AnalyticsService._rebuild_user_store_activities(until, config['ACTIVITY_BATCH_SIZE'])
+            return
+
+        while since < until:
+            with db_transaction.atomic():
+                # Serializes concurrent runs; a run that waited re-reads the watermark
+                since = AnalyticsWatermark.lock(key)
+                if since is None or since >= until:
+                    break
+                batch = AnalyticsService._scans_between(since, until, config['ACTIVITY_BATCH_SIZE'])
+                if not batch:
+                    AnalyticsWatermark.advance(key, until)
+                    break
+                AnalyticsService._add_to_user_store_activities(batch)
+                since = batch[-1]['scanned_at']
+                AnalyticsWatermark.advance(key, since)
+
+    @staticmethod
+    def _scans_between(since, until, limit):
+        """
+        Transactions scanned in (since, until], oldest first: `limit` of them plus any
+        sharing the last one's scanned_at, so the watermark can stop right after it.
+        Points exclude review approvals, which reach the activities as events.
         """
-        # Get all user-store combinations with activity
-        activities = Transaction.objects.values(
+        scans = Transaction.objects.annotate(
+            approved_points=Coalesce(Sum('items__points', filter=Q(items__review_status='approved')), 0)
+        ).values('user_id', 'store_id', 'scanned_at', 'total_points', 'total_amount', 'approved_points')
+
+        batch = list(scans.filter(scanned_at__gt=since, scanned_at__lte=until).order_by('scanned_at', 'id')[:limit])
+        if len(batch) == limit:
+            last = batch[-1]['scanned_at']
+            batch = [scan for scan in batch if scan['scanned_at'] < last]
+            batch += list(scans.filter(scanned_at=last))
+        return batch
+
+    @staticmethod
+    def _add_to_user_store_activities(scans):
+        """
+        Fold scans into per user-store deltas and add them with INSERT ... ON CONFLICT:
+        one statement on PostgreSQL, batches within the bind parameter limit elsewhere.
+        """
+        deltas = {}
+        for scan in scans:
+            pair = (scan['user_id'], scan['store_id'])
+            delta = deltas.setdefault(pair, [0, 0, 0.0, scan['scanned_at'], scan['scanned_at']])
+            delta[0] += 1
+            delta[1] += scan['total_points'] - scan['approved_points']
+            delta[2] += scan['total_amount'] or 0.0
+            delta[3] = min(delta[3], scan['scanned_at'])
+            delta[4] = max(delta[4], scan['scanned_at'])
+
+        ops = connection.ops
+        least, greatest = ('LEAST', 'GREATEST') if connection.vendor == 'postgresql' else ('MIN', 'MAX')
+        table = ops.quote_name(UserStoreActivity._meta.db_table)
+        now = ops.adapt_datetimefield_value(timezone.now())
+        rows = [
+            [
+                generate_cuid(), user_id, store_id, count, points, spent,
+                ops.adapt_datetimefield_value(first), ops.adapt_datetimefield_value(last), now
+            ]
+            for (user_id, store_id), (count, points, spent, first, last) in deltas.items()
+        ]
+
+        # max_query_params is None where there is no limit (PostgreSQL)
+        max_params = connection.features.max_query_params
+        chunk_size = max(max_params // 9, 1) if max_params else len(rows)
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} (id, user_id, store_id, scan_count, total_points_earned,
+                                         total_spent, first_scan, last_scan, last_updated)
+                    VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(chunk))}
+                    ON CONFLICT (user_id, store_id) DO UPDATE SET
+                        scan_count = {table}.scan_count + EXCLUDED.scan_count,
+                        total_points_earned = {table}.total_points_earned + EXCLUDED.total_points_earned,
+                        total_spent = {table}.total_spent + EXCLUDED.total_spent,
+                        first_scan = {least}(COALESCE({table}.first_scan, EXCLUDED.first_scan), EXCLUDED.first_scan),
+                        last_scan = {greatest}(COALESCE({table}.last_scan, EXCLUDED.last_scan), EXCLUDED.last_scan),
+                        last_updated = EXCLUDED.last_updated
+                    """,
+                    [param for row in chunk for param in row]
+                )
+
+    @staticmethod
+    def _rebuild_user_store_activities(until, batch_size):
+        """
+        Recompute every row in one transaction (readers keep seeing the old rows):
+        transactions scanned up to `until` in full, plus approval points of later
+        ones. Points of approvals whose events are still pending are left to them.
+        """
+        started = timezone.now()
+        pending_approvals = AnalyticsEventService.pending_approvals()
+        later_approvals = {
+            (row['transaction__user_id'], row['transaction__store_id']): row['points']
+            for row in TransactionItem.objects.filter(
+                review_status='approved', transaction__scanned_at__gt=until
+            ).exclude(id__in=pending_approvals).values(
+                'transaction__user_id', 'transaction__store_id'
+            ).annotate(points=Sum('points')).order_by()
+        }
+
+        pending_approval_points = TransactionItem.objects.filter(
+            transaction__user_id=OuterRef('user_id'),
+            transaction__store_id=OuterRef('store_id'),
+            transaction__scanned_at__lte=until,
+            id__in=pending_approvals
+        ).values('transaction__user_id').annotate(points=Sum('points')).values('points')
+        activities = Transaction.objects.filter(scanned_at__lte=until).values(
             'user_id', 'store_id'
         ).annotate(
             scan_count=Count('id'),
             total_points_earned=Sum('total_points'),
             total_spent=Sum('total_amount'),
             first_scan=Min('scanned_at'),
-            last_scan=Max('scanned_at')
+            last_scan=Max('scanned_at'),
+            pending_approval_points=Subquery(pending_approval_points)
+        ).order_by()
+
+        with db_transaction.atomic():
+            batch = []
+            for activity in activities.iterator(chunk_size=batch_size):
+                pair = (activity['user_id'], activity['store_id'])
+                activity['total_points_earned'] = (
+                    (activity['total_points_earned'] or 0) - (activity.pop('pending_approval_points') or 0)
+                    + later_approvals.pop(pair, 0)
+                )
+                activity['total_spent'] = activity['total_spent'] or 0.0
+                batch.append(UserStoreActivity(**activity))
+                if len(batch) >= batch_size:
+                    AnalyticsService._write_user_store_activities(batch)
+                    batch = []
+            batch += [
+                UserStoreActivity(user_id=user_id, store_id=store_id, total_points_earned=points)
+                for (user_id, store_id), points in later_approvals.items()
+            ]
+            AnalyticsService._write_user_store_activities(batch)
+
+            # Every current row was just written; older ones have no transactions left
+            UserStoreActivity.objects.filter(last_updated__lt=started).delete()
+            AnalyticsWatermark.set(AnalyticsWatermark.USER_STORE_ACTIVITIES, until)
+
+    @staticmethod
+    def _write_user_store_activities(activities):
+        UserStoreActivity.objects.bulk_create(
+            activities,
+            update_conflicts=True,
+            unique_fields=['user', 'store'],
+            update_fields=[
+                'scan_count', 'total_points_earned', 'total_spent', 'first_scan', 'last_scan', 'last_updated'
+            ]
         )
 
-        # Clear old data
-        UserStoreActivity.objects.all().delete()
-
-        # Create new records
-        for activity in activities:
-            UserStoreActivity.objects.create(
-                user_id=activity['user_id'],
-                store_id=activity['store_id'],
-                scan_count=activity['scan_count'],
-                total_points_earned=activity['total_points_earned'] or 0,
-                total_spent=activity['total_spent'] or 0.0,
-                first_scan=activity['first_scan'],
-                last_scan=activity['last_scan']
-            )
+    @staticmethod
+    def update_user_activity_logs(full=False):
+        """
+        Roll closed days up into UserActivityLog, one row per day (days without
+        scans included). Continues after the last rolled-up day and recomputes the
+        last ROLLUP_RECOMPUTE_DAYS of it, picking up late commits and review
+        approvals; a first run or `full=True` starts at the first transaction.
+        Returns the number of days written.
+        """
+        yesterday = timezone.localdate() - timedelta(days=1)
+        last = None if full else UserActivityLog.objects.aggregate(last=Max('date'))['last']
+        if last is None:
+            first = Transaction.objects.aggregate(first=Min('scanned_at'))['first']
+            start = timezone.localdate(first) if first else yesterday + timedelta(days=1)
+            # Days before the first transaction have no activity (left over from deleted data)
+            UserActivityLog.objects.filter(date__lt=start).delete()
+        else:
+            recompute_days = AnalyticsService.refresh_config()['ROLLUP_RECOMPUTE_DAYS']
+            start = last + timedelta(days=1) - timedelta(days=recompute_days)
+
+        if start > yesterday:
+            return 0
+        return AnalyticsService._roll_up_days(start, yesterday)
+
+    @staticmethod
+    def update_unique_user_sketches(full=False):
+        """
+        Build the per store/day, product/day and global/day unique user sketches of
+        closed days (see analytics/sketches.py), like update_user_activity_logs.
+        """
+        return UniqueUserSketchService.update_sketches(
+            full=full, recompute_days=AnalyticsService.refresh_config()['ROLLUP_RECOMPUTE_DAYS']
+        )
+
+    @staticmethod
+    def _roll_up_days(start, end):
+        """Compute and upsert the UserActivityLog rows of days `start`..`end`."""
+        since = AnalyticsService._day_start(start)
+        until = AnalyticsService._day_start(end + timedelta(days=1))
+
+        scans = {
+            row.pop('date'): row
+            for row in Transaction.objects.filter(
+                scanned_at__gte=since, scanned_at__lt=until
+            ).annotate(
+                date=TruncDate('scanned_at')
+            ).values('date').annotate(
+                total_scans=Count('id'),
+                total_points_earned=Sum('total_points'),
+                total_revenue=Sum('total_amount'),
+                active_users=Count('user', distinct=True)
+            ).order_by()
+        }
+        new_users = dict(
+            User.objects.filter(
+                created_at__gte=since, created_at__lt=until
+            ).annotate(
+                date=TruncDate('created_at')
+            ).values('date').annotate(count=Count('id')).order_by().values_list('date', 'count')
+        )
+
+        # Products whose first matched scan ever falls in the range, by day of that scan
+        scanned_before = TransactionItem.objects.filter(
+            matched=True, product_id=OuterRef('product_id'), transaction__scanned_at__lt=since
+        )
+        first_scans = TransactionItem.objects.filter(
+            ~Exists(scanned_before),
+            matched=True,
+            product__isnull=False,
+            transaction__scanned_at__gte=since,
+            transaction__scanned_at__lt=until
+        ).values('product_id').annotate(first=Min('transaction__scanned_at')).order_by()
+        new_products = defaultdict(int)
+        for first in first_scans.values_list('first', flat=True):
+            new_products[timezone.localdate(first)] += 1
+
+        logs = []
+        day = start
+        while day <= end:
+            totals = scans.get(day, {})
+            logs.append(UserActivityLog(
+                date=day,
+                total_scans=totals.get('total_scans', 0),
+                total_points_earned=totals.get('total_points_earned') or 0,
+                total_points_redeemed=0,  # To be implemented with redemption tracking
+                total_revenue=totals.get('total_revenue') or 0.0,
+                active_users=totals.get('active_users', 0),
+                new_users=new_users.get(day, 0),
+                new_products_scanned=new_products[day]
+            ))
+            day += timedelta(days=1)
+
+        UserActivityLog.objects.bulk_create(
+            logs,
+            update_conflicts=True,
+            unique_fields=['date'],
+            update_fields=[
+                'total_scans', 'total_points_earned', 'total_points_redeemed', 'total_revenue',
+                'active_users', 'new_users', 'new_products_scanned'
+            ]
+        )
+        return len(logs)
 
     @staticmethod
     def update_all_analytics():
         """
-        Update all cached analytics data. Should be run periodically (e.g., daily cron job).
+        Recompute all cached analytics data from scratch. Day to day the tables are
+        maintained incrementally from the analytics change log (analytics/events.py);
+        this full rebuild is the repair path. Pending events are marked applied
+        with it, since the rebuild covers them.
         """
-        print("Updating store analytics...")
-        AnalyticsService.update_store_analytics()
+        # Pending events are marked applied in the transaction that writes the rebuilt
+        # rows, so they commit together; events logged later stay pending and the
+        # rebuilds leave out what those will add
+        with db_transaction.atomic():
+            AnalyticsEventService.mark_all_applied()
+
+            print("Updating store analytics...")
+            AnalyticsService.update_store_analytics()
+
+            print("Updating product analytics...")
+            AnalyticsService.update_product_analytics()
 
-        print("Updating product analytics...")
-        AnalyticsService.update_product_analytics()
+            print("Updating store-product rankings...")
+            AnalyticsService.update_store_product_rankings(full=True)
 
-        print("Updating store-product rankings...")
-        AnalyticsService.update_store_product_rankings()
+            print("Updating user-store activities...")
+            AnalyticsService.update_user_store_activities(full=True)
 
-        print("Updating user-store activities...")
-        AnalyticsService.update_user_store_activities()
+        print("Updating daily activity rollup...")
+        AnalyticsService.update_user_activity_logs(full=True)
+        AnalyticsService.update_unique_user_sketches(full=True)
 
         print("Analytics update complete!")
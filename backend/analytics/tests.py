@@ -1,3 +1,399 @@
-from django.test import TestCase
+import io
+import zlib
+from contextlib import redirect_stdout
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from products.models import Product, Store
+from transactions.models import Transaction, TransactionItem
+from transactions.services import ReceiptProcessingService
+from users.models import User
+from .events import AnalyticsEventService
+from .models import (
+    AnalyticsEvent, ProductAnalytics, StoreAnalytics, StoreProductRanking, UniqueUserSketch, UserActivityLog,
+    UserStoreActivity
+)
+from .services import AnalyticsService
+from .sketches import RELATIVE_ERROR, HyperLogLog, UniqueUserSketchService
+
+
+class AnalyticsFixturesMixin:
+    """A few users, stores and products, and helpers to scan receipts and snapshot the tables."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(email='alice@example.com', password='x', name='Alice')
+        cls.bob = User.objects.create_user(email='bob@example.com', password='x', name='Bob')
+        cls.maxi = Store.objects.create(name='Maxi')
+        cls.idea = Store.objects.create(name='Idea')
+        cls.milk = Product.objects.create(name='Mleko 1L', points=3)
+        cls.bread = Product.objects.create(name='Hleb', points=2)
+        cls.admin = User.objects.create_superuser(email='admin@example.com', password='x', name='Admin')
+
+    def scan(self, user, store, lines):
+        """Persist a receipt of (product or None, receipt name, quantity, price) lines."""
+        items = [
+            dict(
+                product_id=product.id if product else None,
+                product_name=name,
+                quantity=quantity,
+                price=price,
+                points=product.points if product else 0,
+                matched=product is not None
+            )
+            for product, name, quantity, price in lines
+        ]
+        total_points = sum(item['points'] for item in items)
+        total_amount = sum(item['price'] for item in items)
+        transaction, _ = ReceiptProcessingService.persist_receipt(
+            user, store, items, total_points, total_amount=total_amount
+        )
+        return transaction
+
+    def scan_on(self, days_ago, user, store, product):
+        """Scan one line of `product`, dated `days_ago` days back."""
+        transaction = self.scan(user, store, [(product, product.name, 1, 100.0)])
+        scanned_at = timezone.now() - timedelta(days=days_ago)
+        Transaction.objects.filter(pk=transaction.pk).update(scanned_at=scanned_at)
+
+    def approve(self, transaction, product_name, product):
+        """Send a transaction's unmatched line to review and approve it as `product`."""
+        item = TransactionItem.objects.get(transaction=transaction, product_name=product_name)
+        item.review_status = 'pending'
+        item.save()
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        response = client.post(
+            f'/api/reviews/{item.id}/approve/', {'points': 5, 'product_id': product.id}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    @staticmethod
+    def snapshot():
+        return (
+            sorted(StoreAnalytics.objects.filter(total_scans__gt=0).values_list(
+                'store_id', 'total_scans', 'total_points_earned', 'unique_users', 'total_revenue'
+            )),
+            sorted(ProductAnalytics.objects.filter(total_scans__gt=0).values_list(
+                'product_id', 'total_scans', 'total_quantity', 'total_revenue', 'unique_users'
+            )),
+            sorted(StoreProductRanking.objects.values_list(
+                'store_id', 'product_name', 'scan_count', 'total_quantity', 'total_revenue', 'product_id'
+            )),
+        )
+
+    def assertIncrementalMatchesRebuild(self, batch_size=500):
+        AnalyticsEventService.apply_pending_events(batch_size=batch_size)
+        incremental = self.snapshot()
+
+        AnalyticsService.update_store_analytics(exact=True)
+        AnalyticsService.update_product_analytics()
+        AnalyticsService.update_store_product_rankings(full=True)
+        self.assertEqual(incremental, self.snapshot())
+        return incremental
+
+
+class AnalyticsEventTests(AnalyticsFixturesMixin, TestCase):
+
+    def test_repeated_product_lines_count_one_user(self):
+        self.scan(self.alice, self.maxi, [
+            (self.milk, 'MLEKO 1L', 1, 120.0),
+            (self.bread, 'HLEB', 1, 60.0),
+            (self.milk, 'MLEKO 1L', 2, 240.0),
+        ])
+        self.scan(self.bob, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0)])
+
+        self.assertIncrementalMatchesRebuild()
+        milk = ProductAnalytics.objects.get(product=self.milk)
+        self.assertEqual((milk.total_scans, milk.total_quantity, milk.unique_users), (3, 4, 2))
+
+    def test_repeated_product_lines_across_batches(self):
+        self.scan(self.alice, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0), (self.milk, 'MLEKO 1L', 1, 120.0)])
+        self.scan(self.alice, self.idea, [(self.milk, 'MLEKO', 1, 115.0)])
+        self.scan(self.bob, self.idea, [(self.bread, 'HLEB', 1, 60.0), (self.bread, 'HLEB', 1, 60.0)])
+
+        self.assertIncrementalMatchesRebuild(batch_size=1)
+        self.assertEqual(ProductAnalytics.objects.get(product=self.milk).unique_users, 1)
+        self.assertEqual(StoreAnalytics.objects.get(store=self.idea).unique_users, 2)
+
+    def test_approving_an_older_line_after_its_buyer_was_counted(self):
+        older = self.scan(self.alice, self.maxi, [(None, 'MLK 1L', 1, 120.0)])
+        self.scan(self.alice, self.idea, [(self.milk, 'MLEKO 1L', 1, 120.0)])
+        AnalyticsEventService.apply_pending_events()
+
+        self.approve(older, 'MLK 1L', self.milk)
+        self.assertIncrementalMatchesRebuild()
+        self.assertEqual(ProductAnalytics.objects.get(product=self.milk).unique_users, 1)
+
+    def test_approval_decision_does_not_depend_on_apply_order(self):
+        older = self.scan(self.alice, self.maxi, [(None, 'MLK 1L', 1, 120.0)])
+        self.scan(self.alice, self.idea, [(self.milk, 'MLEKO 1L', 1, 120.0)])
+        newer = self.scan(self.bob, self.idea, [(None, 'HLB', 1, 60.0), (None, 'MLK', 1, 120.0)])
+        self.approve(older, 'MLK 1L', self.milk)
+        self.approve(newer, 'HLB', self.bread)
+        self.approve(newer, 'MLK', self.milk)
+
+        self.assertIncrementalMatchesRebuild(batch_size=1)
+        milk = ProductAnalytics.objects.get(product=self.milk)
+        self.assertEqual((milk.total_scans, milk.unique_users), (3, 2))
+        self.assertEqual(ProductAnalytics.objects.get(product=self.bread).unique_users, 1)
+
+    def rescan_at(self, transaction, scanned_at):
+        """Move a transaction and its scan event to another time, as if it had been scanned then."""
+        Transaction.objects.filter(pk=transaction.pk).update(scanned_at=scanned_at)
+        event = AnalyticsEvent.objects.get(transaction_id=transaction.pk, kind=AnalyticsEvent.SCAN)
+        event.payload['scanned_at'] = scanned_at.isoformat()
+        event.save(update_fields=['payload'])
+
+    def test_older_transaction_committed_after_a_newer_one_was_applied(self):
+        newer = self.scan(self.alice, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0)])
+        AnalyticsEventService.apply_pending_events()
+
+        older = self.scan(self.alice, self.maxi, [(self.bread, 'HLEB', 1, 60.0)])
+        self.rescan_at(older, newer.scanned_at - timedelta(hours=1))
+        self.assertIncrementalMatchesRebuild()
+        self.assertEqual(StoreAnalytics.objects.get(store=self.maxi).unique_users, 1)
+
+    def test_transactions_with_the_same_timestamp_count_one_user(self):
+        first = self.scan(self.alice, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0)])
+        second = self.scan(self.alice, self.maxi, [(self.bread, 'HLEB', 1, 60.0)])
+        self.rescan_at(second, first.scanned_at)
+
+        self.assertIncrementalMatchesRebuild(batch_size=1)
+        self.assertEqual(StoreAnalytics.objects.get(store=self.maxi).unique_users, 1)
+
+
+@override_settings(ANALYTICS_REFRESH={'ACTIVITY_LAG_SECONDS': 0})
+class AnalyticsRebuildTests(AnalyticsFixturesMixin, TestCase):
+
+    @staticmethod
+    def activities():
+        return sorted(UserStoreActivity.objects.values_list(
+            'user_id', 'store_id', 'scan_count', 'total_points_earned', 'total_spent'
+        ))
+
+    def test_full_rebuild_marks_the_events_it_covers(self):
+        self.scan(self.alice, self.maxi, [(self.milk, 'MLEKO 1L', 2, 240.0)])
+        self.scan(self.bob, self.idea, [(self.bread, 'HLEB', 1, 60.0)])
+
+        with redirect_stdout(io.StringIO()):
+            AnalyticsService.update_all_analytics()
+        self.assertEqual(AnalyticsEventService.pending_count(), 0)
+        self.assertIncrementalMatchesRebuild()
+
+    def test_rebuild_leaves_out_events_logged_during_it(self):
+        first = self.scan(self.alice, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0), (None, 'HLB', 1, 60.0)])
+        AnalyticsEventService.apply_pending_events()
+        AnalyticsService.update_user_store_activities(full=True)
+
+        # Logged after the rebuild applied the pending events, before it reads the tables
+        self.scan(self.bob, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0)])
+        self.approve(first, 'HLB', self.bread)
+        self.assertEqual(AnalyticsEvent.objects.filter(applied_at__isnull=True).count(), 2)
+        with mock.patch.object(AnalyticsService, 'apply_pending_events'):
+            AnalyticsService.update_store_analytics(exact=True)
+            AnalyticsService.update_product_analytics()
+            AnalyticsService.update_store_product_rankings(full=True)
+            AnalyticsService.update_user_store_activities(full=True)
+
+        incremental = self.assertIncrementalMatchesRebuild()
+        maxi = StoreAnalytics.objects.get(store=self.maxi)
+        self.assertEqual((maxi.total_scans, maxi.unique_users, maxi.total_points_earned), (2, 2, 11))
+        self.assertIn((self.bread.id, 1, 1, 60.0, 1), incremental[1])
+
+        activities = self.activities()
+        AnalyticsService.update_user_store_activities(full=True)
+        self.assertEqual(activities, self.activities())
+
+    def test_store_and_product_rebuilds_use_a_constant_number_of_queries(self):
+        output = io.StringIO()
+        call_command('benchmark_analytics_rebuild', sizes=[2, 8], transactions_per_store=3, stdout=output)
+        self.assertIn('Query counts are constant across catalog sizes', output.getvalue())
+
+    def test_activity_merge_is_batched_within_the_parameter_limit(self):
+        self.scan(self.alice, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0)])
+        AnalyticsService.update_user_store_activities()
+
+        for user in (self.alice, self.bob):
+            for store in (self.maxi, self.idea):
+                self.scan(user, store, [(self.bread, 'HLEB', 1, 60.0)])
+        # Two rows (9 parameters each) per statement: four user-store pairs take two
+        with mock.patch.object(connection.features, 'max_query_params', 18), \
+                CaptureQueriesContext(connection) as queries:
+            AnalyticsService.update_user_store_activities()
+        merges = [query for query in queries if 'INSERT INTO "user_store_activities"' in query['sql']]
+        self.assertEqual(len(merges), 2)
+
+        activities = self.activities()
+        AnalyticsService.update_user_store_activities(full=True)
+        self.assertEqual(activities, self.activities())
+        self.assertIn((self.alice.id, self.maxi.id, 2, 5, 180.0), activities)
+
+
+class HyperLogLogTests(TestCase):
+
+    def test_small_counts_are_exact(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+        self.assertEqual(HyperLogLog().update(['a', 'b', 'a', 'c']).count(), 3)
+
+    def test_estimate_is_within_the_error_bound(self):
+        sketch = HyperLogLog().update(range(50000))
+        self.assertLess(abs(sketch.count() - 50000) / 50000, 3 * RELATIVE_ERROR)
+
+    def test_merge_is_the_union(self):
+        monday = HyperLogLog().update(range(0, 3000))
+        tuesday = HyperLogLog().update(range(2000, 5000))
+        union = HyperLogLog().update(range(0, 5000))
+
+        self.assertEqual(monday.merge(tuesday).registers, union.registers)
+        self.assertLess(abs(union.count() - 5000) / 5000, 3 * RELATIVE_ERROR)
+
+    def test_round_trips_through_bytes(self):
+        sketch = HyperLogLog().update(range(100))
+        self.assertEqual(HyperLogLog.from_bytes(sketch.to_bytes()).registers, sketch.registers)
+        with self.assertRaises(ValueError):
+            HyperLogLog.from_bytes(zlib.compress(bytes(16)))
+
+
+class UniqueUserSketchTests(AnalyticsFixturesMixin, TestCase):
+
+    def test_rolled_up_and_raw_days_merge(self):
+        self.scan_on(3, self.alice, self.maxi, self.milk)
+        self.scan_on(2, self.bob, self.maxi, self.bread)
+        self.scan_on(2, self.alice, self.idea, self.milk)
+        self.scan_on(0, self.bob, self.maxi, self.milk)
+
+        today = timezone.localdate()
+        self.assertEqual(UniqueUserSketchService.update_sketches(), 3)
+        self.assertEqual(UniqueUserSketchService.last_rolled_up_day(), today - timedelta(days=1))
+        self.assertEqual(UniqueUserSketch.objects.filter(date=today - timedelta(days=2)).count(), 5)
+
+        for scope, key, expected in [
+            (UniqueUserSketch.GLOBAL, '', 2),
+            (UniqueUserSketch.STORE, self.maxi.id, 2),
+            (UniqueUserSketch.STORE, self.idea.id, 1),
+            (UniqueUserSketch.PRODUCT, self.milk.id, 2),
+            (UniqueUserSketch.PRODUCT, self.bread.id, 1),
+        ]:
+            self.assertEqual(UniqueUserSketchService.unique_users(scope, key), expected)
+            self.assertEqual(UniqueUserSketchService.unique_users(scope, key, exact=True), expected)
+
+        three_days_ago = today - timedelta(days=3)
+        self.assertEqual(UniqueUserSketchService.unique_users(
+            UniqueUserSketch.STORE, self.idea.id, start=three_days_ago, end=three_days_ago
+        ), 0)
+
+    def test_recomputes_the_latest_days(self):
+        self.scan_on(1, self.alice, self.maxi, self.milk)
+        UniqueUserSketchService.update_sketches()
+        self.scan_on(1, self.bob, self.maxi, self.milk)
+
+        self.assertEqual(UniqueUserSketchService.update_sketches(recompute_days=1), 1)
+        self.assertEqual(UniqueUserSketchService.unique_users(UniqueUserSketch.PRODUCT, self.milk.id), 2)
+
+    def test_rankings_and_store_analytics_read_the_sketches(self):
+        self.scan_on(2, self.alice, self.maxi, self.milk)
+        self.scan_on(2, self.bob, self.maxi, self.bread)
+        self.scan_on(1, self.alice, self.idea, self.milk)
+        UniqueUserSketchService.update_sketches()
+        self.scan_on(0, self.bob, self.idea, self.milk)
+
+        for exact in (False, True):
+            with CaptureQueriesContext(connection) as queries:
+                by_scans = AnalyticsService.get_store_rankings_by_scans(exact=exact)
+            self.assertEqual(len(queries), 2 if exact else 4)
+            self.assertEqual({row['store_id']: row['unique_users'] for row in by_scans}, {
+                self.maxi.id: 2, self.idea.id: 2
+            })
+            leaderboard = AnalyticsService.get_store_leaderboard(exact=exact)
+            self.assertEqual({row['store_id']: row['unique_customers'] for row in leaderboard}, {
+                self.maxi.id: 2, self.idea.id: 2
+            })
+            products = AnalyticsService.get_product_leaderboard(exact=exact)
+            self.assertEqual({row['product_id']: row['unique_users'] for row in products}, {
+                self.milk.id: 2, self.bread.id: 1
+            })
+
+            AnalyticsService.update_store_analytics(exact=exact)
+            self.assertEqual(dict(StoreAnalytics.objects.values_list('store_id', 'unique_users')), {
+                self.maxi.id: 2, self.idea.id: 2
+            })
+        # Raw days are read from the transactions: the sketches were not written by the ranking reads
+        self.assertFalse(UniqueUserSketch.objects.filter(date=timezone.localdate()).exists())
+
+
+@override_settings(ANALYTICS_REFRESH={'WATERMARK_OVERLAP_SECONDS': 0})
+class StoreProductRankingTests(AnalyticsFixturesMixin, TestCase):
+
+    def rankings(self):
+        return dict(
+            ((store_id, name), (count, updated))
+            for store_id, name, count, updated in StoreProductRanking.objects.values_list(
+                'store_id', 'product_name', 'scan_count', 'last_updated'
+            )
+        )
+
+    def test_refresh_rebuilds_only_changed_stores(self):
+        first = self.scan(self.alice, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0), (None, 'KESA', 1, 5.0)])
+        self.scan(self.bob, self.idea, [(self.bread, 'HLEB', 1, 60.0)])
+        AnalyticsService.update_store_product_rankings()
+        before = self.rankings()
+
+        TransactionItem.objects.filter(transaction=first, product_name='KESA').delete()
+        self.scan(self.bob, self.maxi, [(self.milk, 'MLEKO 1L', 2, 240.0)])
+        AnalyticsService.update_store_product_rankings()
+        after = self.rankings()
+
+        self.assertEqual(set(after), {(self.maxi.id, 'MLEKO 1L'), (self.idea.id, 'HLEB')})
+        self.assertEqual(after[self.maxi.id, 'MLEKO 1L'][0], 2)
+        self.assertGreater(after[self.maxi.id, 'MLEKO 1L'][1], before[self.maxi.id, 'MLEKO 1L'][1])
+        self.assertEqual(after[self.idea.id, 'HLEB'], before[self.idea.id, 'HLEB'])
+
+    def test_refresh_without_changes_writes_nothing(self):
+        self.scan(self.alice, self.maxi, [(self.milk, 'MLEKO 1L', 1, 120.0)])
+        AnalyticsService.update_store_product_rankings()
+
+        with CaptureQueriesContext(connection) as queries:
+            AnalyticsService.update_store_product_rankings()
+        self.assertFalse([query for query in queries if '"store_product_rankings"' in query['sql']])
+
+
+class UserActivityLogTests(AnalyticsFixturesMixin, TestCase):
+
+    def test_trends_read_the_rollup_and_todays_scans_alike(self):
+        self.scan_on(3, self.alice, self.maxi, self.milk)
+        self.scan_on(3, self.bob, self.maxi, self.bread)
+        self.scan_on(1, self.alice, self.idea, self.milk)
+        self.scan_on(0, self.alice, self.maxi, self.bread)
+        daily = AnalyticsService.get_daily_activity_trend(days=7)
+        weekly = AnalyticsService.get_weekly_activity_trend(weeks=2, exact=True)
+
+        self.assertEqual(AnalyticsService.update_user_activity_logs(), 3)
+        self.assertEqual(AnalyticsService.get_daily_activity_trend(days=7), daily)
+        self.assertEqual(AnalyticsService.get_weekly_activity_trend(weeks=2, exact=True), weekly)
+        self.assertEqual(AnalyticsService.get_weekly_activity_trend(weeks=2), weekly)
+
+        today = timezone.localdate()
+        self.assertEqual([row['total_scans'] for row in daily], [2, 1, 1])
+        self.assertEqual(daily[0]['date'], today - timedelta(days=3))
+        logs = UserActivityLog.objects.order_by('date')
+        self.assertEqual(
+            list(logs.values_list('total_scans', 'active_users', 'new_products_scanned')),
+            [(2, 2, 2), (0, 0, 0), (1, 1, 0)]
+        )
+
+    def test_recomputes_the_latest_closed_days(self):
+        self.scan_on(2, self.alice, self.maxi, self.milk)
+        AnalyticsService.update_user_activity_logs()
+        self.scan_on(1, self.bob, self.maxi, self.milk)
+
+        AnalyticsService.update_user_activity_logs()
+        log = UserActivityLog.objects.get(date=timezone.localdate() - timedelta(days=1))
+        self.assertEqual((log.total_scans, log.total_revenue), (1, 100.0))
@@ -21,6 +21,7 @@ urlpatterns = [
     path('daily-trend/', views.daily_activity_trend, name='daily-trend'),
     path('most-scanned-products/', views.most_scanned_products, name='most-scanned-products'),
     path('store-report/', views.store_detailed_report, name='store-report'),
+    path('unique-users/', views.unique_users, name='unique-users'),
     path('top-repeat-customers/', views.top_repeat_customers, name='top-repeat-customers'),
     path('new-product-frequency/', views.new_product_scan_frequency, name='new-product-frequency'),
     path('new-products-growth/', views.new_products_growth, name='new-products-growth'),
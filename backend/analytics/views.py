@@ -8,13 +8,15 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
+from datetime import date
 
 from .models import (
     StoreAnalytics,
     ProductAnalytics,
     UserActivityLog,
     StoreProductRanking,
-    UserStoreActivity
+    UserStoreActivity,
+    UniqueUserSketch
 )
 from .serializers import (
     StoreAnalyticsSerializer,
@@ -24,6 +26,12 @@ from .serializers import (
     UserStoreActivitySerializer
 )
 from .services import AnalyticsService
+from .sketches import RELATIVE_ERROR
+
+
+def exact_requested(request):
+    """?exact=true: count distinct users on the transactions instead of the sketches (audits)."""
+    return request.query_params.get('exact', '').lower() in ('1', 'true', 'yes')
 
 
 class StoreAnalyticsViewSet(viewsets.ReadOnlyModelViewSet):
@@ -131,14 +139,16 @@ def store_rankings(request):
     Query params:
     - by: 'scans' or 'points' (default: scans)
     - limit: number of results (default: 10)
+    - exact: count unique users exactly instead of from the sketches (default: false)
     """
     by = request.query_params.get('by', 'scans')
     limit = int(request.query_params.get('limit', 10))
+    exact = exact_requested(request)
 
     if by == 'points':
-        data = AnalyticsService.get_store_rankings_by_points(limit=limit)
+        data = AnalyticsService.get_store_rankings_by_points(limit=limit, exact=exact)
     else:
-        data = AnalyticsService.get_store_rankings_by_scans(limit=limit)
+        data = AnalyticsService.get_store_rankings_by_scans(limit=limit, exact=exact)
 
     return Response(data)
 
@@ -150,9 +160,10 @@ def weekly_activity_trend(request):
     Get weekly activity trend.
     Query params:
     - weeks: number of weeks to include (default: 12)
+    - exact: count active users exactly instead of from the sketches (default: false)
     """
     weeks = int(request.query_params.get('weeks', 12))
-    data = AnalyticsService.get_weekly_activity_trend(weeks=weeks)
+    data = AnalyticsService.get_weekly_activity_trend(weeks=weeks, exact=exact_requested(request))
     return Response(data)
 
 
@@ -163,9 +174,10 @@ def monthly_activity_trend(request):
     Get monthly activity trend.
     Query params:
     - months: number of months to include (default: 12)
+    - exact: count active users exactly instead of from the sketches (default: false)
     """
     months = int(request.query_params.get('months', 12))
-    data = AnalyticsService.get_monthly_activity_trend(months=months)
+    data = AnalyticsService.get_monthly_activity_trend(months=months, exact=exact_requested(request))
     return Response(data)
 
 
@@ -209,6 +221,7 @@ def store_detailed_report(request):
     Query params:
     - store_id: required
     - days: number of days to include (default: 30)
+    - exact: count unique users exactly instead of from the sketches (default: false)
     """
     store_id = request.query_params.get('store_id')
     if not store_id:
@@ -218,10 +231,61 @@ def store_detailed_report(request):
         )
 
     days = int(request.query_params.get('days', 30))
-    data = AnalyticsService.get_store_detailed_report(store_id=store_id, days=days)
+    data = AnalyticsService.get_store_detailed_report(
+        store_id=store_id, days=days, exact=exact_requested(request)
+    )
     return Response(data)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+def unique_users(request):
+    """
+    Get the number of distinct users over a date range, merged from the daily
+    unique user sketches (relative standard error ~1.6%).
+    Query params:
+    - scope: store, product or global (default: global)
+    - id: store or product id (required unless scope is global)
+    - start, end: dates (YYYY-MM-DD), inclusive (default: all time through today)
+    - exact: count on the transactions instead, for audits (default: false)
+    """
+    scope = request.query_params.get('scope', UniqueUserSketch.GLOBAL)
+    key = request.query_params.get('id', '')
+    if scope not in dict(UniqueUserSketch.SCOPE_CHOICES):
+        return Response(
+            {'error': 'scope must be store, product or global'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if scope != UniqueUserSketch.GLOBAL and not key:
+        return Response(
+            {'error': 'id parameter is required for store and product scopes'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        start, end = (
+            date.fromisoformat(request.query_params[name]) if request.query_params.get(name) else None
+            for name in ('start', 'end')
+        )
+    except ValueError:
+        return Response(
+            {'error': 'start and end must be dates (YYYY-MM-DD)'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    exact = exact_requested(request)
+    count = AnalyticsService.get_unique_users(scope, key, start=start, end=end, exact=exact)
+    return Response({
+        'scope': scope,
+        'id': key or None,
+        'start': start,
+        'end': end,
+        'unique_users': count,
+        'exact': exact,
+        'relative_error': 0.0 if exact else round(RELATIVE_ERROR, 4)
+    })
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated, IsAdminUser])
 def top_repeat_customers(request):
@@ -289,9 +353,10 @@ def store_leaderboard(request):
     Get comprehensive store leaderboard.
     Query params:
     - limit: number of results (default: 20)
+    - exact: count unique customers exactly instead of from the sketches (default: false)
     """
     limit = int(request.query_params.get('limit', 20))
-    data = AnalyticsService.get_store_leaderboard(limit=limit)
+    data = AnalyticsService.get_store_leaderboard(limit=limit, exact=exact_requested(request))
     return Response(data)
 
 
@@ -302,9 +367,10 @@ def product_leaderboard(request):
     Get product leaderboard by scan count.
     Query params:
     - limit: number of results (default: 20)
+    - exact: count unique users exactly instead of from the sketches (default: false)
     """
     limit = int(request.query_params.get('limit', 20))
-    data = AnalyticsService.get_product_leaderboard(limit=limit)
+    data = AnalyticsService.get_product_leaderboard(limit=limit, exact=exact_requested(request))
     return Response(data)
 
 
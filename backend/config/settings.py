@@ -209,3 +209,147 @@ SPECTACULAR_SETTINGS = {
     'SERVE_INCLUDE_SCHEMA': False,
     'COMPONENT_SPLIT_REQUEST': True,
 }
+
+# SUF (Serbian Tax Authority) HTTP client
+# One pooled keep-alive session per process; see transactions/suf_client.py
+SUF_CLIENT = {
+    'BASE_URL': os.getenv('SUF_BASE_URL', 'https://suf.purs.gov.rs'),
+    # True: fetch receipt pages from SUF_BASE_URL too (local `run_fake_suf` server)
+    'REDIRECT_RECEIPT_URLS': os.getenv('SUF_REDIRECT_RECEIPT_URLS', 'False') == 'True',
+    'POOL_CONNECTIONS': int(os.getenv('SUF_POOL_CONNECTIONS', 4)),
+    'POOL_MAXSIZE': int(os.getenv('SUF_POOL_MAXSIZE', 10)),
+    'POOL_BLOCK': os.getenv('SUF_POOL_BLOCK', 'False') == 'True',
+    'CONNECT_TIMEOUT': float(os.getenv('SUF_CONNECT_TIMEOUT', 3.05)),
+    'READ_TIMEOUT': float(os.getenv('SUF_READ_TIMEOUT', 10)),
+    'GET_RETRIES': int(os.getenv('SUF_GET_RETRIES', 2)),
+    'RETRY_BACKOFF': float(os.getenv('SUF_RETRY_BACKOFF', 0.3)),
+    'RETRY_JITTER': float(os.getenv('SUF_RETRY_JITTER', 0.5)),
+}
+
+# Circuit breaker around SUF calls (per process, see transactions/suf_client.py)
+# Trips when ERROR_RATE of the calls in the last WINDOW_SECONDS fail, then fails
+# fast for OPEN_SECONDS; read timeouts adapt to TIMEOUT_MULTIPLIER x p99 latency,
+# capped by SUF_CLIENT READ_TIMEOUT. State: GET /api/receipts/suf-status/ (admin)
+SUF_CIRCUIT_BREAKER = {
+    'ENABLED': os.getenv('SUF_CIRCUIT_BREAKER_ENABLED', 'True') == 'True',
+    'WINDOW_SECONDS': int(os.getenv('SUF_BREAKER_WINDOW', 60)),
+    'MIN_CALLS': int(os.getenv('SUF_BREAKER_MIN_CALLS', 10)),
+    'ERROR_RATE': float(os.getenv('SUF_BREAKER_ERROR_RATE', 0.5)),
+    'OPEN_SECONDS': int(os.getenv('SUF_BREAKER_OPEN_SECONDS', 30)),
+    'TIMEOUT_MULTIPLIER': float(os.getenv('SUF_TIMEOUT_MULTIPLIER', 3.0)),
+    'MIN_READ_TIMEOUT': float(os.getenv('SUF_MIN_READ_TIMEOUT', 2.0)),
+}
+
+# Asynchronous receipt scanning
+# When enabled, scan_receipt queues a job and returns 202; run the worker pool
+# with `python manage.py process_scan_jobs`
+RECEIPT_SCAN_ASYNC = os.getenv('RECEIPT_SCAN_ASYNC', 'False') == 'True'
+RECEIPT_SCAN_JOB_MAX_ATTEMPTS = int(os.getenv('RECEIPT_SCAN_JOB_MAX_ATTEMPTS', 3))
+RECEIPT_SCAN_JOB_RETRY_DELAY = int(os.getenv('RECEIPT_SCAN_JOB_RETRY_DELAY', 30))
+# A running job is requeued once its worker has not refreshed its heartbeat for
+# STALE_AFTER seconds; workers refresh it every HEARTBEAT_INTERVAL seconds
+RECEIPT_SCAN_JOB_STALE_AFTER = int(os.getenv('RECEIPT_SCAN_JOB_STALE_AFTER', 300))
+RECEIPT_SCAN_JOB_HEARTBEAT_INTERVAL = int(os.getenv('RECEIPT_SCAN_JOB_HEARTBEAT_INTERVAL', 30))
+
+# Duplicate scan detection (Transaction.receipt_fingerprint, unique per user)
+# 'per_user': each user can claim a receipt once; 'global': a receipt can be claimed once in total.
+# Both are enforced by unique constraints (global claims by a partial unique index on the fingerprint).
+# Fingerprints do not depend on the policy, so changing it applies to past scans too.
+RECEIPT_DUPLICATE_POLICY = os.getenv('RECEIPT_DUPLICATE_POLICY', 'per_user')
+
+# Batch receipt scanning (POST /api/receipts/scan-batch/)
+# Receipts in a batch are fetched from SUF concurrently; keep the worker count
+# at or below SUF_POOL_MAXSIZE so every fetch gets a pooled connection
+RECEIPT_BATCH_MAX_SIZE = int(os.getenv('RECEIPT_BATCH_MAX_SIZE', 20))
+RECEIPT_BATCH_FETCH_WORKERS = int(os.getenv('RECEIPT_BATCH_FETCH_WORKERS', 5))
+
+# Persistent cache of SUF receipt responses (fiscal receipts are immutable)
+# Least recently used entries are evicted beyond MAX_ENTRIES / MAX_BYTES, every
+# EVICT_EVERY stored entries (0: only by `python manage.py evict_receipt_cache`)
+SUF_RECEIPT_CACHE = {
+    'ENABLED': os.getenv('SUF_RECEIPT_CACHE_ENABLED', 'True') == 'True',
+    'MAX_ENTRIES': int(os.getenv('SUF_RECEIPT_CACHE_MAX_ENTRIES', 50000)),
+    'MAX_BYTES': int(os.getenv('SUF_RECEIPT_CACHE_MAX_BYTES', 500 * 1024 * 1024)),
+    'EVICT_BATCH': 500,
+    'EVICT_EVERY': int(os.getenv('SUF_RECEIPT_CACHE_EVICT_EVERY', 100)),
+}
+
+# Receipt line -> product matching engine (products/matching.py)
+# BACKEND 'python' matches in memory; 'postgres_trgm' pushes the similarity
+# search into PostgreSQL (pg_trgm) and falls back to 'python' on other databases.
+# MODE 'indexed' uses a trigram candidate index; 'compat' keeps the original
+# first-match substring / 80% similarity scan semantics
+PRODUCT_MATCHER = {
+    'BACKEND': os.getenv('PRODUCT_MATCHER_BACKEND', 'python'),
+    'MODE': os.getenv('PRODUCT_MATCHER_MODE', 'indexed'),
+    'CANDIDATES': int(os.getenv('PRODUCT_MATCHER_CANDIDATES', 50)),
+    'SIMILARITY_THRESHOLD': float(os.getenv('PRODUCT_MATCHER_THRESHOLD', 0.8)),
+    'TRIGRAM_THRESHOLD': float(os.getenv('PRODUCT_MATCHER_TRIGRAM_THRESHOLD', 0.5)),
+    # LRU memo of line name -> match (incl. no match), invalidated on any catalog
+    # version bump; 0 disables. Stats: GET /api/products/matcher-stats/ (admin)
+    'MEMO_SIZE': int(os.getenv('PRODUCT_MATCHER_MEMO_SIZE', 20000)),
+}
+
+# Store resolution for scanned receipts (products/stores.py)
+# Stores are looked up by TIN (PIB) + shop code and cached per process;
+# cached entries are re-read after CACHE_TTL seconds
+STORE_RESOLVER = {
+    'CACHE_SIZE': int(os.getenv('STORE_RESOLVER_CACHE_SIZE', 2048)),
+    'CACHE_TTL': int(os.getenv('STORE_RESOLVER_CACHE_TTL', 300)),
+}
+
+# Per-stage timing of the receipt scan pipeline (transactions/metrics.py),
+# exported in the Prometheus text format at GET /api/receipts/metrics/ (admin)
+RECEIPT_PIPELINE_METRICS = {
+    'ENABLED': os.getenv('RECEIPT_PIPELINE_METRICS_ENABLED', 'True') == 'True',
+}
+
+# Logging: the receipt pipeline logs through the 'transactions' and 'products'
+# loggers; set RECEIPT_LOG_LEVEL=DEBUG for per-stage timings and parsed items
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {
+            'format': '{asctime} {levelname} {name}: {message}',
+            'style': '{',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'simple',
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': 'WARNING',
+    },
+    'loggers': {
+        'transactions': {
+            'level': os.getenv('RECEIPT_LOG_LEVEL', 'INFO'),
+        },
+        'products': {
+            'level': os.getenv('RECEIPT_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
+
+# Incremental analytics (analytics/events.py): scans and review approvals log
+# events that `update_analytics --type incremental` applies in batches
+ANALYTICS_EVENTS = {
+    'ENABLED': os.getenv('ANALYTICS_EVENTS_ENABLED', 'True') == 'True',
+    'BATCH_SIZE': int(os.getenv('ANALYTICS_EVENTS_BATCH_SIZE', 500)),
+    'RETENTION_DAYS': int(os.getenv('ANALYTICS_EVENTS_RETENTION_DAYS', 7)),
+}
+
+# Watermarked analytics refreshes (analytics/services.py): store-product rankings
+# rebuild only stores that changed since their last run, user-store activities
+# merge only transactions scanned since their last run, the daily activity
+# rollup (UserActivityLog) recomputes only its latest days
+ANALYTICS_REFRESH = {
+    'WATERMARK_OVERLAP_SECONDS': int(os.getenv('ANALYTICS_WATERMARK_OVERLAP_SECONDS', 300)),
+    'ACTIVITY_LAG_SECONDS': int(os.getenv('ANALYTICS_ACTIVITY_LAG_SECONDS', 300)),
+    'ACTIVITY_BATCH_SIZE': int(os.getenv('ANALYTICS_ACTIVITY_BATCH_SIZE', 5000)),
+    'ROLLUP_RECOMPUTE_DAYS': int(os.getenv('ANALYTICS_ROLLUP_RECOMPUTE_DAYS', 2)),
+}
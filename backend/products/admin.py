@@ -1,5 +1,13 @@
 from django.contrib import admin
-from .models import Product, Store, UserFavoriteStore, ApiKey
+from .models import Product, ProductAlias, ProductBarcode, Store, UserFavoriteStore, ApiKey
+
+
+class ProductBarcodeInline(admin.TabularInline):
+    """Inline admin for product GTIN barcodes."""
+    model = ProductBarcode
+    extra = 1
+    fields = ['gtin', 'created_at']
+    readonly_fields = ['created_at']
 
 
 @admin.register(Product)
@@ -8,9 +16,10 @@ class ProductAdmin(admin.ModelAdmin):
 
     list_display = ['name', 'points', 'status', 'created_at']
     list_filter = ['status', 'created_at']
-    search_fields = ['name', 'id']
+    search_fields = ['name', 'id', 'barcodes__gtin']
     ordering = ['name']
     readonly_fields = ['id', 'created_at', 'updated_at']
+    inlines = [ProductBarcodeInline]
 
     fieldsets = (
         (None, {'fields': ('id', 'name', 'points', 'status')}),
@@ -18,17 +27,35 @@ class ProductAdmin(admin.ModelAdmin):
     )
 
 
+@admin.register(ProductAlias)
+class ProductAliasAdmin(admin.ModelAdmin):
+    """Admin interface for learned receipt-name aliases."""
+
+    list_display = ['alias', 'product', 'store', 'created_at']
+    list_filter = ['created_at']
+    search_fields = ['alias', 'product__name', 'store__name']
+    ordering = ['alias']
+    readonly_fields = ['id', 'created_at', 'updated_at']
+    autocomplete_fields = ['product', 'store']
+
+    fieldsets = (
+        (None, {'fields': ('id', 'alias', 'product', 'store')}),
+        ('Timestamps', {'fields': ('created_at', 'updated_at')}),
+    )
+
+
 @admin.register(Store)
 class StoreAdmin(admin.ModelAdmin):
     """Admin interface for Store model."""
 
-    list_display = ['name', 'location', 'created_at']
-    search_fields = ['name', 'location', 'id']
+    list_display = ['name', 'location', 'tin', 'shop_code', 'created_at']
+    search_fields = ['name', 'location', 'id', 'tin']
     ordering = ['name']
     readonly_fields = ['id', 'created_at', 'updated_at']
 
     fieldsets = (
         (None, {'fields': ('id', 'name', 'location')}),
+        ('Fiscal Identity', {'fields': ('tin', 'shop_code')}),
         ('Timestamps', {'fields': ('created_at', 'updated_at')}),
     )
 
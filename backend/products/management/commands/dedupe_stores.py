@@ -0,0 +1,158 @@
+"""
+Django management command that merges duplicate stores (one-off).
+
+Before stores were identified by TIN (PIB) + shop code, every spelling of a
+shop name SUF produced became its own store. This command:
+
+1. backfills TIN and shop code of legacy stores from the SUF receipt cache
+2. groups stores by (TIN, shop code), or by normalized name when no TIN is known
+3. keeps one store per group (the one already holding the TIN, else the oldest),
+   re-points transactions, favorites and product aliases to it and deletes the rest
+
+Per-store analytics of merged stores are dropped; rebuild them afterwards with
+`python manage.py update_analytics`.
+
+Usage:
+    python manage.py dedupe_stores --dry-run
+    python manage.py dedupe_stores
+"""
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+
+from analytics.models import StoreAnalytics, StoreProductRanking, UserStoreActivity
+from products.models import ProductAlias, Store, UserFavoriteStore
+from products.stores import normalize_tin, split_shop_code
+from transactions.models import SUFReceiptCache, Transaction
+
+# Derived per-store rows: deleted with the merged store, rebuilt by update_analytics
+DERIVED_MODELS = (StoreAnalytics, StoreProductRanking, UserStoreActivity)
+
+
+def normalize_store_name(name: str) -> str:
+    return ' '.join((name or '').lower().split())
+
+
+class Command(BaseCommand):
+    help = 'Merge duplicate stores by TIN + shop code and re-point their transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would be merged without changing anything'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        stores = list(Store.objects.order_by('created_at', 'id'))
+        known_tins = self.tins_from_receipt_cache()
+
+        # Fiscal identity of every store: its own TIN, or one recorded for its name by SUF
+        identities = {}
+        for store in stores:
+            if store.tin:
+                identities[store.id] = (store.tin, store.shop_code)
+            elif store.name in known_tins:
+                identities[store.id] = known_tins[store.name]
+
+        # Stores without a known TIN join a TIN group with the same name, else group by name
+        tin_by_name = defaultdict(set)
+        for store in stores:
+            if store.id in identities:
+                tin_by_name[normalize_store_name(store.name)].add(identities[store.id])
+
+        groups = defaultdict(list)
+        for store in stores:
+            identity = identities.get(store.id)
+            if identity is None:
+                candidates = tin_by_name.get(normalize_store_name(store.name), set())
+                identity = next(iter(candidates)) if len(candidates) == 1 else ('name', normalize_store_name(store.name))
+            groups[identity].append(store)
+
+        merged = backfilled = repointed = 0
+        for identity, members in groups.items():
+            # The store already holding the TIN keeps it (unique), otherwise the oldest survives
+            members.sort(key=lambda store: (store.tin is None, store.created_at))
+            survivor, duplicates = members[0], members[1:]
+            tin, shop_code = (None, '') if identity[0] == 'name' else identity
+            needs_tin = tin is not None and survivor.tin is None
+
+            if not duplicates and not needs_tin:
+                continue
+
+            label = f'TIN {tin}/{shop_code or "-"}' if tin else f'name "{survivor.name}"'
+            if duplicates:
+                self.stdout.write(
+                    f'{label}: keep "{survivor.name}" ({survivor.id}), merge '
+                    + ', '.join(f'"{store.name}" ({store.id})' for store in duplicates)
+                )
+            else:
+                self.stdout.write(f'{label}: backfill "{survivor.name}" ({survivor.id})')
+
+            if dry_run:
+                merged += len(duplicates)
+                backfilled += needs_tin
+                continue
+
+            with db_transaction.atomic():
+                repointed += self.merge(survivor, duplicates)
+                if needs_tin:
+                    survivor.tin = tin
+                    survivor.shop_code = shop_code
+                    survivor.save(update_fields=['tin', 'shop_code', 'updated_at'])
+            merged += len(duplicates)
+            backfilled += needs_tin
+
+        prefix = '[dry run] ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'\n{prefix}{merged} duplicate store(s) merged, {repointed} transaction(s) re-pointed, '
+            f'{backfilled} store(s) given a TIN'
+        ))
+        if merged and not dry_run:
+            self.stdout.write('Run `python manage.py update_analytics` to rebuild per-store analytics.')
+
+    @staticmethod
+    def tins_from_receipt_cache():
+        """Shop name -> (TIN, shop code) as recorded in cached SUF receipts."""
+        known = {}
+        for store_info in SUFReceiptCache.objects.values_list('store_info', flat=True).iterator():
+            tin = normalize_tin((store_info or {}).get('tin'))
+            name = (store_info or {}).get('name')
+            if tin and name:
+                known[name] = (tin, store_info.get('shop_code') or split_shop_code(name)[0])
+        return known
+
+    @staticmethod
+    def merge(survivor: Store, duplicates) -> int:
+        """Move everything that belongs to `duplicates` onto `survivor`, then delete them."""
+        duplicate_ids = [store.id for store in duplicates]
+        if not duplicate_ids:
+            return 0
+
+        repointed = Transaction.objects.filter(store_id__in=duplicate_ids).update(store=survivor)
+
+        # Favorites and aliases are unique per store: drop the ones the survivor already has
+        favorited_by = set(UserFavoriteStore.objects.filter(store=survivor).values_list('user_id', flat=True))
+        for favorite in UserFavoriteStore.objects.filter(store_id__in=duplicate_ids).order_by('created_at'):
+            if favorite.user_id in favorited_by:
+                favorite.delete()
+            else:
+                favorited_by.add(favorite.user_id)
+                UserFavoriteStore.objects.filter(pk=favorite.pk).update(store=survivor)
+
+        aliases = set(ProductAlias.objects.filter(store=survivor).values_list('alias', flat=True))
+        for alias in ProductAlias.objects.filter(store_id__in=duplicate_ids).order_by('-updated_at'):
+            if alias.alias in aliases:
+                alias.delete()
+            else:
+                aliases.add(alias.alias)
+                ProductAlias.objects.filter(pk=alias.pk).update(store=survivor)
+
+        for model in DERIVED_MODELS:
+            model.objects.filter(store_id__in=duplicate_ids).delete()
+
+        Store.objects.filter(id__in=duplicate_ids).delete()
+        return repointed
@@ -0,0 +1,534 @@
+"""
+Product matching engine for receipt line names.
+
+Instead of scanning the whole catalog with difflib for every receipt line, the
+matcher keeps an in-memory character-trigram inverted index of ACTIVE products
+and only scores the few candidates that share trigrams with the line name.
+The index is kept current through the CatalogVersion counter: local product
+changes are applied incrementally, changes made by other processes trigger a
+rebuild on the next receipt. The counter is bumped by the Product save/delete
+signals (products/signals.py) only: queryset .update(), bulk_create() and
+bulk_update() on products send no signals and must call CatalogVersion.bump()
+themselves (as generate_workload does), or matchers keep serving the old catalog.
+
+On PostgreSQL the search can instead be pushed into the database with the
+pg_trgm backend (PRODUCT_MATCHER['BACKEND'] = 'postgres_trgm').
+
+Both backends share a MatchMemo: results (including "no match") are memoized
+per normalized line name under the catalog version they were computed for, so
+the same line strings seen on thousands of receipts are matched only once per
+catalog version.
+"""
+import threading
+from collections import Counter, OrderedDict
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import CatalogVersion, Product
+
+
+DEFAULT_PRODUCT_MATCHER_SETTINGS = {
+    # 'python': in-memory ProductMatcher (works on any database)
+    # 'postgres_trgm': pg_trgm similarity search in the database (PostgreSQL only)
+    'BACKEND': 'python',
+    # 'indexed': trigram candidate index, substring hits first, then best fuzzy score
+    # 'compat': original first-match linear scan (in memory, no per-line queries)
+    'MODE': 'indexed',
+    'CANDIDATES': 50,
+    'SIMILARITY_THRESHOLD': 0.8,
+    # Minimum pg_trgm (word_)similarity for the postgres_trgm backend
+    'TRIGRAM_THRESHOLD': 0.5,
+    # Memoized line name -> match results (0 disables the memo)
+    'MEMO_SIZE': 20000,
+}
+
+
+def matcher_settings() -> Dict:
+    config = dict(DEFAULT_PRODUCT_MATCHER_SETTINGS)
+    config.update(getattr(settings, 'PRODUCT_MATCHER', {}))
+    return config
+
+
+def normalize_product_name(name: str) -> str:
+    """Normalize a product/receipt line name for matching."""
+    return (name or '').lower().strip()
+
+
+def normalize_gtin(gtin) -> Optional[str]:
+    """Digits-only GTIN/EAN string, or None for empty/invalid barcodes."""
+    gtin = str(gtin or '').strip()
+    return gtin if gtin.isdigit() and len(gtin) <= 14 else None
+
+
+def trigrams(text: str) -> Set[str]:
+    """Character trigrams of `text` (the whole string if shorter than 3 characters)."""
+    if len(text) < 3:
+        return {text} if text else set()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class MatchMemo:
+    """
+    Bounded LRU memo of normalized line name -> (product, points), including
+    negative (None, 0) results.
+
+    Entries belong to one catalog version: the first lookup under a newer
+    version drops everything, so a result is never served after any Product
+    change. Hit/miss counters are process-wide.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.version: Optional[int] = None
+        self._entries: 'OrderedDict[str, Tuple[Optional[Product], int]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def _use_version(self, version: int):
+        if version != self.version:
+            if self._entries:
+                self.counters['invalidations'] += 1
+            self._entries.clear()
+            self.version = version
+
+    def get(self, version: int, name: str):
+        """Memoized result for `name`, or MatchMemo.MISSING."""
+        with self._lock:
+            self._use_version(version)
+            result = self._entries.get(name, self.MISSING)
+            if result is self.MISSING:
+                self.counters['misses'] += 1
+            else:
+                self._entries.move_to_end(name)
+                self.counters['hits'] += 1
+            return result
+
+    def put(self, version: int, name: str, result: Tuple[Optional[Product], int]):
+        with self._lock:
+            if version != self.version:
+                # Computed against an older catalog; don't keep it
+                return
+            self._entries[name] = result
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                **self.counters,
+                'hit_ratio': round(self.counters['hits'] / lookups, 4) if lookups else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'catalog_version': self.version,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.version = None
+            for key in self.counters:
+                self.counters[key] = 0
+
+
+def memoized_match_names(version: Optional[int], product_names: Iterable[str],
+                         compute) -> List[Tuple[Optional[Product], int]]:
+    """
+    Match names through the memo. `compute` is called once with the distinct
+    normalized names that are not memoized for `version` yet. Without a known
+    catalog version (or with the memo disabled) everything is computed.
+    """
+    names = [normalize_product_name(name) for name in product_names]
+    memo = get_match_memo()
+    if memo is None or version is None:
+        return compute(names)
+
+    results = [memo.get(version, name) for name in names]
+    missing = list(dict.fromkeys(name for name, result in zip(names, results) if result is MatchMemo.MISSING))
+    if missing:
+        computed = dict(zip(missing, compute(missing)))
+        for name, result in computed.items():
+            memo.put(version, name, result)
+        results = [computed[name] if result is MatchMemo.MISSING else result for name, result in zip(names, results)]
+    return results
+
+
+class ProductIndex:
+    """Trigram inverted index over ACTIVE products."""
+
+    def __init__(self, products: Iterable[Product] = ()):
+        self.products: Dict[str, Product] = {}
+        self.names: Dict[str, str] = {}
+        self.grams: Dict[str, Set[str]] = {}
+        self.postings: Dict[str, Set[str]] = {}
+        self.exact: Dict[str, Set[str]] = {}
+        self.short_ids: Set[str] = set()
+        self._ordered: Optional[List[str]] = None
+
+        for product in products:
+            self.add(product)
+
+    def __len__(self):
+        return len(self.products)
+
+    def _sort_key(self, product_id: str):
+        return (self.names[product_id], product_id)
+
+    def ordered_ids(self) -> List[str]:
+        """Product ids in catalog order (by name), as the original DB scan returned them."""
+        if self._ordered is None:
+            self._ordered = sorted(self.products, key=self._sort_key)
+        return self._ordered
+
+    def add(self, product: Product):
+        self.remove(product.id)
+        if product.status != 'ACTIVE':
+            return
+
+        name = normalize_product_name(product.name)
+        grams = trigrams(name)
+        self.products[product.id] = product
+        self.names[product.id] = name
+        self.grams[product.id] = grams
+        self.exact.setdefault(name, set()).add(product.id)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(product.id)
+        if len(name) < 3:
+            self.short_ids.add(product.id)
+        self._ordered = None
+
+    def remove(self, product_id: str):
+        if product_id not in self.products:
+            return
+
+        name = self.names.pop(product_id)
+        for gram in self.grams.pop(product_id):
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del self.postings[gram]
+        exact_ids = self.exact.get(name)
+        if exact_ids is not None:
+            exact_ids.discard(product_id)
+            if not exact_ids:
+                del self.exact[name]
+        self.short_ids.discard(product_id)
+        del self.products[product_id]
+        self._ordered = None
+
+    def first(self, product_ids: Iterable[str]) -> Optional[str]:
+        """The id that comes first in catalog order."""
+        return min(product_ids, key=self._sort_key, default=None)
+
+    def copy(self) -> 'ProductIndex':
+        """An independent copy: changes to either do not affect the other."""
+        index = ProductIndex()
+        index.products = dict(self.products)
+        index.names = dict(self.names)
+        index.grams = dict(self.grams)  # Never mutated in place
+        index.postings = {gram: set(ids) for gram, ids in self.postings.items()}
+        index.exact = {name: set(ids) for name, ids in self.exact.items()}
+        index.short_ids = set(self.short_ids)
+        index._ordered = self._ordered
+        return index
+
+
+class ProductMatcher:
+    """
+    Matches receipt line names to products using a ProductIndex.
+
+    Matching order (both modes):
+    1. exact (case-insensitive) name match
+    2. substring match in either direction
+    3. difflib similarity above SIMILARITY_THRESHOLD
+
+    In 'indexed' mode only products sharing trigrams with the line are
+    considered; substring hits win over fuzzy hits and the fuzzy hit with the
+    best score among the top CANDIDATES is returned. 'compat' mode keeps the
+    original semantics exactly: the first product in name order that is a
+    substring match or more than 80% similar.
+    """
+
+    def __init__(self, mode: str = None, candidates: int = None, threshold: float = None):
+        config = matcher_settings()
+        self.mode = mode or config['MODE']
+        self.candidates = candidates or config['CANDIDATES']
+        self.threshold = threshold if threshold is not None else config['SIMILARITY_THRESHOLD']
+
+        self._lock = threading.RLock()
+        self.index: Optional[ProductIndex] = None
+        self.version: Optional[int] = None
+
+    # ---------------------------------------------------------------- freshness
+
+    def rebuild(self, version: Optional[int] = None):
+        """Load every ACTIVE product into a fresh index."""
+        with self._lock:
+            if version is None:
+                version = CatalogVersion.current()
+            self.index = ProductIndex(Product.objects.filter(status='ACTIVE'))
+            self.version = version
+
+    def ensure_fresh(self):
+        """Rebuild the index if the catalog changed since it was built (one small query)."""
+        version = CatalogVersion.current()
+        if self.index is None or version != self.version:
+            self.rebuild(version)
+
+    def apply_change(self, product: Product, new_version: int, deleted: bool = False):
+        """
+        Apply a committed Product change made by this process.
+        If any other change happened in between, fall back to a full rebuild.
+
+        The change is made to a copy that then replaces the index, so matches
+        still scoring the previous index (outside the lock) never see it change.
+        """
+        with self._lock:
+            if self.index is None:
+                return
+            if self.version is None or new_version != self.version + 1:
+                self.index = None
+                self.version = None
+                return
+
+            index = self.index.copy()
+            if deleted:
+                index.remove(product.id)
+            else:
+                index.add(product)
+            self.index, self.version = index, new_version
+
+    # ----------------------------------------------------------------- matching
+
+    def match(self, product_name: str) -> Tuple[Optional[Product], int]:
+        """Return (matched_product, points) or (None, 0)."""
+        return self.match_names([product_name])[0]
+
+    def match_names(self, product_names: Iterable[str]) -> List[Tuple[Optional[Product], int]]:
+        """Match several receipt lines; returns (matched_product, points) per name."""
+        # The version and the index are read together under the lock that guards their
+        # updates, so results are computed from, and memoized under, the same catalog
+        # version. Updates replace the index rather than change it, so the snapshot is
+        # scored without holding the lock and concurrent matches run in parallel.
+        with self._lock:
+            if self.index is None:
+                self.rebuild()
+            index, version = self.index, self.version
+        return memoized_match_names(version, product_names, lambda names: [self._match(index, name) for name in names])
+
+    def _match(self, index: ProductIndex, normalized_name: str) -> Tuple[Optional[Product], int]:
+        exact_ids = index.exact.get(normalized_name)
+        if exact_ids:
+            product = index.products[index.first(exact_ids)]
+            return product, product.points
+
+        if self.mode == 'compat' or len(normalized_name) < 3:
+            product_id = self._scan(index, normalized_name, index.ordered_ids())
+        else:
+            product_id = self._indexed(index, normalized_name)
+
+        if product_id is None:
+            return None, 0
+        product = index.products[product_id]
+        return product, product.points
+
+    def _is_similar(self, a: str, b: str) -> bool:
+        return SequenceMatcher(None, a, b).ratio() > self.threshold
+
+    def _scan(self, index: ProductIndex, normalized_name: str, product_ids: Iterable[str]) -> Optional[str]:
+        """Original linear first-match semantics over the given ids."""
+        for product_id in product_ids:
+            product_name_lower = index.names[product_id]
+
+            # Check if either name contains the other
+            if normalized_name in product_name_lower or product_name_lower in normalized_name:
+                return product_id
+
+            # Use fuzzy matching
+            if self._is_similar(normalized_name, product_name_lower):
+                return product_id
+
+        return None
+
+    def _indexed(self, index: ProductIndex, normalized_name: str) -> Optional[str]:
+        query_grams = trigrams(normalized_name)
+        shared = Counter()
+        for gram in query_grams:
+            for product_id in index.postings.get(gram, ()):
+                shared[product_id] += 1
+
+        # Substring hits: every trigram of the shorter name occurs in the longer one
+        substring_ids = [
+            product_id for product_id, count in shared.items()
+            if (count == len(query_grams) and normalized_name in index.names[product_id])
+            or (count == len(index.grams[product_id]) and index.names[product_id] in normalized_name)
+        ]
+        # Products shorter than a trigram can still be contained in the line name
+        substring_ids += [
+            product_id for product_id in index.short_ids
+            if index.names[product_id] in normalized_name
+        ]
+        if substring_ids:
+            return index.first(substring_ids)
+
+        # Fuzzy: score only the top candidates by trigram Dice coefficient
+        ranked = sorted(
+            shared.items(),
+            key=lambda item: (
+                -2.0 * item[1] / (len(query_grams) + len(index.grams[item[0]])),
+                index._sort_key(item[0])
+            )
+        )[:self.candidates]
+
+        best_id, best_ratio = None, self.threshold
+        for product_id, _ in ranked:
+            ratio = SequenceMatcher(None, normalized_name, index.names[product_id]).ratio()
+            if ratio > best_ratio:
+                best_id, best_ratio = product_id, ratio
+        return best_id
+
+
+class PostgresTrigramMatcher:
+    """
+    Database-side matcher using pg_trgm on PostgreSQL.
+
+    All lines of a receipt are resolved in one query: the line names are sent
+    as a VALUES list and a LATERAL subquery picks the best ACTIVE product for
+    each, using the trigram GIN index on lower(products.name) (migration
+    products.0005). Ranking: exact name, then containment in either direction,
+    then the highest trigram / word similarity.
+    """
+
+    SQL = """
+        SELECT p.*, q.idx AS match_idx
+        FROM (VALUES {values}) AS q(idx, name)
+        CROSS JOIN LATERAL (
+            SELECT c.*
+            FROM products c
+            WHERE c.status = 'ACTIVE'
+              AND (lower(c.name) = q.name
+                   OR lower(c.name) %% q.name
+                   OR lower(c.name) <%% q.name
+                   OR lower(c.name) %%> q.name)
+            ORDER BY (lower(c.name) = q.name) DESC,
+                     (strpos(lower(c.name), q.name) > 0 OR strpos(q.name, lower(c.name)) > 0) DESC,
+                     GREATEST(similarity(lower(c.name), q.name),
+                              word_similarity(lower(c.name), q.name),
+                              word_similarity(q.name, lower(c.name))) DESC,
+                     c.name, c.id
+            LIMIT 1
+        ) p
+    """
+
+    def __init__(self, threshold: float = None):
+        config = matcher_settings()
+        self.threshold = threshold if threshold is not None else config['TRIGRAM_THRESHOLD']
+        self.version: Optional[int] = None
+
+    def ensure_fresh(self):
+        """The database is always current; only the catalog version (memo key) is read."""
+        self.version = CatalogVersion.current()
+
+    def match(self, product_name: str) -> Tuple[Optional[Product], int]:
+        return self.match_names([product_name])[0]
+
+    def match_names(self, product_names: Iterable[str]) -> List[Tuple[Optional[Product], int]]:
+        return memoized_match_names(self.version, product_names, self._query)
+
+    def _query(self, names: List[str]) -> List[Tuple[Optional[Product], int]]:
+        results: List[Tuple[Optional[Product], int]] = [(None, 0)] * len(names)
+        if not names:
+            return results
+
+        values = ', '.join(['(%s::integer, %s::text)'] * len(names))
+        params = [value for idx, name in enumerate(names) for value in (idx, name)]
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            # SET LOCAL scopes the thresholds to this transaction only
+            cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", [str(self.threshold)])
+            cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)", [str(self.threshold)])
+            for product in Product.objects.raw(self.SQL.format(values=values), params):
+                results[product.match_idx] = (product, product.points)
+
+        return results
+
+
+_matcher: Optional[ProductMatcher] = None
+_matcher_lock = threading.Lock()
+_memo: Optional[MatchMemo] = None
+
+
+def trigram_backend_available() -> bool:
+    return connection.vendor == 'postgresql'
+
+
+def get_product_matcher(refresh: bool = True):
+    """
+    Return the process-wide matcher for the configured backend.
+
+    PRODUCT_MATCHER['BACKEND'] = 'postgres_trgm' selects PostgresTrigramMatcher;
+    on other databases (e.g. SQLite test runs) the in-memory ProductMatcher is
+    used instead. With refresh=True (once per receipt) the in-memory index is
+    checked against the catalog version first.
+    """
+    global _matcher
+
+    if matcher_settings()['BACKEND'] == 'postgres_trgm' and trigram_backend_available():
+        matcher = PostgresTrigramMatcher()
+        if refresh:
+            matcher.ensure_fresh()
+        return matcher
+
+    if _matcher is None:
+        with _matcher_lock:
+            if _matcher is None:
+                _matcher = ProductMatcher()
+    if refresh:
+        _matcher.ensure_fresh()
+    return _matcher
+
+
+def reset_product_matcher():
+    """Drop the process-wide matcher and memo (e.g. after changing PRODUCT_MATCHER settings)."""
+    global _matcher, _memo
+
+    with _matcher_lock:
+        _matcher = None
+        _memo = None
+
+
+def get_match_memo() -> Optional[MatchMemo]:
+    """The process-wide match memo, or None if PRODUCT_MATCHER['MEMO_SIZE'] is 0."""
+    global _memo
+
+    if _memo is None:
+        max_entries = matcher_settings()['MEMO_SIZE']
+        if not max_entries:
+            return None
+        with _matcher_lock:
+            if _memo is None:
+                _memo = MatchMemo(max_entries)
+    return _memo
+
+
+def matcher_stats() -> Dict:
+    """Match memo hit/miss statistics for this process."""
+    memo = get_match_memo()
+    return {
+        'backend': matcher_settings()['BACKEND'],
+        'memo': memo.stats() if memo is not None else None,
+    }
+
+
+def product_changed(product: Product, new_version: int, deleted: bool = False):
+    """Propagate a committed product change to the matcher (if it exists in this process)."""
+    if _matcher is not None:
+        _matcher.apply_change(product, new_version, deleted=deleted)
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:08
+
+import django.db.models.deletion
+import products.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_catalogversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductBarcode',
+            fields=[
+                ('id', models.CharField(default=products.models.generate_cuid, editable=False, max_length=30, primary_key=True, serialize=False)),
+                ('gtin', models.CharField(max_length=14, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='barcodes', to='products.product')),
+            ],
+            options={
+                'db_table': 'product_barcodes',
+                'ordering': ['gtin'],
+            },
+        ),
+    ]
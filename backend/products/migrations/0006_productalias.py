@@ -0,0 +1,39 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:10
+
+import django.db.models.deletion
+import products.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_product_name_trigram_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductAlias',
+            fields=[
+                ('id', models.CharField(default=products.models.generate_cuid, editable=False, max_length=30, primary_key=True, serialize=False)),
+                ('alias', models.CharField(help_text='Normalized receipt line name', max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='products.product')),
+                ('store', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='product_aliases', to='products.store')),
+            ],
+            options={
+                'db_table': 'product_aliases',
+                'ordering': ['alias'],
+                'indexes': [models.Index(fields=['alias'], name='product_ali_alias_70f29e_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productalias',
+            constraint=models.UniqueConstraint(condition=models.Q(('store__isnull', False)), fields=('alias', 'store'), name='unique_store_product_alias'),
+        ),
+        migrations.AddConstraint(
+            model_name='productalias',
+            constraint=models.UniqueConstraint(condition=models.Q(('store__isnull', True)), fields=('alias',), name='unique_global_product_alias'),
+        ),
+    ]
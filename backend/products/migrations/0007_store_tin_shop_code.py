@@ -0,0 +1,31 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_productalias'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='store',
+            name='shop_code',
+            field=models.CharField(blank=True, default='', help_text='SUF shop code (prefix of the shop name)', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='tin',
+            field=models.CharField(blank=True, help_text='Seller tax ID (PIB)', max_length=20, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='store',
+            index=models.Index(fields=['name'], name='stores_name_b54c6a_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='store',
+            constraint=models.UniqueConstraint(condition=models.Q(('tin__isnull', False)), fields=('tin', 'shop_code'), name='unique_store_tin_shop_code'),
+        ),
+    ]
@@ -12,17 +12,35 @@ def generate_cuid():
 
 
 class Store(models.Model):
-    """Store model matching Prisma schema."""
+    """
+    Store model matching Prisma schema.
+
+    A store scanned from a fiscal receipt is identified by the seller's TIN (PIB)
+    plus the shop code that prefixes the SUF shop name ("1228831-Maxi 123");
+    stores without a TIN (e.g. test receipts) fall back to their name.
+    """
 
     id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
     name = models.CharField(max_length=255)
     location = models.CharField(max_length=255, null=True, blank=True)
+    tin = models.CharField(max_length=20, null=True, blank=True, help_text="Seller tax ID (PIB)")
+    shop_code = models.CharField(max_length=32, blank=True, default='', help_text="SUF shop code (prefix of the shop name)")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         db_table = 'stores'
         ordering = ['name']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['tin', 'shop_code'],
+                condition=models.Q(tin__isnull=False),
+                name='unique_store_tin_shop_code'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['name']),
+        ]
 
     def __str__(self):
         return self.name
@@ -54,6 +72,148 @@ class Product(models.Model):
         return f"{self.name} ({self.points} points)"
 
 
+class ProductBarcode(models.Model):
+    """GTIN/EAN barcode of a product; a product can carry several."""
+
+    id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='barcodes'
+    )
+    gtin = models.CharField(max_length=14, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'product_barcodes'
+        ordering = ['gtin']
+
+    def __str__(self):
+        return f"{self.gtin} -> {self.product.name}"
+
+
+class ProductAlias(models.Model):
+    """
+    Learned mapping from a normalized receipt line name to a product.
+
+    Written automatically when an admin approves an unmatched receipt item, so
+    the same receipt string resolves with a single indexed lookup next time.
+    Aliases can be store-specific (store set) or global (store empty); the
+    store-specific alias wins when both exist.
+    """
+
+    id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
+    alias = models.CharField(max_length=255, help_text="Normalized receipt line name")
+    store = models.ForeignKey(
+        Store,
+        on_delete=models.CASCADE,
+        related_name='product_aliases',
+        null=True,
+        blank=True
+    )
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='aliases'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'product_aliases'
+        ordering = ['alias']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['alias', 'store'],
+                condition=models.Q(store__isnull=False),
+                name='unique_store_product_alias'
+            ),
+            models.UniqueConstraint(
+                fields=['alias'],
+                condition=models.Q(store__isnull=True),
+                name='unique_global_product_alias'
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['alias']),
+        ]
+
+    def __str__(self):
+        scope = self.store.name if self.store_id else 'all stores'
+        return f"{self.alias} -> {self.product.name} ({scope})"
+
+    @classmethod
+    def learn(cls, product_name, product_id, store_id=None, relink=False):
+        """
+        Remember that `product_name` is `product_id`.
+        Writes the store-specific alias, and a global alias if none exists yet;
+        `relink=True` (an admin explicitly picked the product) overwrites the
+        global alias too, so a wrong earlier link is corrected everywhere.
+        Call inside the transaction that saves the approval.
+        """
+        from .matching import normalize_product_name
+
+        alias = normalize_product_name(product_name)
+        if not alias or not product_id:
+            return
+
+        if store_id:
+            cls.objects.update_or_create(
+                alias=alias,
+                store_id=store_id,
+                defaults={'product_id': product_id}
+            )
+        write_global = cls.objects.update_or_create if relink else cls.objects.get_or_create
+        write_global(
+            alias=alias,
+            store__isnull=True,
+            defaults={'product_id': product_id}
+        )
+
+
+class CatalogVersion(models.Model):
+    """
+    Monotonic version counter for the product catalog.
+
+    Bumped in the same database transaction as every Product save/delete
+    (see products/signals.py), so in-process indexes and caches built from the
+    catalog can tell exactly when they are stale, across all worker processes.
+
+    Queryset .update(), bulk_create() and bulk_update() send no signals: code
+    changing products that way must call bump() in the same transaction. The
+    row is a hot spot (every product write locks it until commit), so bulk
+    catalog changes should bump once at the end rather than per product.
+    """
+
+    PRODUCTS = 'products'
+
+    key = models.CharField(max_length=50, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'catalog_versions'
+
+    def __str__(self):
+        return f"{self.key} v{self.version}"
+
+    @classmethod
+    def current(cls, key=PRODUCTS) -> int:
+        """Current version (0 if the catalog has never been modified)."""
+        version = cls.objects.filter(key=key).values_list('version', flat=True).first()
+        return version or 0
+
+    @classmethod
+    def bump(cls, key=PRODUCTS) -> int:
+        """Increment the version and return the new value."""
+        updated = cls.objects.filter(key=key).update(version=models.F('version') + 1)
+        if not updated:
+            obj, created = cls.objects.get_or_create(key=key, defaults={'version': 1})
+            if not created:
+                cls.objects.filter(key=key).update(version=models.F('version') + 1)
+        return cls.current(key)
+
+
 class UserFavoriteStore(models.Model):
     """Many-to-many relationship between users and favorite stores."""
 
@@ -16,7 +16,7 @@ class StoreSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Store
-        fields = ['id', 'name', 'location', 'created_at', 'updated_at']
+        fields = ['id', 'name', 'location', 'tin', 'shop_code', 'created_at', 'updated_at']
         read_only_fields = ['id', 'created_at', 'updated_at']
 
 
@@ -0,0 +1,47 @@
+"""
+Signal handlers keeping catalog-derived state in sync with Product and Store changes.
+"""
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import CatalogVersion, Product, Store
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def bump_catalog_version(sender, instance, **kwargs):
+    """Bump the catalog version and update this process's matcher index once committed."""
+    from .matching import product_changed
+
+    new_version = CatalogVersion.bump()
+    deleted = 'created' not in kwargs
+    transaction.on_commit(lambda: product_changed(instance, new_version, deleted=deleted))
+
+
+@contextmanager
+def single_catalog_bump():
+    """
+    Bump the catalog version once for a bulk change of many products instead of
+    once per product (a queryset delete sends post_delete for every row). Use
+    inside the transaction making the change; the per-product handler is
+    disconnected for the whole process meanwhile, so keep it to commands.
+    """
+    post_save.disconnect(bump_catalog_version, sender=Product)
+    post_delete.disconnect(bump_catalog_version, sender=Product)
+    try:
+        yield
+    finally:
+        post_save.connect(bump_catalog_version, sender=Product)
+        post_delete.connect(bump_catalog_version, sender=Product)
+    CatalogVersion.bump()
+
+
+@receiver(post_delete, sender=Store)
+def forget_deleted_store(sender, instance, **kwargs):
+    """Stop serving a deleted (e.g. merged) store from this process's resolver cache."""
+    from .stores import StoreResolver
+
+    StoreResolver.forget(instance.id)
@@ -0,0 +1,153 @@
+"""
+Store resolution for scanned receipts.
+
+Receipts identify their store by the seller's TIN (PIB) and the shop code in
+front of the SUF shop name ("1228831-Maxi 123" -> shop code "1228831"), which
+is stable even when SUF spells the rest of the name differently. Resolution is
+a keyed lookup on the unique (tin, shop_code) index, fronted by a bounded
+process-local cache of recently seen stores.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .models import Store
+
+
+DEFAULT_STORE_RESOLVER_SETTINGS = {
+    'CACHE_SIZE': 2048,
+    # Cached stores are re-read after this many seconds, so stores merged by
+    # `dedupe_stores` in another process stop being served
+    'CACHE_TTL': 300,
+}
+
+SHOP_CODE_PATTERN = re.compile(r'^\s*(\d+)\s*-\s*(.+)$')
+
+
+def split_shop_code(shop_name: str) -> Tuple[str, str]:
+    """'1228831-Maxi 123' -> ('1228831', 'Maxi 123'); names without a code -> ('', name)."""
+    match = SHOP_CODE_PATTERN.match(shop_name or '')
+    if match:
+        return match.group(1), match.group(2).strip()
+    return '', (shop_name or '').strip()
+
+
+def normalize_tin(tin) -> Optional[str]:
+    """Digits-only TIN, or None when missing."""
+    tin = re.sub(r'\D', '', str(tin or ''))
+    return tin or None
+
+
+class StoreResolver:
+    """Resolve receipt store info to a Store, caching TIN-identified stores per process."""
+
+    _lock = threading.Lock()
+    _cache: 'OrderedDict[Tuple[str, str], Tuple[float, Store]]' = OrderedDict()
+    _counters = {'hits': 0, 'misses': 0, 'created': 0}
+
+    @staticmethod
+    def config() -> Dict:
+        config = dict(DEFAULT_STORE_RESOLVER_SETTINGS)
+        config.update(getattr(settings, 'STORE_RESOLVER', {}))
+        return config
+
+    @classmethod
+    def _cached(cls, key: Tuple[str, str]) -> Optional[Store]:
+        with cls._lock:
+            entry = cls._cache.get(key)
+            if entry is None or time.monotonic() - entry[0] > cls.config()['CACHE_TTL']:
+                cls._counters['misses'] += 1
+                return None
+            cls._cache.move_to_end(key)
+            cls._counters['hits'] += 1
+            return entry[1]
+
+    @classmethod
+    def _remember(cls, key: Tuple[str, str], store: Store):
+        with cls._lock:
+            cls._cache[key] = (time.monotonic(), store)
+            cls._cache.move_to_end(key)
+            while len(cls._cache) > cls.config()['CACHE_SIZE']:
+                cls._cache.popitem(last=False)
+
+    @classmethod
+    def forget(cls, store_id: str):
+        """Drop a store from this process's cache (e.g. after it was deleted)."""
+        with cls._lock:
+            for key in [key for key, (_, store) in cls._cache.items() if store.id == store_id]:
+                del cls._cache[key]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._cache.clear()
+            for key in cls._counters:
+                cls._counters[key] = 0
+
+    @classmethod
+    def stats(cls) -> Dict:
+        with cls._lock:
+            return {**cls._counters, 'entries': len(cls._cache)}
+
+    @classmethod
+    def resolve(cls, store_info: Dict) -> Store:
+        """
+        Return the Store for `store_info` ({'name', 'location', 'tin', optional
+        'shop_code'}), creating it if needed.
+
+        With a TIN: cache, then the unique (tin, shop_code) index, then a legacy
+        store with the same name and no TIN (which is adopted). Without a TIN:
+        get_or_create by name, as before TINs were stored.
+        """
+        name = store_info.get('name') or 'Unknown Store'
+        location = store_info.get('location') or ''
+        tin = normalize_tin(store_info.get('tin'))
+
+        if not tin:
+            store, _ = Store.objects.get_or_create(name=name, defaults={'location': location})
+            return store
+
+        shop_code = store_info.get('shop_code')
+        if shop_code is None:
+            shop_code, _ = split_shop_code(name)
+        key = (tin, shop_code)
+
+        store = cls._cached(key)
+        if store is not None:
+            return store
+
+        store = Store.objects.filter(tin=tin, shop_code=shop_code).first()
+        if store is None:
+            store = cls._adopt_or_create(name, location, tin, shop_code)
+
+        cls._remember(key, store)
+        return store
+
+    @classmethod
+    def _adopt_or_create(cls, name: str, location: str, tin: str, shop_code: str) -> Store:
+        try:
+            with transaction.atomic():
+                legacy = (
+                    Store.objects.select_for_update()
+                    .filter(name=name, tin__isnull=True)
+                    .order_by('created_at')
+                    .first()
+                )
+                if legacy is not None:
+                    legacy.tin = tin
+                    legacy.shop_code = shop_code
+                    legacy.save(update_fields=['tin', 'shop_code', 'updated_at'])
+                    return legacy
+
+                store = Store.objects.create(name=name, location=location, tin=tin, shop_code=shop_code)
+                with cls._lock:
+                    cls._counters['created'] += 1
+                return store
+        except IntegrityError:
+            # A concurrent scan registered the same TIN + shop code first
+            return Store.objects.get(tin=tin, shop_code=shop_code)
@@ -1,3 +1,204 @@
-from django.test import TestCase
+import io
+from unittest import skipUnless
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from transactions.models import Transaction
+from users.models import User
+from .matching import (
+    MatchMemo, PostgresTrigramMatcher, ProductMatcher, get_match_memo, get_product_matcher, reset_product_matcher
+)
+from .models import CatalogVersion, Product, ProductAlias, Store
+from .stores import StoreResolver, normalize_tin, split_shop_code
+
+
+class MatchMemoTests(TestCase):
+
+    def test_a_newer_catalog_version_drops_every_entry(self):
+        memo = MatchMemo(max_entries=10)
+        memo.put(1, 'mleko', ('milk', 3))
+        memo.get(1, 'mleko')
+        memo.put(1, 'mleko', ('milk', 3))
+
+        self.assertEqual(memo.get(1, 'mleko'), ('milk', 3))
+        self.assertIs(memo.get(2, 'mleko'), MatchMemo.MISSING)
+        self.assertEqual(memo.stats()['invalidations'], 1)
+
+    def test_results_of_an_older_version_are_not_kept(self):
+        memo = MatchMemo(max_entries=10)
+        memo.get(2, 'hleb')
+        memo.put(1, 'hleb', (None, 0))
+        self.assertIs(memo.get(2, 'hleb'), MatchMemo.MISSING)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        memo = MatchMemo(max_entries=2)
+        memo.get(1, 'a')
+        for name in 'abc':
+            memo.put(1, name, (None, 0))
+        self.assertIs(memo.get(1, 'a'), MatchMemo.MISSING)
+        self.assertEqual(memo.stats()['evictions'], 1)
+
+
+class ProductMatcherTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.milk = Product.objects.create(name='Mleko 1L', points=3)
+        cls.bread = Product.objects.create(name='Hleb Sava', points=2)
+
+    def setUp(self):
+        get_match_memo().clear()
+        self.matcher = ProductMatcher()
+        self.matcher.ensure_fresh()
+
+    def test_matches_exact_substring_and_fuzzy_names(self):
+        results = self.matcher.match_names(['MLEKO 1L', 'hleb', 'Mlekko 1L', 'Jogurt'])
+        self.assertEqual(results, [(self.milk, 3), (self.bread, 2), (self.milk, 3), (None, 0)])
+
+    def test_memoized_no_match_is_dropped_when_the_catalog_changes(self):
+        self.assertEqual(self.matcher.match('Jogurt'), (None, 0))
+        self.assertEqual(self.matcher.match('Jogurt'), (None, 0))
+        self.assertEqual(get_match_memo().stats()['hits'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            yogurt = Product.objects.create(name='Jogurt', points=4)
+        self.matcher.ensure_fresh()
+        self.assertEqual(self.matcher.match('Jogurt'), (yogurt, 4))
+
+    def test_changes_from_other_processes_rebuild_the_index(self):
+        self.matcher.match('Kafa')
+        # As if another process saved a product: the version moves without this
+        # process's signal handler seeing the change
+        Product.objects.bulk_create([Product(name='Kafa', points=5)])
+        CatalogVersion.bump()
+
+        self.matcher.ensure_fresh()
+        product, points = self.matcher.match('Kafa')
+        self.assertEqual((product.name, points), ('Kafa', 5))
+        self.assertEqual(get_match_memo().stats()['catalog_version'], self.matcher.version)
+
+    def test_results_are_memoized_under_the_version_of_the_index_used(self):
+        self.matcher.match('Sir')
+        cheese = Product(id='c0cheese', name='Sir', points=6)
+        self.matcher.apply_change(cheese, self.matcher.version + 1)
+
+        self.assertEqual(self.matcher.match('Sir'), (cheese, 6))
+        self.assertEqual(get_match_memo().stats()['catalog_version'], self.matcher.version)
+
+    def test_changes_do_not_touch_an_index_being_scored(self):
+        snapshot = self.matcher.index
+        cheese = Product(id='c0cheese', name='Sir', points=6)
+        self.matcher.apply_change(cheese, self.matcher.version + 1)
+        self.matcher.apply_change(self.milk, self.matcher.version + 1, deleted=True)
+
+        self.assertIsNot(self.matcher.index, snapshot)
+        self.assertEqual(set(snapshot.products), {self.milk.id, self.bread.id})
+        self.assertNotIn('sir', snapshot.exact)
+        self.assertIn(self.milk.id, snapshot.postings['mle'])
+        self.assertEqual(self.matcher.match_names(['Sir', 'Mleko 1L']), [(cheese, 6), (None, 0)])
+
+
+@override_settings(PRODUCT_MATCHER={'BACKEND': 'postgres_trgm'})
+class PostgresTrigramMatcherTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.milk = Product.objects.create(name='Mleko 1L', points=3)
+        cls.bread = Product.objects.create(name='Hleb Sava', points=2)
+
+    def setUp(self):
+        reset_product_matcher()
+
+    @skipUnless(connection.vendor != 'postgresql', 'falls back only without PostgreSQL')
+    def test_falls_back_to_the_in_memory_matcher(self):
+        self.assertIsInstance(get_product_matcher(), ProductMatcher)
+
+    @skipUnless(connection.vendor == 'postgresql', 'pg_trgm needs PostgreSQL')
+    def test_matches_every_line_in_one_query(self):
+        matcher = get_product_matcher()
+        self.assertIsInstance(matcher, PostgresTrigramMatcher)
+        with self.assertNumQueries(5):  # savepoint, two thresholds, the match, release
+            results = matcher.match_names(['MLEKO 1L', 'hleb', 'Mlekko 1L', 'Jogurt'])
+        self.assertEqual(results, [(self.milk, 3), (self.bread, 2), (self.milk, 3), (None, 0)])
+
+
+class ProductAliasTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.maxi = Store.objects.create(name='Maxi')
+        cls.idea = Store.objects.create(name='Idea')
+        cls.milk = Product.objects.create(name='Mleko 1L', points=3)
+        cls.yogurt = Product.objects.create(name='Jogurt', points=4)
+
+    def aliases(self):
+        return set(ProductAlias.objects.values_list('alias', 'store_id', 'product_id'))
+
+    def test_learn_keeps_the_first_global_alias(self):
+        ProductAlias.learn(' MLK 1L ', self.milk.id, store_id=self.maxi.id)
+        ProductAlias.learn('MLK 1L', self.yogurt.id, store_id=self.idea.id)
+
+        self.assertEqual(self.aliases(), {
+            ('mlk 1l', self.maxi.id, self.milk.id),
+            ('mlk 1l', self.idea.id, self.yogurt.id),
+            ('mlk 1l', None, self.milk.id),
+        })
+
+    def test_relink_corrects_the_global_alias(self):
+        ProductAlias.learn('MLK 1L', self.yogurt.id, store_id=self.maxi.id)
+        ProductAlias.learn('MLK 1L', self.milk.id, store_id=self.maxi.id, relink=True)
+
+        self.assertEqual(self.aliases(), {
+            ('mlk 1l', self.maxi.id, self.milk.id),
+            ('mlk 1l', None, self.milk.id),
+        })
+
+
+class StoreResolverTests(TestCase):
+
+    MAXI = {'name': '1228831-Maxi 123', 'location': 'Beograd', 'tin': '100000001'}
+
+    def setUp(self):
+        StoreResolver.clear()
+
+    def test_splits_shop_codes_and_tins(self):
+        self.assertEqual(split_shop_code(' 1228831 - Maxi 123'), ('1228831', 'Maxi 123'))
+        self.assertEqual(split_shop_code('Maxi'), ('', 'Maxi'))
+        self.assertEqual(normalize_tin(' 100-000-001 '), '100000001')
+        self.assertIsNone(normalize_tin(''))
+
+    def test_tin_and_shop_code_identify_the_store(self):
+        store = StoreResolver.resolve(self.MAXI)
+        renamed = StoreResolver.resolve({**self.MAXI, 'name': '1228831-MAXI  123'})
+        other_shop = StoreResolver.resolve({**self.MAXI, 'name': '1228832-Maxi 124'})
+
+        self.assertEqual((store.tin, store.shop_code), ('100000001', '1228831'))
+        self.assertEqual(renamed, store)
+        self.assertNotEqual(other_shop, store)
+        with self.assertNumQueries(0):
+            StoreResolver.resolve(self.MAXI)
+
+    def test_adopts_the_legacy_store_of_the_same_name(self):
+        legacy = Store.objects.create(name='1228831-Maxi 123')
+        self.assertEqual(StoreResolver.resolve(self.MAXI), legacy)
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.tin, '100000001')
+
+    def test_stores_without_a_tin_are_found_by_name(self):
+        store = StoreResolver.resolve({'name': 'Pijaca', 'tin': ''})
+        self.assertEqual(StoreResolver.resolve({'name': 'Pijaca'}), store)
+        self.assertIsNone(store.tin)
+
+    def test_dedupe_merges_legacy_stores_into_the_tin_store(self):
+        user = User.objects.create_user(email='alice@example.com', password='x', name='Alice')
+        store = StoreResolver.resolve(self.MAXI)
+        legacy = Store.objects.create(name='1228831-Maxi 123')
+        scan = Transaction.objects.create(user=user, store=legacy, total_points=0)
+
+        call_command('dedupe_stores', stdout=io.StringIO())
+
+        self.assertEqual(list(Store.objects.all()), [store])
+        scan.refresh_from_db()
+        self.assertEqual(scan.store, store)
@@ -16,7 +16,7 @@ class ProductViewSet(viewsets.ModelViewSet):
 
     def get_permissions(self):
         """Admin only for create, update, delete. Authenticated users for list/retrieve."""
-        if self.action in ['create', 'update', 'partial_update', 'destroy']:
+        if self.action in ['create', 'update', 'partial_update', 'destroy', 'matcher_stats']:
             return [IsAdminUser()]
         return [IsAuthenticated()]
 
@@ -86,6 +86,17 @@ class ProductViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(products, many=True)
         return Response(serializer.data)
 
+    @extend_schema(
+        summary="Get product matcher statistics (Admin only)",
+        description="Hit ratio, size and catalog version of this server process's receipt line match memo.",
+        responses={200: {'type': 'object'}}
+    )
+    @action(detail=False, methods=['get'], url_path='matcher-stats')
+    def matcher_stats(self, request):
+        """Report receipt line match memo statistics."""
+        from .matching import matcher_stats
+        return Response(matcher_stats())
+
 
 class StoreViewSet(viewsets.ModelViewSet):
     """ViewSet for Store CRUD operations."""
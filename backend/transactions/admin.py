@@ -1,15 +1,17 @@
+import json
+
 from django.contrib import admin
 from django.utils.html import format_html
 from django.urls import reverse
 from django.utils import timezone
-from .models import Transaction, TransactionItem
+from .models import Transaction, TransactionItem, ReceiptScanJob, SUFReceiptCache
 
 
 class TransactionItemInline(admin.TabularInline):
     """Inline admin for transaction items."""
     model = TransactionItem
     extra = 0
-    readonly_fields = ['id', 'product', 'product_name', 'quantity', 'price', 'unit_price', 'points', 'matched', 'review_status']
+    readonly_fields = ['id', 'product', 'product_name', 'gtin', 'quantity', 'price', 'unit_price', 'points', 'matched', 'review_status']
     can_delete = False
 
     def has_add_permission(self, request, obj=None):
@@ -24,15 +26,23 @@ class TransactionAdmin(admin.ModelAdmin):
     list_filter = ['scanned_at', 'store']
     search_fields = ['id', 'user__email', 'store__name']
     ordering = ['-scanned_at']
-    readonly_fields = ['id', 'user', 'store', 'total_points', 'receipt_url', 'receipt_data', 'scanned_at', 'created_at']
+    readonly_fields = ['id', 'user', 'store', 'total_points', 'receipt_url', 'receipt_json', 'scanned_at', 'created_at']
     inlines = [TransactionItemInline]
 
     fieldsets = (
         (None, {'fields': ('id', 'user', 'store', 'total_points')}),
-        ('Receipt Info', {'fields': ('receipt_url', 'receipt_data')}),
+        ('Receipt Info', {'fields': ('receipt_url', 'receipt_json')}),
         ('Timestamps', {'fields': ('scanned_at', 'created_at')}),
     )
 
+    def receipt_json(self, obj):
+        """Decompressed raw receipt, pretty-printed."""
+        data = obj.receipt_data
+        if data is None:
+            return '-'
+        return format_html('<pre>{}</pre>', json.dumps(data, ensure_ascii=False, indent=2))
+    receipt_json.short_description = 'Receipt data'
+
     def has_add_permission(self, request):
         """Transactions are created via API only."""
         return False
@@ -48,14 +58,14 @@ class TransactionItemAdmin(admin.ModelAdmin):
 
     list_display = ['product_name', 'transaction_user', 'quantity', 'price', 'unit_price', 'points', 'matched', 'review_status_badge', 'review_requested_at']
     list_filter = ['matched', 'review_status', 'review_requested_at']
-    search_fields = ['transaction__id', 'product_name', 'product__name', 'transaction__user__email']
+    search_fields = ['transaction__id', 'product_name', 'gtin', 'product__name', 'transaction__user__email']
     ordering = ['-review_requested_at', '-transaction__scanned_at']
-    readonly_fields = ['id', 'transaction', 'product', 'product_name', 'quantity', 'price', 'unit_price', 'matched', 'review_requested_at', 'points', 'review_status', 'review_notes']
+    readonly_fields = ['id', 'transaction', 'product', 'product_name', 'gtin', 'quantity', 'price', 'unit_price', 'matched', 'review_requested_at', 'points', 'review_status', 'review_notes']
     actions = ['approve_reviews', 'reject_reviews']
 
     fieldsets = (
         (None, {'fields': ('id', 'transaction', 'product')}),
-        ('Product Info', {'fields': ('product_name', 'quantity', 'price', 'unit_price')}),
+        ('Product Info', {'fields': ('product_name', 'gtin', 'quantity', 'price', 'unit_price')}),
         ('Points & Matching', {'fields': ('points', 'matched')}),
         ('Review Info', {'fields': ('review_status', 'review_requested_at', 'review_notes')}),
     )
@@ -83,7 +93,7 @@ class TransactionItemAdmin(admin.ModelAdmin):
 
     def approve_reviews(self, request, queryset):
         """Approve selected reviews and assign default points."""
-        from products.models import Product
+        from products.models import Product, ProductAlias
         from django.db.models import F
 
         print(f"🔍 ADMIN DEBUG - approve_reviews called")
@@ -93,6 +103,7 @@ class TransactionItemAdmin(admin.ModelAdmin):
         users_to_update = {}
         transactions_to_update = {}
         items_to_process = []
+        newly_matched = {}
 
         # First pass: process items and collect users/transactions
         for item in queryset.filter(review_status='pending'):
@@ -119,6 +130,7 @@ class TransactionItemAdmin(admin.ModelAdmin):
                 print(f"⚠️ ADMIN DEBUG - Product already linked: {item.product}")
 
             # Assign default 10 points and mark as matched
+            newly_matched[item.id] = not item.matched
             item.review_status = 'approved'
             item.matched = True
             item.points = 10
@@ -134,26 +146,28 @@ class TransactionItemAdmin(admin.ModelAdmin):
             users_to_update[user_id] = users_to_update.get(user_id, 0) + 10
             transactions_to_update[transaction_id] = transactions_to_update.get(transaction_id, 0) + 10
 
-        # Save all items
-        for item in items_to_process:
-            item.save()
-
-        # Update user points in batch
+        from analytics.events import AnalyticsEventService
+        from django.db import transaction as db_transaction
         from users.models import User
-        for user_id, points_to_add in users_to_update.items():
-            user = User.objects.get(id=user_id)
-            old_points = user.points
-            user.points += points_to_add
-            user.save()
-            print(f"🔍 ADMIN DEBUG - User {user.email}: {old_points} -> {user.points} points (+{points_to_add})")
-
-        # Update transaction totals in batch
-        for transaction_id, points_to_add in transactions_to_update.items():
-            transaction = Transaction.objects.get(id=transaction_id)
-            old_total = transaction.total_points
-            transaction.total_points += points_to_add
-            transaction.save()
-            print(f"🔍 ADMIN DEBUG - Transaction {transaction_id}: {old_total} -> {transaction.total_points} points (+{points_to_add})")
+
+        # Points, learned aliases and the analytics change log are committed together
+        with db_transaction.atomic():
+            # Save all items
+            for item in items_to_process:
+                item.save()
+                # Remember the receipt string so the next scan matches it directly
+                ProductAlias.learn(item.product_name, item.product_id, store_id=item.transaction.store_id)
+                AnalyticsEventService.record_review_approval(item, 10, newly_matched[item.id])
+
+            # Update user points and transaction totals in the database, so concurrent
+            # approvals and scans cannot overwrite each other
+            for user_id, points_to_add in users_to_update.items():
+                User.objects.filter(id=user_id).update(points=F('points') + points_to_add)
+                print(f"🔍 ADMIN DEBUG - User {user_id}: +{points_to_add} points")
+
+            for transaction_id, points_to_add in transactions_to_update.items():
+                Transaction.objects.filter(id=transaction_id).update(total_points=F('total_points') + points_to_add)
+                print(f"🔍 ADMIN DEBUG - Transaction {transaction_id}: +{points_to_add} points")
 
         updated = len(items_to_process)
         print(f"\n✅ ADMIN DEBUG - Completed! Updated {updated} items")
@@ -180,3 +194,41 @@ class TransactionItemAdmin(admin.ModelAdmin):
     def has_delete_permission(self, request, obj=None):
         """Prevent deletion of transaction items."""
         return False
+
+
+@admin.register(ReceiptScanJob)
+class ReceiptScanJobAdmin(admin.ModelAdmin):
+    """Admin interface for asynchronous receipt scan jobs."""
+
+    list_display = ['id', 'user', 'status', 'stage', 'attempts', 'created_at', 'finished_at']
+    list_filter = ['status', 'stage', 'created_at']
+    search_fields = ['id', 'user__email', 'qr_data']
+    ordering = ['-created_at']
+    readonly_fields = ['id', 'user', 'qr_data', 'status', 'stage', 'attempts', 'result', 'error',
+                       'transaction', 'available_at', 'created_at', 'started_at', 'finished_at']
+
+    fieldsets = (
+        (None, {'fields': ('id', 'user', 'qr_data')}),
+        ('Progress', {'fields': ('status', 'stage', 'attempts', 'available_at')}),
+        ('Outcome', {'fields': ('transaction', 'result', 'error')}),
+        ('Timestamps', {'fields': ('created_at', 'started_at', 'finished_at')}),
+    )
+
+    def has_add_permission(self, request):
+        """Scan jobs are created via API only."""
+        return False
+
+
+@admin.register(SUFReceiptCache)
+class SUFReceiptCacheAdmin(admin.ModelAdmin):
+    """Admin interface for cached SUF receipt responses."""
+
+    list_display = ['invoice_number', 'url_hash', 'hit_count', 'size_bytes', 'created_at', 'last_accessed_at']
+    search_fields = ['invoice_number', 'url_hash']
+    ordering = ['-last_accessed_at']
+    readonly_fields = ['id', 'url_hash', 'invoice_number', 'receipt_data', 'store_info', 'size_bytes',
+                       'hit_count', 'created_at', 'last_accessed_at']
+
+    def has_add_permission(self, request):
+        """Cache entries are written by the receipt pipeline only."""
+        return False
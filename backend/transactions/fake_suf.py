@@ -0,0 +1,180 @@
+"""
+Local stand-in for the SUF receipt verification service.
+
+Serves recorded fixtures (see suf_fixtures.py) over the same two endpoints the
+scan pipeline uses, so the real HTML scraping, /specifications POST and
+parsing code can be exercised and load-tested offline:
+
+    GET  /v/?vl=...        receipt page HTML
+    POST /specifications   specifications JSON (form fields invoiceNumber, token)
+
+Latency, errors (503) and hangs can be injected. With `synthesize` enabled,
+unknown `vl` values are answered with a fixture chosen by hash and a unique
+invoice number, so every scan of a load test is a new receipt.
+
+Started by `python manage.py run_fake_suf`; point the app at it with
+SUF_BASE_URL=http://127.0.0.1:8765 and SUF_REDIRECT_RECEIPT_URLS=True.
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from .models import normalize_receipt_key
+from .suf_fixtures import SUFFixture
+
+
+DEFAULT_FAKE_SUF_SETTINGS = {
+    'LATENCY_MS': 0,        # mean added latency per request
+    'JITTER_MS': 0,         # standard deviation of the added latency
+    'ERROR_RATE': 0.0,      # share of requests answered with 503
+    'HANG_RATE': 0.0,       # share of requests that stall for HANG_SECONDS
+    'HANG_SECONDS': 30,
+    'SYNTHESIZE': False,
+    'SEED': None,
+}
+
+SYNTHETIC_SUFFIX = re.compile(r'^(?P<invoice>.+)-S(?P<digest>[0-9a-f]{10})$')
+
+
+class FakeSUF:
+    """Fixture lookup and fault injection shared by all request handler threads."""
+
+    def __init__(self, fixtures: List[SUFFixture], **overrides):
+        if not fixtures:
+            raise ValueError('The fake SUF server needs at least one fixture')
+
+        config = dict(DEFAULT_FAKE_SUF_SETTINGS)
+        config.update(overrides)
+        self.config = config
+
+        self.fixtures = fixtures
+        self.by_key = {fixture.key: fixture for fixture in fixtures}
+        self.by_invoice = {fixture.invoice_number: fixture for fixture in fixtures}
+
+        self._random = random.Random(config['SEED'])
+        self._lock = threading.Lock()
+        self.counters = {'pages': 0, 'specifications': 0, 'not_found': 0, 'errors': 0, 'hangs': 0}
+
+    def _count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def inject_faults(self) -> Optional[int]:
+        """Sleep for the configured latency; return 503 if this request should fail."""
+        with self._lock:
+            delay = max(self._random.gauss(self.config['LATENCY_MS'], self.config['JITTER_MS']), 0) / 1000
+            roll = self._random.random()
+
+        hang = roll < self.config['HANG_RATE']
+        error = not hang and roll < self.config['HANG_RATE'] + self.config['ERROR_RATE']
+
+        if hang:
+            self._count('hangs')
+            delay += self.config['HANG_SECONDS']
+        if delay:
+            time.sleep(delay)
+
+        if error:
+            self._count('errors')
+            return 503
+        return None
+
+    def page(self, vl: str) -> Optional[str]:
+        """Receipt page HTML for a `vl` value (real or synthesized), or None."""
+        fixture = self.by_key.get(vl)
+        if fixture is not None:
+            self._count('pages')
+            return fixture.html
+
+        if not self.config['SYNTHESIZE']:
+            self._count('not_found')
+            return None
+
+        digest = hashlib.sha256(vl.encode('utf-8')).hexdigest()
+        fixture = self.fixtures[int(digest, 16) % len(self.fixtures)]
+        self._count('pages')
+        # A unique invoice number keeps synthesized receipts apart in the receipt cache
+        return fixture.html.replace(fixture.invoice_number, f'{fixture.invoice_number}-S{digest[:10]}')
+
+    def specifications(self, invoice_number: str, token: str) -> Optional[Dict]:
+        """Specifications JSON for an invoice number/token pair, or None."""
+        fixture = self.by_invoice.get(invoice_number)
+        if fixture is None and self.config['SYNTHESIZE']:
+            match = SYNTHETIC_SUFFIX.match(invoice_number)
+            if match:
+                fixture = self.by_invoice.get(match.group('invoice'))
+
+        if fixture is None or fixture.token != token:
+            self._count('not_found')
+            return None
+
+        self._count('specifications')
+        return fixture.specifications
+
+
+class FakeSUFHandler(BaseHTTPRequestHandler):
+    server_version = 'FakeSUF/1.0'
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real service
+
+    @property
+    def suf(self) -> FakeSUF:
+        return self.server.suf
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send(status, message.encode('utf-8'), 'text/plain; charset=utf-8')
+
+    def do_GET(self):
+        failure = self.suf.inject_faults()
+        if failure:
+            return self._send_error(failure, 'Service Unavailable')
+
+        has_vl = any(param.startswith('vl=') for param in urlsplit(self.path).query.split('&'))
+        html = self.suf.page(normalize_receipt_key(self.path)) if has_vl else None
+        if html is None:
+            return self._send_error(404, 'Receipt not found')
+        self._send(200, html.encode('utf-8'), 'text/html; charset=utf-8')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+
+        failure = self.suf.inject_faults()
+        if failure:
+            return self._send_error(failure, 'Service Unavailable')
+
+        if urlsplit(self.path).path.rstrip('/') != '/specifications':
+            return self._send_error(404, 'Not found')
+
+        specifications = self.suf.specifications(
+            form.get('invoiceNumber', [''])[0],
+            form.get('token', [''])[0]
+        )
+        body = specifications if specifications is not None else {'success': False, 'items': []}
+        self._send(200, json.dumps(body, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+
+def make_server(fixtures: List[SUFFixture], address: Tuple[str, int] = ('127.0.0.1', 8765),
+                verbose: bool = False, **overrides) -> ThreadingHTTPServer:
+    """Build (but do not start) a threaded fake SUF server bound to `address`."""
+    server = ThreadingHTTPServer(address, FakeSUFHandler)
+    server.daemon_threads = True
+    server.suf = FakeSUF(fixtures, **overrides)
+    server.verbose = verbose
+    return server
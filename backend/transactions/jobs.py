@@ -0,0 +1,263 @@
+"""
+Database-backed queue for asynchronous receipt scanning.
+
+`scan_receipt` enqueues a ReceiptScanJob and returns immediately; a pool of
+worker threads started by `python manage.py process_scan_jobs` claims pending
+jobs and runs ReceiptProcessingService.process_receipt for them.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import ReceiptScanJob, Transaction
+from .services import ReceiptProcessingService
+
+logger = logging.getLogger(__name__)
+
+# Identifies this process on the jobs it claims; its pool keeps their heartbeats fresh
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+class ScanJobService:
+    """Enqueue, claim and execute receipt scan jobs."""
+
+    MAX_ATTEMPTS = getattr(settings, 'RECEIPT_SCAN_JOB_MAX_ATTEMPTS', 3)
+    RETRY_DELAY_SECONDS = getattr(settings, 'RECEIPT_SCAN_JOB_RETRY_DELAY', 30)
+    STALE_AFTER_SECONDS = getattr(settings, 'RECEIPT_SCAN_JOB_STALE_AFTER', 300)
+    HEARTBEAT_INTERVAL_SECONDS = getattr(settings, 'RECEIPT_SCAN_JOB_HEARTBEAT_INTERVAL', 30)
+    REQUEUE_INTERVAL_SECONDS = 60
+
+    @staticmethod
+    def validate_qr(qr_data: str) -> Optional[str]:
+        """Return an error message if the QR payload can never be processed, else None."""
+        if qr_data.startswith("TEST:"):
+            return None
+        if not ReceiptProcessingService.extract_url_from_qr(qr_data):
+            return 'Invalid QR code - could not extract receipt URL'
+        return None
+
+    @staticmethod
+    def enqueue(qr_data: str, user, delay: float = 0) -> ReceiptScanJob:
+        """Store a pending scan job for the worker pool, runnable after `delay` seconds."""
+        return ReceiptScanJob.objects.create(
+            user=user,
+            qr_data=qr_data,
+            available_at=timezone.now() + timedelta(seconds=delay)
+        )
+
+    @classmethod
+    def claim_next(cls, worker: str = WORKER_ID) -> Optional[ReceiptScanJob]:
+        """
+        Atomically claim the oldest runnable job for `worker`.
+        SKIP LOCKED lets concurrent workers claim different rows without blocking.
+        """
+        with db_transaction.atomic():
+            job = (
+                ReceiptScanJob.objects
+                .select_for_update(skip_locked=True)
+                .select_related('user')
+                .filter(status='pending', available_at__lte=timezone.now())
+                .order_by('available_at', 'created_at')
+                .first()
+            )
+            if job is None:
+                return None
+
+            job.status = 'running'
+            job.stage = 'fetching'
+            job.attempts += 1
+            job.started_at = job.heartbeat_at = timezone.now()
+            job.worker = worker
+            job.save(update_fields=['status', 'stage', 'attempts', 'started_at', 'heartbeat_at', 'worker'])
+            return job
+
+    @classmethod
+    def run_job(cls, job: ReceiptScanJob) -> ReceiptScanJob:
+        """Process a claimed job and record its outcome."""
+
+        def set_stage(stage):
+            job.stage = stage
+            ReceiptScanJob.objects.filter(pk=job.pk).update(stage=stage, heartbeat_at=timezone.now())
+
+        try:
+            result = ReceiptProcessingService.process_receipt(job.qr_data, job.user, progress=set_stage)
+        except Exception as e:
+            logger.exception('Scan job %s failed on attempt %d', job.pk, job.attempts)
+            return cls._fail_or_retry(job, f'Error processing receipt: {e}')
+
+        if result.get('suf_unavailable'):
+            return cls._defer(job, result['error'], result['retry_after'])
+
+        if result.get('already_scanned') and job.attempts > 1:
+            # An earlier attempt may have saved the receipt before its worker stopped
+            saved = cls._saved_by_earlier_attempt(job)
+            if saved is not None:
+                result = {'success': True, 'transaction_id': saved.id, 'total_points': saved.total_points}
+
+        job.result = result
+        job.stage = 'done'
+        job.finished_at = timezone.now()
+        if result.get('success'):
+            job.status = 'succeeded'
+            job.transaction_id = result.get('transaction_id')
+            job.error = None
+        else:
+            job.status = 'failed'
+            job.error = result.get('error')
+        job.save(update_fields=['result', 'stage', 'finished_at', 'status', 'transaction', 'error'])
+        return job
+
+    @staticmethod
+    def _saved_by_earlier_attempt(job: ReceiptScanJob) -> Optional[Transaction]:
+        """The job user's transaction of the job's receipt, saved after the job was queued."""
+        receipt_url = ReceiptProcessingService.extract_url_from_qr(job.qr_data)
+        if not receipt_url:
+            return None
+        return (
+            Transaction.objects
+            .filter(
+                user_id=job.user_id,
+                receipt_fingerprint=ReceiptProcessingService.receipt_fingerprint(receipt_url),
+                scanned_at__gte=job.created_at
+            )
+            .only('id', 'total_points')
+            .first()
+        )
+
+    @classmethod
+    def _fail_or_retry(cls, job: ReceiptScanJob, error: str) -> ReceiptScanJob:
+        job.error = error
+        if job.attempts < cls.MAX_ATTEMPTS:
+            job.status = 'pending'
+            job.stage = 'queued'
+            job.available_at = timezone.now() + timedelta(seconds=cls.RETRY_DELAY_SECONDS * job.attempts)
+        else:
+            job.status = 'failed'
+            job.finished_at = timezone.now()
+        job.save(update_fields=['error', 'status', 'stage', 'available_at', 'finished_at'])
+        return job
+
+    @classmethod
+    def _defer(cls, job: ReceiptScanJob, error: str, delay: float) -> ReceiptScanJob:
+        """
+        Put a job back in the queue until SUF is expected to be reachable again.
+        The SUF circuit breaker rejected the call, so the attempt is not counted.
+        """
+        job.error = error
+        job.status = 'pending'
+        job.stage = 'queued'
+        job.attempts -= 1
+        job.available_at = timezone.now() + timedelta(seconds=delay)
+        job.save(update_fields=['error', 'status', 'stage', 'attempts', 'available_at'])
+        return job
+
+    @staticmethod
+    def heartbeat(worker: str = WORKER_ID) -> int:
+        """Mark the running jobs of `worker` as alive. Returns the number of jobs."""
+        return ReceiptScanJob.objects.filter(status='running', worker=worker).update(heartbeat_at=timezone.now())
+
+    @classmethod
+    def requeue_stale_jobs(cls) -> int:
+        """
+        Return jobs left 'running' by a crashed worker to the queue: jobs whose
+        heartbeat is older than STALE_AFTER_SECONDS (slow jobs of a live worker
+        keep theirs fresh). The crashed run counted as an attempt when the job
+        was claimed, so jobs out of attempts fail instead (a receipt that crashes
+        its worker is not retried forever). Returns the number of jobs requeued.
+        """
+        now = timezone.now()
+        cutoff = now - timedelta(seconds=cls.STALE_AFTER_SECONDS)
+        # Jobs claimed before heartbeats were recorded have none: fall back to their start
+        stale = ReceiptScanJob.objects.filter(status='running').filter(
+            Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff)
+        )
+        failed = stale.filter(attempts__gte=cls.MAX_ATTEMPTS).update(
+            status='failed',
+            error='The worker stopped while processing the receipt',
+            finished_at=now
+        )
+        requeued = stale.filter(attempts__lt=cls.MAX_ATTEMPTS).update(
+            status='pending',
+            stage='queued',
+            available_at=now
+        )
+        if failed or requeued:
+            logger.warning('Requeued %d and failed %d stale scan job(s)', requeued, failed)
+        return requeued
+
+    @classmethod
+    def run_once(cls) -> bool:
+        """Claim and run a single job. Returns False when the queue is empty."""
+        job = cls.claim_next()
+        if job is None:
+            return False
+        cls.run_job(job)
+        return True
+
+    @classmethod
+    def work(cls, stop_event: threading.Event, poll_interval: float = 1.0, exit_when_idle: bool = False):
+        """Worker loop: keep claiming jobs until stopped (or idle, if requested)."""
+        try:
+            while not stop_event.is_set():
+                close_old_connections()
+                if cls.run_once():
+                    continue
+                if exit_when_idle:
+                    break
+                stop_event.wait(poll_interval)
+        finally:
+            # Each worker thread owns its own DB connection
+            connection.close()
+
+    @classmethod
+    def run_pool(cls, workers: int = 4, poll_interval: float = 1.0, exit_when_idle: bool = False,
+                 stop_event: Optional[threading.Event] = None):
+        """
+        Run `workers` worker threads until interrupted. The main thread refreshes
+        the heartbeat of this process's running jobs every HEARTBEAT_INTERVAL_SECONDS;
+        jobs of crashed workers (here or in another pool) are requeued at start
+        and every REQUEUE_INTERVAL_SECONDS.
+        """
+        stop_event = stop_event or threading.Event()
+        cls.requeue_stale_jobs()
+        next_requeue = time.monotonic() + cls.REQUEUE_INTERVAL_SECONDS
+        next_heartbeat = time.monotonic() + cls.HEARTBEAT_INTERVAL_SECONDS
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='scan-worker') as pool:
+            futures = [
+                pool.submit(cls.work, stop_event, poll_interval, exit_when_idle)
+                for _ in range(workers)
+            ]
+            try:
+                while not all(f.done() for f in futures):
+                    time.sleep(0.5)
+                    if time.monotonic() >= next_heartbeat:
+                        next_heartbeat = time.monotonic() + cls.HEARTBEAT_INTERVAL_SECONDS
+                        cls._in_pool(cls.heartbeat, 'Could not refresh the scan job heartbeats')
+                    if time.monotonic() >= next_requeue:
+                        next_requeue = time.monotonic() + cls.REQUEUE_INTERVAL_SECONDS
+                        cls._in_pool(cls.requeue_stale_jobs, 'Could not requeue stale scan jobs')
+            except KeyboardInterrupt:
+                stop_event.set()
+
+        for future in futures:
+            future.result()
+
+    @staticmethod
+    def _in_pool(task, error: str):
+        """Periodic task of the pool's main thread; a failure is logged and retried next time."""
+        close_old_connections()
+        try:
+            task()
+        except Exception:
+            logger.exception(error)
@@ -0,0 +1,114 @@
+"""
+Django management command that benchmarks the SUF receipt page parsers.
+
+Compares the fast path (regex + lxml, ReceiptPage.fast_fields) with the
+BeautifulSoup fallback (ReceiptPage.soup_fields) on recorded SUF pages,
+reporting parse time and memory allocations for each.
+
+Usage:
+    python manage.py benchmark_receipt_parser
+    python manage.py benchmark_receipt_parser --iterations 500
+    python manage.py benchmark_receipt_parser --pages /path/to/page.html /path/to/pages/
+"""
+
+import timeit
+import tracemalloc
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from transactions.services import ReceiptPage
+
+
+FIXTURES_DIR = Path(__file__).resolve().parents[2] / 'fixtures' / 'suf'
+
+PARSERS = {
+    'fast': lambda page: page.fast_fields,
+    'soup': lambda page: page.soup_fields,
+}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the fast receipt page parser against the BeautifulSoup fallback'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pages',
+            nargs='+',
+            default=[str(FIXTURES_DIR)],
+            help='HTML files or directories of recorded SUF pages (default: transactions/fixtures/suf)'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=200,
+            help='Parses per page and parser for the timing run'
+        )
+
+    def handle(self, *args, **options):
+        pages = self.load_pages(options['pages'])
+        iterations = options['iterations']
+
+        self.stdout.write(f'Benchmarking {len(pages)} page(s), {iterations} iterations each\n')
+        self.stdout.write(
+            f"{'page':<28}{'parser':<8}{'mean ms':>10}{'best ms':>10}{'peak KiB':>11}{'allocs':>9}"
+        )
+
+        totals = {name: 0.0 for name in PARSERS}
+        for path, html in pages:
+            # Both parsers must agree before their speed matters
+            page = ReceiptPage(path.name, html)
+            if page.fast_fields != page.soup_fields:
+                self.stdout.write(self.style.WARNING(
+                    f'{path.name}: fast and soup parsers disagree\n'
+                    f'  fast: {page.fast_fields}\n  soup: {page.soup_fields}'
+                ))
+
+            for name, parse in PARSERS.items():
+                run = lambda: parse(ReceiptPage(path.name, html))
+                timings = timeit.repeat(run, number=iterations, repeat=3)
+                mean_ms = sum(timings) / (len(timings) * iterations) * 1000
+                best_ms = min(timings) / iterations * 1000
+                peak_kib, allocations = self.measure_allocations(run)
+                totals[name] += mean_ms
+
+                self.stdout.write(
+                    f'{path.name[:27]:<28}{name:<8}{mean_ms:>10.3f}{best_ms:>10.3f}'
+                    f'{peak_kib:>11.1f}{allocations:>9}'
+                )
+
+        if totals['fast']:
+            self.stdout.write(self.style.SUCCESS(
+                f"\nfast parser is {totals['soup'] / totals['fast']:.1f}x faster than BeautifulSoup"
+            ))
+
+    @staticmethod
+    def measure_allocations(run):
+        """Peak traced memory (KiB) and number of live allocated blocks for one parse."""
+        tracemalloc.start()
+        try:
+            before = tracemalloc.take_snapshot()
+            result = run()
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del result
+
+        allocations = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+        return peak / 1024, allocations
+
+    @staticmethod
+    def load_pages(locations):
+        paths = []
+        for location in locations:
+            path = Path(location)
+            if path.is_dir():
+                paths.extend(sorted(path.glob('*.html')))
+            elif path.is_file():
+                paths.append(path)
+            else:
+                raise CommandError(f'No such file or directory: {location}')
+
+        if not paths:
+            raise CommandError('No recorded SUF pages (*.html) found')
+        return [(path, path.read_text(encoding='utf-8')) for path in paths]
@@ -0,0 +1,26 @@
+"""
+Django management command that trims the SUF receipt cache to its size bound.
+
+Scans evict every SUF_RECEIPT_CACHE['EVICT_EVERY'] stored receipts; run this
+from cron instead when that is set to 0, or to trim the cache after lowering
+MAX_ENTRIES / MAX_BYTES.
+
+Usage:
+    python manage.py evict_receipt_cache
+"""
+
+from django.core.management.base import BaseCommand
+
+from transactions.receipt_cache import ReceiptCache
+
+
+class Command(BaseCommand):
+    help = 'Evict least recently used SUF receipt cache entries beyond MAX_ENTRIES / MAX_BYTES'
+
+    def handle(self, *args, **options):
+        evicted = ReceiptCache.evict()
+        stats = ReceiptCache.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Evicted {evicted} entr{'y' if evicted == 1 else 'ies'}; "
+            f"{stats['entries']} entries, {stats['size_bytes']} bytes cached"
+        ))
@@ -0,0 +1,368 @@
+"""
+Django management command that generates a large synthetic workload.
+
+Creates users, stores, products (with barcodes), transactions and
+transaction items at production-like volumes, for testing analytics and
+indexes. The data is shaped like real receipts:
+
+- product popularity follows a Zipf distribution (a few products are on most receipts)
+- user activity is Zipf-skewed as well, and users mostly shop at a few home stores
+- scans follow a weekly cycle (busy Friday/Saturday, quiet Sunday) and shop hours
+
+Rows are written with chunked bulk inserts in scan order, without signals or
+per-row saves, and every id is derived from the seed: the same seed, volumes
+and --end-date produce the same rows. Generated ids start with `wl<seed>`, so
+a run can be removed again with --clear.
+
+Afterwards rebuild the derived tables with `python manage.py update_analytics`.
+
+Usage:
+    python manage.py generate_workload --seed 1 --users 200 --stores 20 --products 500 --transactions 5000
+    python manage.py generate_workload --seed 7 --transactions 2000000 --days 730 --end-date 2026-01-01
+    python manage.py generate_workload --seed 7 --clear
+"""
+
+import bisect
+import contextlib
+import math
+import random
+import time
+from collections import defaultdict
+from datetime import date, datetime, time as dt_time, timedelta
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction as db_transaction
+from django.utils import timezone
+
+from products.models import CatalogVersion, Product, ProductBarcode, Store
+from products.signals import single_catalog_bump
+from transactions.models import Transaction, TransactionItem, receipt_fingerprint
+
+User = get_user_model()
+
+# Relative scan volume per weekday, Monday first
+WEEKDAY_WEIGHTS = (0.90, 0.85, 0.90, 1.00, 1.25, 1.45, 0.65)
+# Relative scan volume per hour of day (shops open 7-22)
+HOUR_WEIGHTS = (
+    0, 0, 0, 0, 0, 0, 0, 2, 4, 5, 5, 5,
+    6, 6, 5, 5, 7, 9, 10, 9, 7, 4, 1, 0,
+)
+
+CHAINS = ('Maxi', 'Idea', 'Lidl', 'Univerexport', 'Roda', 'Mercator', 'DIS', 'Aman', 'Tempo', 'Gomex')
+CITIES = ('Beograd', 'Novi Sad', 'Nis', 'Kragujevac', 'Subotica', 'Cacak', 'Zrenjanin', 'Pancevo')
+CATEGORIES = (
+    'MLEKO', 'JOGURT', 'HLEB', 'SIR', 'KAFA', 'CAJ', 'SOK', 'VODA', 'PIVO', 'COKOLADA',
+    'KEKS', 'CIPS', 'TESTENINA', 'PIRINAC', 'BRASNO', 'SECER', 'ULJE', 'JAJA', 'SALAMA', 'PASTETA',
+    'DETERDZENT', 'SAMPON', 'PASTA ZA ZUBE', 'SAPUN', 'TOALET PAPIR',
+)
+BRANDS = (
+    'IMLEK', 'DUKAT', 'BAMBI', 'STARK', 'SWISSLION', 'DONCAFE', 'GRAND', 'KNJAZ', 'ROSA', 'JELEN',
+    'PODRAVKA', 'FRIKOM', 'CARNEX', 'NESTLE', 'MILKA', 'ANCHOR', 'DIJAMANT', 'FUNGO', 'SAVEX', 'NIVEA',
+)
+SIZES = ('0.5L', '1L', '1.5L', '2L', '100G', '200G', '250G', '400G', '500G', '1KG', '6KOM', '10KOM')
+
+
+def zipf_cum_weights(count: int, exponent: float):
+    """Cumulative Zipf weights for ranks 1..count (for random.choices / bisect)."""
+    cum_weights, total = [], 0.0
+    for rank in range(1, count + 1):
+        total += 1.0 / rank ** exponent
+        cum_weights.append(total)
+    return cum_weights
+
+
+def ean13(body: str) -> str:
+    """Append the EAN-13 check digit to a 12-digit body."""
+    total = sum(int(digit) * (3 if i % 2 else 1) for i, digit in enumerate(body))
+    return body + str((10 - total % 10) % 10)
+
+
+@contextlib.contextmanager
+def explicit_timestamps(*model_classes):
+    """Let bulk inserts keep the given created_at/updated_at values (auto_now/auto_now_add off)."""
+    saved = []
+    for model in model_classes:
+        for field in model._meta.concrete_fields:
+            if isinstance(field, models.DateTimeField) and (field.auto_now or field.auto_now_add):
+                saved.append((field, field.auto_now, field.auto_now_add))
+                field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = 'Generate a large, deterministic synthetic dataset of users, stores, products and receipts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=1, help='Random seed; also namespaces the generated ids')
+        parser.add_argument('--users', type=int, default=1000, help='Number of users')
+        parser.add_argument('--stores', type=int, default=200, help='Number of stores')
+        parser.add_argument('--products', type=int, default=5000, help='Number of products')
+        parser.add_argument('--transactions', type=int, default=100000, help='Number of transactions')
+        parser.add_argument('--items-per-receipt', type=float, default=8.0, help='Mean receipt lines per transaction')
+        parser.add_argument('--days', type=int, default=365, help='Length of the scan history in days')
+        parser.add_argument(
+            '--end-date',
+            type=date.fromisoformat,
+            default=None,
+            help='Last day of the scan history, YYYY-MM-DD (default: today)'
+        )
+        parser.add_argument('--product-skew', type=float, default=1.1, help='Zipf exponent of product popularity')
+        parser.add_argument('--user-skew', type=float, default=0.8, help='Zipf exponent of user activity')
+        parser.add_argument('--match-rate', type=float, default=0.85, help='Share of receipt lines matched to a product')
+        parser.add_argument(
+            '--gtin-rate',
+            type=float,
+            default=0.6,
+            help="Share of matched receipt lines carrying the product's barcode (GTIN)"
+        )
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows per bulk insert')
+        parser.add_argument('--clear', action='store_true', help='Delete the rows generated with this seed and exit')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['seed'] < 10 ** 12:
+            raise CommandError('--seed must be between 0 and 999999999999 (it namespaces the generated ids)')
+        self.prefix = f"wl{options['seed']}"
+
+        if options['clear']:
+            self.clear()
+            return
+
+        if User.objects.filter(id__startswith=self.prefix).exists():
+            raise CommandError(
+                f"Rows for seed {options['seed']} already exist; remove them first with --seed {options['seed']} --clear"
+            )
+
+        self.rng = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+        end_date = options['end_date'] or timezone.localdate()
+        start_date = end_date - timedelta(days=options['days'] - 1)
+        # Catalog rows predate the scan history
+        self.epoch = timezone.make_aware(datetime.combine(start_date - timedelta(days=30), dt_time(8)))
+
+        started = time.perf_counter()
+        with explicit_timestamps(User, Store, Product, ProductBarcode, Transaction):
+            users = self.create_users(options['users'])
+            stores = self.create_stores(options['stores'])
+            products = self.create_products(options['products'])
+            totals = self.create_transactions(users, stores, products, start_date, options)
+        self.award_points(users, totals)
+        CatalogVersion.bump()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {len(users)} users, {len(stores)} stores, {len(products)} products, '
+            f"{totals['transactions']} transactions and {totals['items']} items "
+            f'in {time.perf_counter() - started:.1f}s'
+        ))
+        self.stdout.write('Run `python manage.py update_analytics` to rebuild analytics for the new data.')
+
+    def make_id(self, kind: str, index: int) -> str:
+        return f'{self.prefix}{kind}{index:010d}'
+
+    def bulk_insert(self, model, rows):
+        for start in range(0, len(rows), self.chunk_size):
+            model.objects.bulk_create(rows[start:start + self.chunk_size])
+
+    def create_users(self, count: int):
+        users = [
+            User(
+                id=self.make_id('u', i),
+                email=f'{self.prefix}.user{i}@example.com',
+                name=f'Workload User {i}',
+                password='!workload',  # unusable password
+                points=0,
+                created_at=self.epoch,
+                updated_at=self.epoch,
+            )
+            for i in range(count)
+        ]
+        self.bulk_insert(User, users)
+        self.stdout.write(f'  {count} users')
+        return users
+
+    def create_stores(self, count: int):
+        stores = []
+        for i in range(count):
+            chain = CHAINS[i % len(CHAINS)]
+            shop_code = str(1000000 + i)
+            stores.append(Store(
+                id=self.make_id('s', i),
+                name=f'{shop_code}-{chain} {i // len(CHAINS) + 1}',
+                location=self.rng.choice(CITIES),
+                # One TIN per chain and seed, shop codes unique within it
+                tin=f'9{self.prefix[2:].zfill(6)[-6:]}{CHAINS.index(chain):02d}',
+                shop_code=shop_code,
+                created_at=self.epoch,
+                updated_at=self.epoch,
+            ))
+        self.bulk_insert(Store, stores)
+        self.stdout.write(f'  {count} stores')
+        return stores
+
+    def create_products(self, count: int):
+        """Products in popularity order: index 0 is the most popular (Zipf rank 1)."""
+        products, barcodes = [], []
+        gtin_prefix = f'2{int(self.prefix[2:]) % 1000:03d}'  # 2xx is the restricted (in-store) GTIN range
+        for i in range(count):
+            name = f'{self.rng.choice(CATEGORIES)} {self.rng.choice(BRANDS)} {self.rng.choice(SIZES)} {i}'
+            product = Product(
+                id=self.make_id('p', i),
+                name=name,
+                points=self.rng.choice((1, 1, 2, 2, 3, 5, 5, 10, 15, 20)),
+                status='ACTIVE',
+                created_at=self.epoch,
+                updated_at=self.epoch,
+            )
+            # Unit price in RSD, log-normal around ~200
+            product.unit_price = round(math.exp(self.rng.gauss(5.3, 0.8)), 2)
+            product.gtin = ean13(f'{gtin_prefix}{i:08d}')
+            products.append(product)
+            barcodes.append(ProductBarcode(
+                id=self.make_id('b', i),
+                product=product,
+                gtin=product.gtin,
+                created_at=self.epoch,
+            ))
+        self.bulk_insert(Product, products)
+        self.bulk_insert(ProductBarcode, barcodes)
+        self.stdout.write(f'  {count} products')
+        return products
+
+    def daily_counts(self, start_date: date, days: int, total: int):
+        """Split `total` scans over the days by weekday weight with some daily noise (sums exactly to total)."""
+        weights = [
+            WEEKDAY_WEIGHTS[(start_date + timedelta(days=d)).weekday()] * max(self.rng.gauss(1.0, 0.1), 0.5)
+            for d in range(days)
+        ]
+        scale = total / sum(weights)
+        counts, carry = [], 0.0
+        for weight in weights:
+            exact = weight * scale + carry
+            counts.append(int(exact))
+            carry = exact - int(exact)
+        counts[-1] += total - sum(counts)
+        return counts
+
+    def create_transactions(self, users, stores, products, start_date: date, options):
+        rng = self.rng
+        user_cum = zipf_cum_weights(len(users), options['user_skew'])
+        product_cum = zipf_cum_weights(len(products), options['product_skew'])
+        store_cum = zipf_cum_weights(len(stores), 0.7)
+        hour_cum = list(accumulate(HOUR_WEIGHTS))
+        # Users shop mostly at one to three home stores
+        shuffled_users = list(range(len(users)))
+        rng.shuffle(shuffled_users)  # activity rank is independent of user index
+        home_stores = [rng.sample(range(len(stores)), k=min(len(stores), rng.randint(1, 3))) for _ in users]
+        mean_extra_lines = max(options['items_per_receipt'] - 1, 0)
+        tz = timezone.get_current_timezone()
+
+        totals = {'transactions': 0, 'items': 0, 'points': defaultdict(int)}
+        transactions, items = [], []
+        counts = self.daily_counts(start_date, options['days'], options['transactions'])
+
+        for day_offset, day_count in enumerate(counts):
+            day = start_date + timedelta(days=day_offset)
+            seconds = sorted(
+                bisect.bisect(hour_cum, rng.random() * hour_cum[-1]) * 3600 + rng.randrange(3600)
+                for _ in range(day_count)
+            )
+            for second in seconds:
+                index = totals['transactions']
+                scanned_at = datetime.combine(day, dt_time()).replace(tzinfo=tz) + timedelta(seconds=second)
+                user_index = shuffled_users[bisect.bisect(user_cum, rng.random() * user_cum[-1])]
+                if rng.random() < 0.8:
+                    store = stores[rng.choice(home_stores[user_index])]
+                else:
+                    store = stores[bisect.bisect(store_cum, rng.random() * store_cum[-1])]
+
+                txn_id = self.make_id('t', index)
+                receipt_url = f'https://suf.purs.gov.rs/v/?vl={txn_id.upper()}'
+                txn = Transaction(
+                    id=txn_id,
+                    user_id=users[user_index].id,
+                    store_id=store.id,
+                    receipt_url=receipt_url,
+                    receipt_fingerprint=receipt_fingerprint(receipt_url),
+                    scanned_at=scanned_at,
+                    created_at=scanned_at,
+                )
+
+                line_count = 1 + min(int(rng.expovariate(1 / mean_extra_lines)) if mean_extra_lines else 0, 59)
+                chosen = set()
+                txn_points, txn_amount = 0, 0.0
+                for _ in range(line_count):
+                    product_index = bisect.bisect(product_cum, rng.random() * product_cum[-1])
+                    if product_index in chosen:
+                        continue
+                    chosen.add(product_index)
+                    product = products[product_index]
+                    quantity = rng.choices((1, 2, 3, 4, 6), weights=(80, 12, 4, 2, 2))[0]
+                    price = round(product.unit_price * quantity, 2)
+                    matched = rng.random() < options['match_rate']
+                    points = product.points * quantity if matched else 0
+                    gtin = product.gtin if matched and rng.random() < options['gtin_rate'] else None
+                    items.append(TransactionItem(
+                        id=self.make_id('i', totals['items']),
+                        transaction_id=txn_id,
+                        product_id=product.id if matched else None,
+                        product_name=product.name.upper() if matched else f'{product.name.upper()} /KOM',
+                        gtin=gtin,
+                        quantity=quantity,
+                        price=price,
+                        unit_price=product.unit_price,
+                        points=points,
+                        matched=matched,
+                    ))
+                    totals['items'] += 1
+                    txn_points += points
+                    txn_amount += price
+
+                txn.total_points = txn_points
+                txn.total_amount = round(txn_amount, 2)
+                transactions.append(txn)
+                totals['points'][user_index] += txn_points
+                totals['transactions'] += 1
+
+                if len(transactions) >= self.chunk_size:
+                    self.flush(transactions, items)
+                    transactions, items = [], []
+
+        self.flush(transactions, items)
+        return totals
+
+    def flush(self, transactions, items):
+        if not transactions:
+            return
+        with db_transaction.atomic():
+            Transaction.objects.bulk_create(transactions, batch_size=self.chunk_size)
+            TransactionItem.objects.bulk_create(items, batch_size=self.chunk_size)
+        self.stdout.write(f'  ... {transactions[-1].scanned_at:%Y-%m-%d}: {transactions[-1].id}')
+
+    def award_points(self, users, totals):
+        for user_index, points in totals['points'].items():
+            users[user_index].points = points
+        User.objects.bulk_update(users, ['points'], batch_size=self.chunk_size)
+
+    def clear(self):
+        """
+        Delete everything generated with this seed, children first, with one
+        catalog version bump for all the deleted products.
+        """
+        prefix = self.prefix
+        with db_transaction.atomic(), single_catalog_bump():
+            deleted = {
+                'transaction items': TransactionItem.objects.filter(id__startswith=prefix).delete()[0],
+                'transactions': Transaction.objects.filter(id__startswith=prefix).delete()[0],
+                'barcodes': ProductBarcode.objects.filter(id__startswith=prefix).delete()[0],
+                'products': Product.objects.filter(id__startswith=prefix).delete()[0],
+                'stores': Store.objects.filter(id__startswith=prefix).delete()[0],
+                'users': User.objects.filter(id__startswith=prefix).delete()[0],
+            }
+        self.stdout.write(self.style.SUCCESS(
+            'Deleted ' + ', '.join(f'{count} {name}' for name, count in deleted.items())
+        ))
@@ -0,0 +1,116 @@
+"""
+Django management command that measures end-to-end receipt scan throughput.
+
+Runs the full scan pipeline (page fetch, /specifications POST, parsing,
+matching, saving) for unique synthetic receipt URLs from concurrent threads.
+Meant to be pointed at a local `run_fake_suf --synthesize` server, never at
+the production SUF system.
+
+Usage:
+    python manage.py run_fake_suf --synthesize --latency 200 --jitter 50   # in another shell
+    SUF_BASE_URL=http://127.0.0.1:8765 SUF_REDIRECT_RECEIPT_URLS=True \\
+        python manage.py load_test_scans --scans 500 --concurrency 8 --cleanup
+"""
+
+import math
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from transactions.metrics import get_pipeline_metrics
+from transactions.models import Transaction
+from transactions.services import ReceiptProcessingService
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Load test the receipt scan pipeline against a local fake SUF server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scans', type=int, default=200, help='Number of receipts to scan')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent scanning threads')
+        parser.add_argument('--user', default='loadtest@example.com', help='Email of the scanning user')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the transactions created by the run')
+        parser.add_argument(
+            '--allow-production',
+            action='store_true',
+            help='Run even when SUF_CLIENT points at the production SUF host'
+        )
+
+    def handle(self, *args, **options):
+        suf_config = getattr(settings, 'SUF_CLIENT', {})
+        if 'suf.purs.gov.rs' in suf_config.get('BASE_URL', 'suf.purs.gov.rs') and not options['allow_production']:
+            raise CommandError(
+                'SUF_BASE_URL points at the production SUF system. Start `run_fake_suf --synthesize` '
+                'and set SUF_BASE_URL=http://127.0.0.1:8765 SUF_REDIRECT_RECEIPT_URLS=True'
+            )
+
+        user, created = User.objects.get_or_create(
+            email=options['user'],
+            defaults={'name': 'Load Test'}
+        )
+        if created:
+            user.set_unusable_password()
+            user.save(update_fields=['password'])
+
+        run_id = uuid.uuid4().hex[:12]
+        urls = [f'https://suf.purs.gov.rs/v/?vl=LOADTEST{run_id}{i:08d}' for i in range(options['scans'])]
+
+        self.stdout.write(f"Scanning {len(urls)} receipt(s) with {options['concurrency']} thread(s)...")
+
+        concurrency = options['concurrency']
+        started = time.perf_counter()
+        get_pipeline_metrics().reset()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='load-test') as pool:
+            chunks = pool.map(
+                lambda chunk: self.scan_all(chunk, user),
+                [urls[i::concurrency] for i in range(concurrency)]
+            )
+            outcomes = [outcome for chunk in chunks for outcome in chunk]
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for _, latency in outcomes)
+        results = Counter('ok' if result.get('success') else result.get('error', 'error') for result, _ in outcomes)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'\n{len(urls)} scans in {elapsed:.2f}s: {len(urls) / elapsed:.1f} scans/s'
+        ))
+        for fraction in (0.5, 0.95, 0.99):
+            index = max(math.ceil(fraction * len(latencies)) - 1, 0)
+            self.stdout.write(f'  p{int(fraction * 100)} latency: {latencies[index] * 1000:.0f} ms')
+        for outcome, count in results.most_common():
+            self.stdout.write(f'  {outcome}: {count}')
+        self.stdout.write('  Mean time per pipeline stage:')
+        for stage, timing in get_pipeline_metrics().snapshot()['stages'].items():
+            self.stdout.write(f"    {stage}: {timing['mean_ms']} ms ({timing['count']} calls, {timing['errors']} errors)")
+        self.stdout.write(f'  SUF circuit breaker: {ReceiptProcessingService.get_client().breaker.snapshot()}')
+
+        if options['cleanup']:
+            deleted, _ = Transaction.objects.filter(
+                user=user,
+                receipt_url__startswith=f'https://suf.purs.gov.rs/v/?vl=LOADTEST{run_id}'
+            ).delete()
+            self.stdout.write(f'Deleted {deleted} row(s) created by the run')
+
+    @staticmethod
+    def scan_all(receipt_urls, user):
+        """Scan receipts one after another on this thread; returns (result, seconds) per receipt."""
+        outcomes = []
+        try:
+            for receipt_url in receipt_urls:
+                started = time.perf_counter()
+                try:
+                    result = ReceiptProcessingService.process_receipt(receipt_url, user)
+                except Exception as e:
+                    result = {'success': False, 'error': f'{type(e).__name__}: {e}'}
+                outcomes.append((result, time.perf_counter() - started))
+        finally:
+            # Each thread owns its own DB connection
+            connection.close()
+        return outcomes
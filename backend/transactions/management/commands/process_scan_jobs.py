@@ -0,0 +1,47 @@
+"""
+Django management command that runs the background receipt scan worker pool.
+
+Usage:
+    python manage.py process_scan_jobs
+    python manage.py process_scan_jobs --workers 8
+    python manage.py process_scan_jobs --once
+"""
+
+from django.core.management.base import BaseCommand
+from transactions.jobs import ScanJobService
+
+
+class Command(BaseCommand):
+    help = 'Process pending receipt scan jobs with a pool of worker threads'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of worker threads'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to wait between polls when the queue is empty'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the queue and exit instead of polling forever'
+        )
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+
+        self.stdout.write(self.style.SUCCESS(f'Starting {workers} scan worker(s)...'))
+
+        ScanJobService.run_pool(
+            workers=workers,
+            poll_interval=options['poll_interval'],
+            exit_when_idle=options['once'],
+        )
+
+        self.stdout.write(self.style.SUCCESS('Scan workers stopped'))
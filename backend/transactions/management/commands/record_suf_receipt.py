@@ -0,0 +1,53 @@
+"""
+Django management command that records a live SUF receipt as a fixture.
+
+Fetches the receipt page and its /specifications response once from SUF and
+writes them in the record/replay format served by `run_fake_suf`.
+
+Usage:
+    python manage.py record_suf_receipt "https://suf.purs.gov.rs/v/?vl=..."
+    python manage.py record_suf_receipt "https://suf.purs.gov.rs/v/?vl=..." --name maxi_weekend
+"""
+
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from transactions.services import ReceiptProcessingService
+from transactions.suf_fixtures import DEFAULT_FIXTURES_DIR, SUFFixture, fixture_name
+
+
+class Command(BaseCommand):
+    help = 'Record a receipt page and its specifications from SUF as a replay fixture'
+
+    def add_arguments(self, parser):
+        parser.add_argument('qr_data', help='Receipt URL or raw QR code data')
+        parser.add_argument('--name', help='Fixture name (default: derived from the invoice number)')
+        parser.add_argument(
+            '--fixtures',
+            default=str(DEFAULT_FIXTURES_DIR),
+            help='Directory to write the fixture to'
+        )
+        parser.add_argument('--force', action='store_true', help='Overwrite an existing fixture')
+
+    def handle(self, *args, **options):
+        receipt_url = ReceiptProcessingService.extract_url_from_qr(options['qr_data'])
+        if not receipt_url:
+            raise CommandError('Invalid QR code - could not extract receipt URL')
+
+        page = ReceiptProcessingService.fetch_receipt_page(receipt_url)
+        if page is None:
+            raise CommandError('Could not fetch the receipt page from SUF')
+
+        specifications = ReceiptProcessingService._post_specifications(receipt_url, page)
+        if not specifications or not specifications.get('success'):
+            raise CommandError('SUF did not return the receipt specifications')
+
+        name = options['name'] or fixture_name(page.invoice_number or '')
+        directory = Path(options['fixtures'])
+        if (directory / f'{name}.json').exists() and not options['force']:
+            raise CommandError(f'Fixture {name} already exists (use --force to overwrite)')
+
+        path = SUFFixture(name, receipt_url, page.html, specifications).save(directory)
+        self.stdout.write(self.style.SUCCESS(
+            f"Recorded {len(specifications.get('items', []))} item(s) from {page.store_info['name']} to {path}"
+        ))
@@ -0,0 +1,79 @@
+"""
+Django management command that runs a local stand-in for the SUF service.
+
+Replays recorded receipt fixtures (transactions/fixtures/suf/ by default) with
+optional latency and error injection, for offline benchmarks and load tests of
+the real scan pipeline. Point the app at it with:
+
+    SUF_BASE_URL=http://127.0.0.1:8765
+    SUF_REDIRECT_RECEIPT_URLS=True
+
+Usage:
+    python manage.py run_fake_suf
+    python manage.py run_fake_suf --port 9000 --latency 250 --jitter 80
+    python manage.py run_fake_suf --synthesize --error-rate 0.05 --hang-rate 0.01
+"""
+
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from transactions.fake_suf import make_server
+from transactions.suf_fixtures import DEFAULT_FIXTURES_DIR, load_fixtures
+
+
+class Command(BaseCommand):
+    help = 'Serve recorded SUF receipts locally with configurable latency and errors'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Interface to bind')
+        parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+        parser.add_argument(
+            '--fixtures',
+            default=str(DEFAULT_FIXTURES_DIR),
+            help='Directory of recorded fixtures (see record_suf_receipt)'
+        )
+        parser.add_argument('--latency', type=float, default=0, help='Mean added latency per request (ms)')
+        parser.add_argument('--jitter', type=float, default=0, help='Standard deviation of the added latency (ms)')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 503')
+        parser.add_argument('--hang-rate', type=float, default=0.0, help='Share of requests that stall')
+        parser.add_argument('--hang-seconds', type=float, default=30, help='How long a stalled request hangs')
+        parser.add_argument(
+            '--synthesize',
+            action='store_true',
+            help='Answer unknown vl values with a fixture and a unique invoice number (for load tests)'
+        )
+        parser.add_argument('--seed', type=int, default=None, help='Random seed for fault injection')
+        parser.add_argument('--verbose', action='store_true', help='Log every request')
+
+    def handle(self, *args, **options):
+        fixtures = load_fixtures(Path(options['fixtures']))
+        if not fixtures:
+            raise CommandError(f"No fixtures found in {options['fixtures']}")
+
+        server = make_server(
+            fixtures,
+            address=(options['host'], options['port']),
+            verbose=options['verbose'],
+            LATENCY_MS=options['latency'],
+            JITTER_MS=options['jitter'],
+            ERROR_RATE=options['error_rate'],
+            HANG_RATE=options['hang_rate'],
+            HANG_SECONDS=options['hang_seconds'],
+            SYNTHESIZE=options['synthesize'],
+            SEED=options['seed'],
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Fake SUF serving {len(fixtures)} fixture(s) on http://{options['host']}:{options['port']}"
+        ))
+        for fixture in fixtures:
+            self.stdout.write(f'  {fixture.name}: {fixture.url}')
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+        self.stdout.write(self.style.SUCCESS(f'Fake SUF stopped: {server.suf.counters}'))
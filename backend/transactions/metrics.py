@@ -0,0 +1,235 @@
+"""
+Per-stage timing metrics for the receipt scan pipeline.
+
+Every scan is broken into timed stages (spans):
+
+- fetch_page: GET of the SUF receipt page
+- parse: parsing the receipt page (invoice parameters, store info)
+- fetch_specifications: POST to SUF /specifications
+- match: item parsing, store resolution and product matching
+- persist: saving the transaction, items and points
+- scan: the whole scan, end to end
+
+Each stage keeps a call counter, an error counter and a cumulative latency
+histogram; scan outcomes (ok, already_scanned, suf_unavailable, ...) are
+counted separately. Metrics are process-local and exported in the
+Prometheus text format by the /api/receipts/metrics/ endpoint.
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_PIPELINE_METRICS_SETTINGS = {
+    'ENABLED': True,
+    # Histogram bucket upper bounds, in seconds
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+}
+
+STAGES = ('fetch_page', 'parse', 'fetch_specifications', 'match', 'persist', 'scan')
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed bucket bounds (not thread-safe on its own)."""
+
+    def __init__(self, bounds: Iterable[float]):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)  # last slot: +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            index = len(self.bounds)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound)], ending with (inf, count)."""
+        total, buckets = 0, []
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile (None without observations)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return math.inf
+
+
+class PipelineMetrics:
+    """Thread-safe registry of stage spans and outcome counters for this process."""
+
+    def __init__(self, **overrides):
+        config = dict(DEFAULT_PIPELINE_METRICS_SETTINGS)
+        config.update(getattr(settings, 'RECEIPT_PIPELINE_METRICS', {}))
+        config.update(overrides)
+        self.config = config
+
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._histograms: Dict[str, Histogram] = {}
+        self._errors: Dict[str, int] = {}
+        self._outcomes: Dict[str, int] = {}
+
+    def _histogram(self, stage: str) -> Histogram:
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = Histogram(self.config['BUCKETS'])
+            self._errors[stage] = 0
+        return histogram
+
+    def observe(self, stage: str, seconds: float, failed: bool = False):
+        if not self.config['ENABLED']:
+            return
+        with self._lock:
+            self._histogram(stage).observe(seconds)
+            if failed:
+                self._errors[stage] += 1
+
+    @contextmanager
+    def span(self, stage: str, **context):
+        """
+        Time the enclosed block as one call of `stage`. An exception (or
+        span.fail()) counts the call as an error; the exception propagates.
+        """
+        span = _Span()
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.failed = True
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            self.observe(stage, seconds, failed=span.failed)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    'receipt pipeline stage %s took %.1f ms', stage, seconds * 1000,
+                    extra={'stage': stage, 'duration_ms': round(seconds * 1000, 1), 'failed': span.failed, **context}
+                )
+
+    def count_outcome(self, result: Dict):
+        """Count the outcome of a scan result dict (see outcome_of)."""
+        if not self.config['ENABLED']:
+            return
+        outcome = outcome_of(result)
+        with self._lock:
+            self._outcomes[outcome] = self._outcomes.get(outcome, 0) + 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            stages = {}
+            for stage, histogram in self._histograms.items():
+                stages[stage] = {
+                    'count': histogram.count,
+                    'errors': self._errors[stage],
+                    'total_seconds': round(histogram.sum, 6),
+                    'mean_ms': round(histogram.sum / histogram.count * 1000, 2) if histogram.count else None,
+                    'p50_le_seconds': histogram.quantile(0.5),
+                    'p95_le_seconds': histogram.quantile(0.95),
+                    'p99_le_seconds': histogram.quantile(0.99),
+                }
+            return {
+                'uptime_seconds': round(time.time() - self._started, 1),
+                'stages': stages,
+                'outcomes': dict(self._outcomes),
+            }
+
+    def render_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format (version 0.0.4)."""
+        lines = [
+            '# HELP receipt_pipeline_stage_duration_seconds Time spent per receipt pipeline stage.',
+            '# TYPE receipt_pipeline_stage_duration_seconds histogram',
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            errors = dict(self._errors)
+            outcomes = sorted(self._outcomes.items())
+            for stage, histogram in histograms:
+                for bound, total in histogram.cumulative():
+                    le = '+Inf' if bound == math.inf else repr(float(bound))
+                    lines.append(f'receipt_pipeline_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {total}')
+                lines.append(f'receipt_pipeline_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'receipt_pipeline_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        lines += [
+            '# HELP receipt_pipeline_stage_errors_total Receipt pipeline stage calls that failed.',
+            '# TYPE receipt_pipeline_stage_errors_total counter',
+        ]
+        lines += [f'receipt_pipeline_stage_errors_total{{stage="{stage}"}} {errors[stage]}' for stage, _ in histograms]
+
+        lines += [
+            '# HELP receipt_scans_total Receipt scans by outcome.',
+            '# TYPE receipt_scans_total counter',
+        ]
+        lines += [f'receipt_scans_total{{outcome="{outcome}"}} {count}' for outcome, count in outcomes]
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._started = time.time()
+            self._histograms.clear()
+            self._errors.clear()
+            self._outcomes.clear()
+
+
+class _Span:
+    """Handle yielded by PipelineMetrics.span; call fail() to count a non-raising failure."""
+
+    __slots__ = ('failed',)
+
+    def __init__(self):
+        self.failed = False
+
+    def fail(self):
+        self.failed = True
+
+
+def outcome_of(result: Dict) -> str:
+    """Short outcome label of a scan result dict."""
+    if result.get('success'):
+        return 'ok'
+    if result.get('already_scanned'):
+        return 'already_scanned'
+    if result.get('suf_unavailable'):
+        return 'suf_unavailable'
+    error = result.get('error', '')
+    if error.startswith('Invalid QR code'):
+        return 'invalid_qr'
+    if error.startswith('No items found'):
+        return 'no_items'
+    if error.startswith('Could not fetch'):
+        return 'fetch_failed'
+    return 'error'
+
+
+_metrics: Optional[PipelineMetrics] = None
+_metrics_lock = threading.Lock()
+
+
+def get_pipeline_metrics() -> PipelineMetrics:
+    """Process-wide pipeline metrics registry, created on first use."""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = PipelineMetrics()
+    return _metrics
@@ -0,0 +1,42 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:04
+
+import django.core.serializers.json
+import django.db.models.deletion
+import django.utils.timezone
+import transactions.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0005_transactionitem_review_notes_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptScanJob',
+            fields=[
+                ('id', models.CharField(default=transactions.models.generate_cuid, editable=False, max_length=30, primary_key=True, serialize=False)),
+                ('qr_data', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='pending', max_length=20)),
+                ('stage', models.CharField(choices=[('queued', 'Queued'), ('fetching', 'Fetching receipt'), ('matching', 'Matching products'), ('saving', 'Saving transaction'), ('done', 'Done')], default='queued', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('result', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='scan_jobs', to='transactions.transaction')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='receipt_scan_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'receipt_scan_jobs',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'available_at'], name='receipt_sca_status_dd733a_idx'), models.Index(fields=['user', '-created_at'], name='receipt_sca_user_id_a4f061_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:06
+
+import django.utils.timezone
+import transactions.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0006_receiptscanjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SUFReceiptCache',
+            fields=[
+                ('id', models.CharField(default=transactions.models.generate_cuid, editable=False, max_length=30, primary_key=True, serialize=False)),
+                ('url_hash', models.CharField(max_length=64, unique=True)),
+                ('invoice_number', models.CharField(blank=True, db_index=True, max_length=100, null=True)),
+                ('receipt_data', models.JSONField()),
+                ('store_info', models.JSONField(default=dict)),
+                ('size_bytes', models.IntegerField(default=0)),
+                ('hit_count', models.IntegerField(default=0, help_text='SUF round-trips saved by this entry')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_accessed_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'SUF Receipt Cache Entry',
+                'verbose_name_plural': 'SUF Receipt Cache',
+                'db_table': 'suf_receipt_cache',
+                'ordering': ['-last_accessed_at'],
+            },
+        ),
+    ]
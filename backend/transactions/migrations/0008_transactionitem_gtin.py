@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0007_sufreceiptcache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transactionitem',
+            name='gtin',
+            field=models.CharField(blank=True, max_length=14, null=True),
+        ),
+    ]
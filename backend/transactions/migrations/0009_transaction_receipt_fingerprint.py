@@ -0,0 +1,82 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:11
+
+import hashlib
+from urllib.parse import unquote, urlsplit, urlunsplit
+
+from django.db import migrations, models
+
+
+# Frozen copies of transactions.models.normalize_receipt_key / receipt_fingerprint
+# as of this migration, so later changes to the models cannot change its result
+
+def normalize_receipt_key(receipt_url):
+    parts = urlsplit(receipt_url.strip())
+    for param in parts.query.split('&'):
+        name, _, value = param.partition('=')
+        if name == 'vl' and value:
+            return unquote(value)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+
+def receipt_fingerprint(receipt_url):
+    return hashlib.sha256(normalize_receipt_key(receipt_url).encode('utf-8')).hexdigest()
+
+
+def backfill_fingerprints(apps, schema_editor):
+    """
+    Fingerprint existing scanned receipts. The oldest transaction keeps the
+    fingerprint when a user scanned the same receipt more than once before
+    duplicates were detected; later copies are left without one.
+    """
+    Transaction = apps.get_model('transactions', 'Transaction')
+
+    seen = set()
+    batch = []
+    queryset = (
+        Transaction.objects
+        .filter(receipt_url__isnull=False)
+        .exclude(receipt_url='')
+        .order_by('scanned_at', 'id')
+        .only('id', 'user_id', 'receipt_url')
+    )
+    for txn in queryset.iterator(chunk_size=2000):
+        fingerprint = receipt_fingerprint(txn.receipt_url)
+        if (txn.user_id, fingerprint) in seen:
+            continue
+        seen.add((txn.user_id, fingerprint))
+        txn.receipt_fingerprint = fingerprint
+        batch.append(txn)
+        if len(batch) >= 2000:
+            Transaction.objects.bulk_update(batch, ['receipt_fingerprint'])
+            batch = []
+    if batch:
+        Transaction.objects.bulk_update(batch, ['receipt_fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0008_transactionitem_gtin'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='receipt_fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='claimed_globally',
+            field=models.BooleanField(default=False, help_text="Claimed under the 'global' duplicate policy"),
+        ),
+        migrations.RunPython(backfill_fingerprints, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(fields=('user', 'receipt_fingerprint'), name='transactions_user_receipt_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(('claimed_globally', True)), fields=('receipt_fingerprint',), name='transactions_receipt_global_unique'),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 5.0.1 on 2026-10-18 03:22
+
+import json
+import zlib
+
+import django.db.models.deletion
+import transactions.models
+from django.db import migrations, models
+
+
+# Frozen copies of transactions.models.compress_receipt / decompress_receipt
+# as of this migration
+
+def compress_receipt(data):
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 6)
+
+
+def decompress_receipt(compressed_data):
+    return json.loads(zlib.decompress(bytes(compressed_data)).decode('utf-8'))
+
+
+def move_receipts_out(apps, schema_editor):
+    """Copy inline receipt JSON into compressed transaction_receipts rows."""
+    Transaction = apps.get_model('transactions', 'Transaction')
+    TransactionReceipt = apps.get_model('transactions', 'TransactionReceipt')
+
+    batch = []
+    queryset = Transaction.objects.filter(receipt_data__isnull=False).only('id', 'receipt_data')
+    for txn in queryset.iterator(chunk_size=1000):
+        batch.append(TransactionReceipt(
+            transaction_id=txn.id,
+            compressed_data=compress_receipt(txn.receipt_data),
+            size_bytes=len(json.dumps(txn.receipt_data, ensure_ascii=False).encode('utf-8'))
+        ))
+        if len(batch) >= 1000:
+            TransactionReceipt.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        TransactionReceipt.objects.bulk_create(batch)
+
+
+def move_receipts_back(apps, schema_editor):
+    Transaction = apps.get_model('transactions', 'Transaction')
+    TransactionReceipt = apps.get_model('transactions', 'TransactionReceipt')
+
+    batch = []
+    for receipt in TransactionReceipt.objects.iterator(chunk_size=1000):
+        batch.append(Transaction(id=receipt.transaction_id, receipt_data=decompress_receipt(receipt.compressed_data)))
+        if len(batch) >= 1000:
+            Transaction.objects.bulk_update(batch, ['receipt_data'])
+            batch = []
+    if batch:
+        Transaction.objects.bulk_update(batch, ['receipt_data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0009_transaction_receipt_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionReceipt',
+            fields=[
+                ('id', models.CharField(default=transactions.models.generate_cuid, editable=False, max_length=30, primary_key=True, serialize=False)),
+                ('compressed_data', models.BinaryField()),
+                ('size_bytes', models.IntegerField(default=0, help_text='Uncompressed JSON size')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('transaction', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='receipt', to='transactions.transaction')),
+            ],
+            options={
+                'db_table': 'transaction_receipts',
+            },
+        ),
+        migrations.RunPython(move_receipts_out, move_receipts_back),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='receipt_data',
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1 on 2026-10-18 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0010_transactionreceipt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receiptscanjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='receiptscanjob',
+            name='worker',
+            field=models.CharField(blank=True, help_text='Worker process running the job', max_length=100, null=True),
+        ),
+    ]
@@ -1,8 +1,14 @@
 from django.db import models
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 from products.models import Store, Product
+import hashlib
+import json
 import secrets
 import time
+import zlib
+from urllib.parse import unquote, urlsplit, urlunsplit
 
 
 def generate_cuid():
@@ -12,6 +18,31 @@ def generate_cuid():
     return f"c{timestamp}{random_part}"
 
 
+def normalize_receipt_key(receipt_url: str) -> str:
+    """
+    Stable identity of a fiscal receipt derived from its URL.
+    SUF verification URLs carry the signed invoice in the `vl` parameter, which
+    is used on its own; any other URL is used with scheme/host lower-cased and
+    the fragment dropped.
+    """
+    parts = urlsplit(receipt_url.strip())
+    for param in parts.query.split('&'):
+        name, _, value = param.partition('=')
+        if name == 'vl' and value:
+            # unquote (not unquote_plus): '+' is a valid base64 character
+            return unquote(value)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+
+def receipt_fingerprint(receipt_url: str) -> str:
+    """
+    Fixed-width (SHA-256 hex) duplicate-scan fingerprint of a receipt. It does
+    not depend on the duplicate policy: the policy is applied when looking it
+    up (the fingerprint alone for 'global', user and fingerprint for 'per_user').
+    """
+    return hashlib.sha256(normalize_receipt_key(receipt_url).encode('utf-8')).hexdigest()
+
+
 class Transaction(models.Model):
     """Transaction model (purchase/scan history) matching Prisma schema."""
 
@@ -31,7 +62,8 @@ class Transaction(models.Model):
     total_points = models.IntegerField()
     total_amount = models.FloatField(null=True, blank=True)  # Total purchase amount in RSD
     receipt_url = models.URLField(max_length=2000, null=True, blank=True)  # Serbian fiscal URLs can be very long
-    receipt_data = models.JSONField(null=True, blank=True)
+    receipt_fingerprint = models.CharField(max_length=64, null=True, blank=True, db_index=True)  # See receipt_fingerprint()
+    claimed_globally = models.BooleanField(default=False, help_text="Claimed under the 'global' duplicate policy")
     scanned_at = models.DateTimeField(auto_now_add=True, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -43,10 +75,75 @@ class Transaction(models.Model):
             models.Index(fields=['store']),
             models.Index(fields=['scanned_at']),
         ]
+        constraints = [
+            # A user can claim a receipt once under either duplicate policy
+            models.UniqueConstraint(
+                fields=['user', 'receipt_fingerprint'], name='transactions_user_receipt_unique'
+            ),
+            # ...and once in total while the 'global' policy is on
+            models.UniqueConstraint(
+                fields=['receipt_fingerprint'],
+                condition=models.Q(claimed_globally=True),
+                name='transactions_receipt_global_unique'
+            ),
+        ]
 
     def __str__(self):
         return f"Transaction {self.id[:8]} - {self.user.email} - {self.total_points} points"
 
+    @property
+    def receipt_data(self):
+        """Raw SUF receipt JSON, loaded (one query unless select_related) and decompressed on access."""
+        try:
+            return self.receipt.data
+        except TransactionReceipt.DoesNotExist:
+            return None
+
+
+def compress_receipt(data) -> bytes:
+    """zlib-compressed compact JSON, as stored in TransactionReceipt.compressed_data."""
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), 6)
+
+
+def decompress_receipt(compressed_data) -> dict:
+    return json.loads(zlib.decompress(bytes(compressed_data)).decode('utf-8'))
+
+
+class TransactionReceipt(models.Model):
+    """
+    Raw SUF receipt payload of a transaction, kept out of the transactions table.
+    Stored zlib-compressed and only read when explicitly requested.
+    """
+
+    id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
+    transaction = models.OneToOneField(
+        Transaction,
+        on_delete=models.CASCADE,
+        related_name='receipt'
+    )
+    compressed_data = models.BinaryField()
+    size_bytes = models.IntegerField(default=0, help_text="Uncompressed JSON size")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'transaction_receipts'
+
+    def __str__(self):
+        return f"Receipt for transaction {self.transaction_id[:8]}"
+
+    @classmethod
+    def build(cls, transaction: Transaction, data) -> 'TransactionReceipt':
+        compressed_data = compress_receipt(data)
+        return cls(
+            transaction=transaction,
+            compressed_data=compressed_data,
+            size_bytes=len(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        )
+
+    @property
+    def data(self):
+        return decompress_receipt(self.compressed_data)
+
 
 class TransactionItem(models.Model):
     """Individual products in a receipt matching Prisma schema."""
@@ -66,6 +163,7 @@ class TransactionItem(models.Model):
         blank=True
     )
     product_name = models.CharField(max_length=255)
+    gtin = models.CharField(max_length=14, null=True, blank=True)  # Barcode from the SUF receipt line
     quantity = models.IntegerField(default=1)
     price = models.FloatField(null=True, blank=True)  # Total price for this line item
     unit_price = models.FloatField(null=True, blank=True)  # Price per unit
@@ -97,3 +195,95 @@ class TransactionItem(models.Model):
 
     def __str__(self):
         return f"{self.product_name} x{self.quantity} ({self.points} points)"
+
+
+class ReceiptScanJob(models.Model):
+    """
+    Pending receipt scan processed in the background.
+
+    The table doubles as the job queue: workers claim pending rows with
+    SELECT ... FOR UPDATE SKIP LOCKED, so no external broker is needed.
+    """
+
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    STAGE_CHOICES = [
+        ('queued', 'Queued'),
+        ('fetching', 'Fetching receipt'),
+        ('matching', 'Matching products'),
+        ('saving', 'Saving transaction'),
+        ('done', 'Done'),
+    ]
+
+    id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='receipt_scan_jobs'
+    )
+    qr_data = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    stage = models.CharField(max_length=20, choices=STAGE_CHOICES, default='queued')
+    attempts = models.IntegerField(default=0)
+    result = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(null=True, blank=True)
+    transaction = models.ForeignKey(
+        Transaction,
+        on_delete=models.SET_NULL,
+        related_name='scan_jobs',
+        null=True,
+        blank=True
+    )
+    available_at = models.DateTimeField(default=timezone.now)  # Not claimable before this time (retry backoff)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    worker = models.CharField(max_length=100, null=True, blank=True, help_text="Worker process running the job")
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Refreshed by its worker while the job runs
+
+    class Meta:
+        db_table = 'receipt_scan_jobs'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'available_at']),
+            models.Index(fields=['user', '-created_at']),
+        ]
+
+    def __str__(self):
+        return f"Scan job {self.id[:8]} - {self.status} ({self.stage})"
+
+
+class SUFReceiptCache(models.Model):
+    """
+    Cached SUF responses for a fiscal receipt.
+
+    Fiscal receipts never change once issued, so the parsed /specifications
+    payload and store info are kept here and reused on retries, duplicate scans
+    and re-processing. Entries are keyed by a SHA-256 of the receipt URL and
+    also looked up by invoice number; least recently used entries are evicted
+    once the configured size bound is exceeded.
+    """
+
+    id = models.CharField(max_length=30, primary_key=True, default=generate_cuid, editable=False)
+    url_hash = models.CharField(max_length=64, unique=True)
+    invoice_number = models.CharField(max_length=100, null=True, blank=True, db_index=True)
+    receipt_data = models.JSONField()
+    store_info = models.JSONField(default=dict)
+    size_bytes = models.IntegerField(default=0)
+    hit_count = models.IntegerField(default=0, help_text="SUF round-trips saved by this entry")
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_accessed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        db_table = 'suf_receipt_cache'
+        verbose_name = 'SUF Receipt Cache Entry'
+        verbose_name_plural = 'SUF Receipt Cache'
+        ordering = ['-last_accessed_at']
+
+    def __str__(self):
+        return f"{self.invoice_number or self.url_hash[:12]} ({self.hit_count} hits)"
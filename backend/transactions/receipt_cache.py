@@ -0,0 +1,183 @@
+"""
+Persistent, size-bounded cache of SUF receipt responses.
+
+Fiscal receipts are immutable once issued, so a receipt fetched once never has
+to be fetched from SUF again. Entries live in the suf_receipt_cache table and
+are found either by the hash of the receipt URL (before any SUF traffic) or by
+the invoice number (after the receipt page has been read).
+"""
+import hashlib
+import json
+import threading
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import SUFReceiptCache, normalize_receipt_key
+
+
+DEFAULT_RECEIPT_CACHE_SETTINGS = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 50000,
+    'MAX_BYTES': 500 * 1024 * 1024,
+    'EVICT_BATCH': 500,
+    # put() runs evict() on every EVICT_EVERY-th entry it stores (per process);
+    # 0 leaves eviction to the evict_receipt_cache command
+    'EVICT_EVERY': 100,
+}
+
+
+class ReceiptCache:
+    """Read-through cache for SUF receipts with process-wide hit/miss counters."""
+
+    _lock = threading.Lock()
+    _counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+    @staticmethod
+    def config() -> Dict:
+        config = dict(DEFAULT_RECEIPT_CACHE_SETTINGS)
+        config.update(getattr(settings, 'SUF_RECEIPT_CACHE', {}))
+        return config
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls.config()['ENABLED']
+
+    @staticmethod
+    def url_hash(receipt_url: str) -> str:
+        """
+        SHA-256 of the receipt's normalized key (see normalize_receipt_key), so every
+        URL form of one signed receipt finds the same entry before any SUF traffic.
+        """
+        return hashlib.sha256(normalize_receipt_key(receipt_url).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _count(cls, counter: str, amount: int = 1):
+        with cls._lock:
+            cls._counters[counter] += amount
+
+    @classmethod
+    def _touch(cls, entry: SUFReceiptCache):
+        SUFReceiptCache.objects.filter(pk=entry.pk).update(
+            hit_count=F('hit_count') + 1,
+            last_accessed_at=timezone.now()
+        )
+
+    @classmethod
+    def get(cls, receipt_url: Optional[str] = None, invoice_number: Optional[str] = None,
+            count_miss: bool = True) -> Optional[SUFReceiptCache]:
+        """
+        Look up a cached receipt by URL and/or invoice number.
+        A hit refreshes the entry's LRU timestamp and bumps its hit counter.
+        """
+        if not cls.enabled():
+            return None
+
+        entry = None
+        if receipt_url:
+            entry = SUFReceiptCache.objects.filter(url_hash=cls.url_hash(receipt_url)).first()
+        if entry is None and invoice_number:
+            entry = SUFReceiptCache.objects.filter(invoice_number=invoice_number).first()
+
+        if entry is None:
+            if count_miss:
+                cls._count('misses')
+            return None
+
+        cls._count('hits')
+        cls._touch(entry)
+        return entry
+
+    @classmethod
+    def put(cls, receipt_url: str, receipt_data: Dict, store_info: Dict,
+            invoice_number: Optional[str] = None) -> Optional[SUFReceiptCache]:
+        """
+        Store a successfully fetched receipt. Every EVICT_EVERY-th store evicts old
+        entries if over the size bound, so the cache can exceed it by that many
+        entries per process in between.
+        """
+        if not cls.enabled():
+            return None
+
+        size_bytes = len(json.dumps(receipt_data, ensure_ascii=False).encode('utf-8'))
+        try:
+            entry, _ = SUFReceiptCache.objects.update_or_create(
+                url_hash=cls.url_hash(receipt_url),
+                defaults={
+                    'invoice_number': invoice_number,
+                    'receipt_data': receipt_data,
+                    'store_info': store_info,
+                    'size_bytes': size_bytes,
+                    'last_accessed_at': timezone.now(),
+                }
+            )
+        except IntegrityError:
+            # Another worker cached the same receipt concurrently
+            return None
+
+        if cls._count_store():
+            cls.evict()
+        return entry
+
+    @classmethod
+    def _count_store(cls) -> bool:
+        """Count a stored entry; True when eviction is due."""
+        every = cls.config()['EVICT_EVERY']
+        with cls._lock:
+            cls._counters['stores'] += 1
+            return bool(every) and cls._counters['stores'] % every == 0
+
+    @classmethod
+    def evict(cls) -> int:
+        """Delete least recently used entries until the cache is within MAX_ENTRIES and MAX_BYTES."""
+        config = cls.config()
+        evicted = 0
+
+        while True:
+            totals = SUFReceiptCache.objects.aggregate(entries=Count('id'), size=Sum('size_bytes'))
+            entries, size = totals['entries'], totals['size'] or 0
+            if entries <= config['MAX_ENTRIES'] and size <= config['MAX_BYTES']:
+                break
+
+            batch = max(entries - config['MAX_ENTRIES'], 0) or config['EVICT_BATCH']
+            oldest = list(
+                SUFReceiptCache.objects.order_by('last_accessed_at')
+                .values_list('pk', flat=True)[:min(batch, config['EVICT_BATCH'])]
+            )
+            if not oldest:
+                break
+            deleted, _ = SUFReceiptCache.objects.filter(pk__in=oldest).delete()
+            evicted += deleted
+
+        if evicted:
+            cls._count('evictions', evicted)
+        return evicted
+
+    @classmethod
+    def stats(cls) -> Dict:
+        """Hit/miss counters for this process plus totals stored in the cache table."""
+        with cls._lock:
+            counters = dict(cls._counters)
+
+        lookups = counters['hits'] + counters['misses']
+        totals = SUFReceiptCache.objects.aggregate(
+            entries=Count('id'),
+            size_bytes=Sum('size_bytes'),
+            saved_fetches=Sum('hit_count')
+        )
+        return {
+            **counters,
+            'hit_ratio': round(counters['hits'] / lookups, 4) if lookups else 0.0,
+            'entries': totals['entries'],
+            'size_bytes': totals['size_bytes'] or 0,
+            'saved_fetches': totals['saved_fetches'] or 0,
+        }
+
+    @classmethod
+    def reset_counters(cls):
+        with cls._lock:
+            for key in cls._counters:
+                cls._counters[key] = 0
@@ -1,5 +1,6 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import Transaction, TransactionItem
+from .models import Transaction, TransactionItem, ReceiptScanJob
 from products.serializers import StoreSerializer
 
 
@@ -9,7 +10,7 @@ class TransactionItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = TransactionItem
         fields = [
-            'id', 'product_id', 'product_name', 'quantity',
+            'id', 'product_id', 'product_name', 'gtin', 'quantity',
             'price', 'unit_price', 'points', 'matched',
             'review_status', 'review_requested_at', 'review_notes'
         ]
@@ -17,7 +18,12 @@ class TransactionItemSerializer(serializers.ModelSerializer):
 
 
 class TransactionSerializer(serializers.ModelSerializer):
-    """Serializer for Transaction model."""
+    """
+    Serializer for Transaction model.
+
+    The raw SUF receipt (`receipt_data`) is only included when the serializer
+    context has `include_receipt` set (see TransactionViewSet.retrieve).
+    """
 
     items = TransactionItemSerializer(many=True, read_only=True)
     store = StoreSerializer(read_only=True)
@@ -26,10 +32,16 @@ class TransactionSerializer(serializers.ModelSerializer):
         model = Transaction
         fields = [
             'id', 'store', 'total_points', 'total_amount', 'receipt_url',
-            'receipt_data', 'scanned_at', 'created_at', 'items'
+            'scanned_at', 'created_at', 'items'
         ]
         read_only_fields = ['id', 'scanned_at', 'created_at']
 
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if self.context.get('include_receipt'):
+            data['receipt_data'] = instance.receipt_data
+        return data
+
 
 class ReceiptScanSerializer(serializers.Serializer):
     """Serializer for receipt scanning input."""
@@ -38,6 +50,22 @@ class ReceiptScanSerializer(serializers.Serializer):
         required=True,
         help_text="QR code data from fiscal receipt (URL or raw QR string)"
     )
+    async_processing = serializers.BooleanField(
+        required=False,
+        help_text="Queue the scan and return 202 with a job id instead of waiting for SUF "
+                  "(defaults to the RECEIPT_SCAN_ASYNC setting)"
+    )
+
+
+class ReceiptBatchScanSerializer(serializers.Serializer):
+    """Serializer for batch receipt scanning input."""
+
+    qr_data = serializers.ListField(
+        child=serializers.CharField(),
+        allow_empty=False,
+        max_length=getattr(settings, 'RECEIPT_BATCH_MAX_SIZE', 20),
+        help_text="QR code data of each receipt (URL or raw QR string)"
+    )
 
 
 class ReceiptScanResponseSerializer(serializers.Serializer):
@@ -50,3 +78,26 @@ class ReceiptScanResponseSerializer(serializers.Serializer):
     items = serializers.ListField(required=False)
     unmatched_items = serializers.ListField(required=False)
     error = serializers.CharField(required=False)
+
+
+class ReceiptBatchScanResponseSerializer(serializers.Serializer):
+    """Serializer for batch receipt scanning response."""
+
+    results = ReceiptScanResponseSerializer(many=True)
+    succeeded = serializers.IntegerField()
+    failed = serializers.IntegerField()
+    total_points = serializers.IntegerField()
+
+
+class ReceiptScanJobSerializer(serializers.ModelSerializer):
+    """Serializer for asynchronous receipt scan job status."""
+
+    job_id = serializers.CharField(source='id', read_only=True)
+
+    class Meta:
+        model = ReceiptScanJob
+        fields = [
+            'job_id', 'status', 'stage', 'attempts', 'transaction_id',
+            'result', 'error', 'created_at', 'started_at', 'finished_at'
+        ]
+        read_only_fields = fields
@@ -2,10 +2,196 @@
 Service for processing Serbian fiscal receipts.
 Integrates with Serbian Tax Authority (SUF) system.
 """
+import logging
+import math
 import re
+import time
 import requests
-from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from typing import Callable, Dict, List, Optional, Tuple
 from django.conf import settings
+from django.db import IntegrityError, transaction as db_transaction
+from django.db.models import F
+
+from products.matching import get_product_matcher, normalize_gtin, normalize_product_name
+from products.stores import StoreResolver, split_shop_code
+from .metrics import get_pipeline_metrics
+from .receipt_cache import ReceiptCache
+from .suf_client import get_suf_client
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiptPage:
+    """
+    A SUF receipt HTML page, fetched and parsed once per scan.
+
+    Fields are read by a fast path first: one regex scan of the raw HTML for
+    the viewModel.InvoiceNumber()/viewModel.Token() calls and one lxml parse
+    for the labelled elements. The BeautifulSoup strategies are only run
+    (lazily, once per page) for fields the fast path could not find.
+    """
+
+    UNKNOWN_STORE = {
+        'name': 'Unknown Store',
+        'location': '',
+        'tin': '',
+        'shop_code': '',
+    }
+
+    LABEL_IDS = ('invoiceNumberLabel', 'tinLabel', 'shopFullNameLabel', 'addressLabel', 'cityLabel')
+
+    _VIEW_MODEL_RE = re.compile(r'viewModel\.(InvoiceNumber|Token)\(["\']([^"\']+)["\']\)')
+    _LABEL_XPATH = '//*[' + ' or '.join(f'@id="{label_id}"' for label_id in LABEL_IDS) + ']'
+
+    def __init__(self, url: str, html: str):
+        self.url = url
+        self.html = html
+
+    @cached_property
+    def fast_fields(self) -> Dict[str, str]:
+        """
+        Fields found by the fast path, keyed 'InvoiceNumber', 'Token' and the
+        LABEL_IDS. Missing keys were not found (or the page did not parse).
+        """
+        fields = {}
+        for name, value in self._VIEW_MODEL_RE.findall(self.html):
+            fields.setdefault(name, value)
+
+        import lxml.html
+        from lxml import etree
+        try:
+            root = lxml.html.document_fromstring(
+                self.html.encode('utf-8'),
+                parser=lxml.html.HTMLParser(encoding='utf-8')
+            )
+        except (etree.ParserError, ValueError):
+            return fields
+
+        for elem in root.xpath(self._LABEL_XPATH):
+            # Same text as BeautifulSoup's get_text(strip=True)
+            fields.setdefault(elem.get('id'), ''.join(text.strip() for text in elem.itertext()))
+        return fields
+
+    @cached_property
+    def soup(self):
+        """Parsed HTML tree (built on first access)."""
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(self.html, 'lxml')
+
+    @cached_property
+    def _script_bodies(self) -> List[str]:
+        """Text of all inline scripts, viewModel scripts (type="text/javascript") first."""
+        typed = [s.string for s in self.soup.find_all('script', type='text/javascript') if s.string]
+        others = [s.string for s in self.soup.find_all('script') if s.string and s.string not in typed]
+        return typed + others
+
+    def _label_text(self, element_id: str) -> str:
+        elem = self.soup.find(id=element_id)
+        return elem.get_text(strip=True) if elem else ''
+
+    def _soup_invoice_number(self) -> Optional[str]:
+        # Method 1: viewModel.InvoiceNumber('M4XG7WCS-M4XG7WCS-56123')
+        for body in self._script_bodies:
+            match = re.search(r'viewModel\.InvoiceNumber\(["\']([^"\']+)["\']\)', body)
+            if match:
+                return match.group(1)
+
+        # Method 2: element with id="invoiceNumberLabel"
+        label = self._label_text('invoiceNumberLabel')
+        if label:
+            return label
+
+        # Method 3: fallback - any invoiceNumber pattern
+        for body in self._script_bodies:
+            match = re.search(r'invoiceNumber["\']?\s*[:=]\s*["\']([^"\']+)', body, re.IGNORECASE)
+            if match:
+                return match.group(1)
+
+        return None
+
+    def _soup_token(self) -> Optional[str]:
+        # Method 1: viewModel.Token('8e9b6f78-3747-4929-ad10-0f3fe5391755')
+        for body in self._script_bodies:
+            match = re.search(r'viewModel\.Token\(["\']([^"\']+)["\']\)', body)
+            if match:
+                return match.group(1)
+
+        # Method 2: fallback - any token pattern
+        for body in self._script_bodies:
+            match = re.search(r'token["\']?\s*[:=]\s*["\']([a-f0-9\-]{36})', body, re.IGNORECASE)
+            if match:
+                return match.group(1)
+
+        return None
+
+    @cached_property
+    def soup_fields(self) -> Dict[str, str]:
+        """
+        Fields found by the BeautifulSoup strategies (the fallback path),
+        keyed like fast_fields.
+        """
+        fields = {
+            'InvoiceNumber': self._soup_invoice_number(),
+            'Token': self._soup_token(),
+        }
+        for label_id in self.LABEL_IDS:
+            fields[label_id] = self._label_text(label_id)
+        return {key: value for key, value in fields.items() if value}
+
+    @cached_property
+    def invoice_number(self) -> Optional[str]:
+        """Invoice number from viewModel.InvoiceNumber(), the invoiceNumberLabel element, or any invoiceNumber assignment."""
+        fast = self.fast_fields
+        return fast.get('InvoiceNumber') or fast.get('invoiceNumberLabel') or self.soup_fields.get('InvoiceNumber')
+
+    @cached_property
+    def token(self) -> Optional[str]:
+        """Token from viewModel.Token(), or any UUID-shaped token assignment."""
+        return self.fast_fields.get('Token') or self.soup_fields.get('Token')
+
+    @property
+    def invoice_params(self) -> Optional[Dict]:
+        """Form data for the /specifications endpoint, or None if either value is missing."""
+        if self.invoice_number and self.token:
+            return {
+                'invoiceNumber': self.invoice_number,
+                'token': self.token
+            }
+
+        logger.warning(
+            'Could not extract invoice parameters from %s (invoice number found: %s, token found: %s)',
+            self.url, self.invoice_number is not None, self.token is not None
+        )
+        return None
+
+    @cached_property
+    def store_info(self) -> Dict:
+        """Store name, location and PIB (tax ID) from the labelled elements of the page."""
+        try:
+            # The store block is present on every receipt page; if the fast path
+            # missed it, fall back to BeautifulSoup
+            fields = self.fast_fields if 'shopFullNameLabel' in self.fast_fields else self.soup_fields
+            tin = fields.get('tinLabel', '')
+            shop_name = fields.get('shopFullNameLabel') or 'Unknown Store'
+            address = fields.get('addressLabel', '')
+            city = fields.get('cityLabel', '')
+        except Exception:
+            logger.exception('Error extracting store info from %s', self.url)
+            return dict(self.UNKNOWN_STORE)
+
+        # Combine address and city for location
+        location = f"{address}, {city}" if address and city else address or city
+
+        logger.debug('Extracted store info - name: %s, TIN: %s, location: %s', shop_name, tin, location)
+
+        return {
+            'name': shop_name,
+            'location': location,
+            'tin': tin,
+            'shop_code': split_shop_code(shop_name)[0],
+        }
 
 
 class ReceiptProcessingService:
@@ -13,6 +199,11 @@ class ReceiptProcessingService:
 
     SUF_BASE_URL = "https://suf.purs.gov.rs"
 
+    @staticmethod
+    def get_client():
+        """Shared, connection-pooled SUF client (see suf_client.py)."""
+        return get_suf_client()
+
     @staticmethod
     def extract_url_from_qr(qr_data: str) -> Optional[str]:
         """
@@ -32,7 +223,32 @@ class ReceiptProcessingService:
         return None
 
     @staticmethod
-    def extract_invoice_params(receipt_url: str) -> Optional[Dict]:
+    def fetch_receipt_page(receipt_url: str) -> Optional['ReceiptPage']:
+        """
+        Download the SUF receipt page once and wrap it in a ReceiptPage.
+        The returned page is reused by every later stage of the pipeline
+        (invoice parameters, store info) so the HTML is fetched and parsed once per scan;
+        it is parsed here, in its own timed stage.
+        """
+        metrics = get_pipeline_metrics()
+        try:
+            client = ReceiptProcessingService.get_client()
+            with metrics.span('fetch_page'):
+                response = client.get(client.resolve_url(receipt_url))
+                response.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning('Error fetching receipt page: %s', e)
+            return None
+
+        page = ReceiptPage(receipt_url, response.text)
+        with metrics.span('parse'):
+            page.invoice_number
+            page.token
+            page.store_info
+        return page
+
+    @staticmethod
+    def extract_invoice_params(receipt_url: str, page: Optional['ReceiptPage'] = None) -> Optional[Dict]:
         """
         Extract invoice number and token from the receipt URL.
         The HTML page contains these in JavaScript within script tags:
@@ -40,115 +256,101 @@ class ReceiptProcessingService:
         - viewModel.Token('8e9b6f78-3747-4929-ad10-0f3fe5391755')
 
         Invoice number can also be found in element with id="invoiceNumberLabel"
+
+        Pass an already fetched `page` to avoid downloading the receipt page again.
         """
-        try:
-            from bs4 import BeautifulSoup
-            import re
+        if page is None:
+            page = ReceiptProcessingService.fetch_receipt_page(receipt_url)
+            if page is None:
+                return None
 
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+        return page.invoice_params
+
+    @staticmethod
+    def fetch_receipt(receipt_url: str, page: Optional['ReceiptPage'] = None) -> Optional[Dict]:
+        """
+        Fetch a receipt's specifications and store info, reading through the SUF receipt cache.
+
+        Returns a dict with 'receipt_data', 'store_info', 'invoice_number' and
+        'cached' (True when no SUF call was needed), or None on failure.
+        The cache is checked by URL hash before any SUF traffic, and by invoice
+        number only once the receipt page has been read (so a hit on the invoice
+        number alone still costs one page download); successful responses are cached.
+        """
+        entry = ReceiptCache.get(receipt_url=receipt_url, count_miss=False)
+
+        if entry is None:
+            if page is None:
+                page = ReceiptProcessingService.fetch_receipt_page(receipt_url)
+                if page is None:
+                    return None
+            entry = ReceiptCache.get(invoice_number=page.invoice_number)
+
+        if entry is not None:
+            return {
+                'receipt_data': entry.receipt_data,
+                'store_info': entry.store_info,
+                'invoice_number': entry.invoice_number,
+                'cached': True,
             }
-            response = requests.get(receipt_url, headers=headers, timeout=10)
-            response.raise_for_status()
-
-            soup = BeautifulSoup(response.text, 'lxml')
-
-            invoice_number = None
-            token = None
-
-            # Method 1: Look for viewModel.InvoiceNumber() and viewModel.Token() in script tags
-            scripts = soup.find_all('script', type='text/javascript')
-            for script in scripts:
-                if script.string:
-                    # Match: viewModel.InvoiceNumber('M4XG7WCS-M4XG7WCS-56123')
-                    inv_match = re.search(r'viewModel\.InvoiceNumber\(["\']([^"\']+)["\']\)', script.string)
-                    if inv_match:
-                        invoice_number = inv_match.group(1)
-                        print(f"Found invoice number in viewModel: {invoice_number}")
-
-                    # Match: viewModel.Token('8e9b6f78-3747-4929-ad10-0f3fe5391755')
-                    token_match = re.search(r'viewModel\.Token\(["\']([^"\']+)["\']\)', script.string)
-                    if token_match:
-                        token = token_match.group(1)
-                        print(f"Found token in viewModel: {token[:20]}...")
-
-                    # Break if both found
-                    if invoice_number and token:
-                        break
-
-            # Method 2: Look for invoice number in element with id="invoiceNumberLabel"
-            if not invoice_number:
-                inv_label = soup.find(id='invoiceNumberLabel')
-                if inv_label:
-                    invoice_number = inv_label.get_text(strip=True)
-                    print(f"Found invoice number in label: {invoice_number}")
-
-            # Method 3: Fallback - look for any invoiceNumber patterns
-            if not invoice_number:
-                all_scripts = soup.find_all('script')
-                for script in all_scripts:
-                    if script.string:
-                        inv_match = re.search(r'invoiceNumber["\']?\s*[:=]\s*["\']([^"\']+)', script.string, re.IGNORECASE)
-                        if inv_match:
-                            invoice_number = inv_match.group(1)
-                            print(f"Found invoice number (fallback): {invoice_number}")
-                            break
-
-            # Method 4: Fallback - look for any token patterns
-            if not token:
-                all_scripts = soup.find_all('script')
-                for script in all_scripts:
-                    if script.string:
-                        token_match = re.search(r'token["\']?\s*[:=]\s*["\']([a-f0-9\-]{36})', script.string, re.IGNORECASE)
-                        if token_match:
-                            token = token_match.group(1)
-                            print(f"Found token (fallback): {token[:20]}...")
-                            break
-
-            if invoice_number and token:
-                print(f"Successfully extracted invoice params - Number: {invoice_number}, Token: {token[:20]}...")
-                return {
-                    'invoiceNumber': invoice_number,
-                    'token': token
-                }
 
-            print(f"Could not extract invoice parameters from HTML")
-            print(f"Invoice number found: {invoice_number is not None}")
-            print(f"Token found: {token is not None}")
+        receipt_data = ReceiptProcessingService._post_specifications(receipt_url, page)
+        if not receipt_data:
             return None
 
-        except Exception as e:
-            print(f"Error extracting invoice params: {e}")
-            import traceback
-            traceback.print_exc()
-            return None
+        return ReceiptProcessingService._store_fetched(receipt_url, page, receipt_data)
 
     @staticmethod
-    def fetch_receipt_data(receipt_url: str) -> Optional[Dict]:
+    def _store_fetched(receipt_url: str, page: 'ReceiptPage', receipt_data: Dict) -> Dict:
+        """Cache a freshly fetched receipt (if SUF reported success) and wrap it like fetch_receipt."""
+        if receipt_data.get('success'):
+            ReceiptCache.put(
+                receipt_url,
+                receipt_data,
+                page.store_info,
+                invoice_number=page.invoice_number
+            )
+
+        return {
+            'receipt_data': receipt_data,
+            'store_info': page.store_info,
+            'invoice_number': page.invoice_number,
+            'cached': False,
+        }
+
+    @staticmethod
+    def fetch_receipt_data(receipt_url: str, page: Optional['ReceiptPage'] = None) -> Optional[Dict]:
         """
         Fetch receipt data from Serbian fiscal system.
 
         The SUF system requires a two-step process:
         1. GET the receipt page to extract invoiceNumber and token
         2. POST to /specifications endpoint with these parameters
+
+        When `page` is given, step 1 reuses it instead of downloading the page again.
+        Reads through the SUF receipt cache (see fetch_receipt).
         """
+        fetched = ReceiptProcessingService.fetch_receipt(receipt_url, page=page)
+        return fetched['receipt_data'] if fetched else None
+
+    @staticmethod
+    def _post_specifications(receipt_url: str, page: 'ReceiptPage') -> Optional[Dict]:
+        """POST the invoice parameters of `page` to the SUF /specifications endpoint."""
         try:
-            # Step 1: Extract invoice parameters from the receipt page
-            params = ReceiptProcessingService.extract_invoice_params(receipt_url)
+            params = page.invoice_params
             if not params:
-                print("Failed to extract invoice parameters from receipt URL")
                 return None
 
-            # Step 2: POST to specifications endpoint
-            specifications_url = "https://suf.purs.gov.rs/specifications"
+            # POST to specifications endpoint
+            client = ReceiptProcessingService.get_client()
+            specifications_url = client.url('/specifications')
 
             headers = {
                 'Accept': '*/*',
                 'Accept-Language': 'en-US,en;q=0.9',
                 'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
-                'Origin': 'https://suf.purs.gov.rs',
+                'Origin': client.base_url,
                 'Referer': receipt_url,
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
                 'X-Requested-With': 'XMLHttpRequest'
             }
 
@@ -158,28 +360,28 @@ class ReceiptProcessingService:
                 'token': params['token']
             }
 
-            print(f"Posting to specifications endpoint...")
-            response = requests.post(
-                specifications_url,
-                headers=headers,
-                data=form_data,
-                timeout=10
-            )
-            response.raise_for_status()
+            with get_pipeline_metrics().span('fetch_specifications'):
+                response = client.post(
+                    specifications_url,
+                    headers=headers,
+                    data=form_data
+                )
+                response.raise_for_status()
 
-            print(f"Specifications response status: {response.status_code}")
-            print(f"Response content type: {response.headers.get('Content-Type')}")
-            print(f"Response preview: {response.text[:500]}")
+                logger.debug(
+                    'Specifications response: status %s, content type %s',
+                    response.status_code, response.headers.get('Content-Type')
+                )
 
-            # Parse JSON response
-            receipt_data = response.json()
+                # Parse JSON response
+                receipt_data = response.json()
             return receipt_data
 
         except requests.RequestException as e:
-            print(f"Error fetching receipt data: {e}")
+            logger.warning('Error fetching receipt data: %s', e)
             return None
         except ValueError as e:
-            print(f"Error parsing JSON response: {e}")
+            logger.warning('Error parsing specifications JSON response: %s', e)
             return None
 
     @staticmethod
@@ -209,13 +411,15 @@ class ReceiptProcessingService:
 
         # Check if the response is successful
         if not receipt_data.get('success'):
-            print(f"Receipt data success=False: {receipt_data}")
+            logger.warning('SUF returned success=false for the receipt specifications')
+            logger.debug('Unsuccessful specifications response: %s', receipt_data)
             return items
 
         # Get items array from the response
         raw_items = receipt_data.get('items', [])
-
-        print(f"Parsing {len(raw_items)} items from receipt data")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug('Parsing %d items from receipt data', len(raw_items))
 
         for item in raw_items:
             parsed_item = {
@@ -225,13 +429,17 @@ class ReceiptProcessingService:
                 'unit_price': float(item.get('unitPrice', 0.0)),  # Price per unit
                 'gtin': item.get('gtin', ''),  # Barcode/GTIN
             }
-            print(f"  - {parsed_item['name']}: {parsed_item['quantity']}x @ {parsed_item['unit_price']} = {parsed_item['total']}")
+            if debug:
+                logger.debug(
+                    '  - %s: %sx @ %s = %s',
+                    parsed_item['name'], parsed_item['quantity'], parsed_item['unit_price'], parsed_item['total']
+                )
             items.append(parsed_item)
 
         return items
 
     @staticmethod
-    def extract_store_info(receipt_url: str) -> Dict:
+    def extract_store_info(receipt_url: str, page: Optional['ReceiptPage'] = None) -> Dict:
         """
         Extract store information from the SUF receipt HTML page.
         Store info is in HTML elements with specific IDs:
@@ -239,100 +447,267 @@ class ReceiptProcessingService:
         - shopFullNameLabel: Store name
         - addressLabel: Address
         - cityLabel: City
+
+        Pass an already fetched `page` to avoid downloading the receipt page again.
         """
-        try:
-            from bs4 import BeautifulSoup
+        if page is None:
+            page = ReceiptProcessingService.fetch_receipt_page(receipt_url)
+            if page is None:
+                return dict(ReceiptPage.UNKNOWN_STORE)
 
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-            response = requests.get(receipt_url, headers=headers, timeout=10)
-            response.raise_for_status()
+        return page.store_info
 
-            soup = BeautifulSoup(response.text, 'lxml')
+    @staticmethod
+    def match_product_by_name(product_name: str, products_db=None, matcher=None) -> Tuple[Optional[object], int]:
+        """
+        Match a product from receipt with products in database or previously approved items.
+        Returns (matched_product, points) or (None, 0).
+        Uses the configured product matcher backend (exact, substring, then
+        fuzzy matching); see products/matching.py. `products_db` is accepted for backwards
+        compatibility only - matching always runs against the ACTIVE catalog.
+        Pass the `matcher` obtained once per receipt to skip the freshness check.
+        """
+        if matcher is None:
+            matcher = get_product_matcher()
+        return matcher.match(product_name)
 
-            # Extract PIB (Tax ID Number)
-            tin_elem = soup.find(id='tinLabel')
-            tin = tin_elem.get_text(strip=True) if tin_elem else ''
+    @classmethod
+    def match_receipt_items(cls, items: List[Dict], matcher=None, store=None) -> List[Tuple[Optional[object], int]]:
+        """
+        Match every line of a receipt, returning (matched_product, points) per line.
 
-            # Extract store name
-            shop_name_elem = soup.find(id='shopFullNameLabel')
-            shop_name = shop_name_elem.get_text(strip=True) if shop_name_elem else 'Unknown Store'
+        Resolution order, each step batched for the whole receipt:
+        1. GTIN barcode (one IN query)
+        2. learned alias from approved reviews, store-specific first (one IN query)
+        3. name matching for whatever is still unresolved
+        """
+        from products.models import ProductAlias, ProductBarcode
+        from django.db.models import Q
+
+        results = [(None, 0)] * len(items)
+
+        gtins = {normalize_gtin(item.get('gtin')) for item in items} - {None}
+        products_by_gtin = {}
+        if gtins:
+            barcodes = ProductBarcode.objects.filter(
+                gtin__in=gtins,
+                product__status='ACTIVE'
+            ).select_related('product')
+            products_by_gtin = {barcode.gtin: barcode.product for barcode in barcodes}
+
+        unresolved = []
+        for position, item in enumerate(items):
+            product = products_by_gtin.get(normalize_gtin(item.get('gtin')))
+            if product is not None:
+                results[position] = (product, product.points)
+            else:
+                unresolved.append(position)
+
+        if unresolved:
+            names = {normalize_product_name(items[position]['name']) for position in unresolved}
+            store_filter = Q(store__isnull=True)
+            if store is not None:
+                store_filter |= Q(store=store)
+            aliases = ProductAlias.objects.filter(
+                store_filter,
+                alias__in=names,
+                product__status='ACTIVE'
+            ).select_related('product')
+
+            # Global aliases first so store-specific ones overwrite them
+            products_by_alias = {}
+            for alias in sorted(aliases, key=lambda a: a.store_id is not None):
+                products_by_alias[alias.alias] = alias.product
+
+            still_unresolved = []
+            for position in unresolved:
+                product = products_by_alias.get(normalize_product_name(items[position]['name']))
+                if product is not None:
+                    results[position] = (product, product.points)
+                else:
+                    still_unresolved.append(position)
+            unresolved = still_unresolved
+
+        if unresolved:
+            if matcher is None:
+                matcher = get_product_matcher()
+
+            # Resolve the remaining lines by name in one batch (one query on the pg_trgm backend)
+            name_matches = matcher.match_names([items[position]['name'] for position in unresolved])
+            for position, match in zip(unresolved, name_matches):
+                results[position] = match
+
+        return results
 
-            # Extract address
-            address_elem = soup.find(id='addressLabel')
-            address = address_elem.get_text(strip=True) if address_elem else ''
+    @staticmethod
+    def duplicate_policy() -> str:
+        """'per_user' (default): a receipt can be scanned once per user; 'global': once in total."""
+        return getattr(settings, 'RECEIPT_DUPLICATE_POLICY', 'per_user')
 
-            # Extract city
-            city_elem = soup.find(id='cityLabel')
-            city = city_elem.get_text(strip=True) if city_elem else ''
+    @staticmethod
+    def receipt_fingerprint(receipt_url: str) -> str:
+        """Fingerprint of a receipt (the same under either duplicate policy)."""
+        from .models import receipt_fingerprint
+        return receipt_fingerprint(receipt_url)
 
-            # Combine address and city for location
-            location = f"{address}, {city}" if address and city else address or city
+    @classmethod
+    def claimed_receipts(cls, fingerprints, user):
+        """
+        Transactions that already claimed any of `fingerprints` under the duplicate
+        policy: by anyone for 'global', by `user` for 'per_user'. Oldest first.
+        """
+        from .models import Transaction
+        claimed = Transaction.objects.filter(receipt_fingerprint__in=fingerprints)
+        if cls.duplicate_policy() != 'global':
+            claimed = claimed.filter(user=user)
+        return claimed.only('id', 'user_id', 'scanned_at', 'total_points', 'receipt_fingerprint').order_by(
+            'scanned_at', 'id'
+        )
 
-            print(f"Extracted store info - Name: {shop_name}, TIN: {tin}, Location: {location}")
+    @classmethod
+    def find_duplicate(cls, fingerprint: str, user):
+        """Transaction that already claimed this receipt (indexed lookup), or None."""
+        return cls.claimed_receipts([fingerprint], user).first()
 
+    @classmethod
+    def claim_receipt(cls, fingerprint: str, user) -> bool:
+        """
+        Check, inside the transaction that saves a scan, that no other user claimed
+        the receipt under the 'global' policy; raises IntegrityError if one did.
+        Returns whether the scan is a global claim (Transaction.claimed_globally).
+
+        The database enforces both policies: the (user, fingerprint) unique
+        constraint covers each user's own scans, and the unique index on the
+        fingerprint of global claims makes a concurrent claim by another user fail.
+        This check covers receipts claimed before the policy was switched to 'global'.
+        """
+        if cls.duplicate_policy() != 'global':
+            return False
+        if cls.find_duplicate(fingerprint, user) is not None:
+            raise IntegrityError(f'Receipt {fingerprint} was already claimed')
+        return True
+
+    @staticmethod
+    def already_scanned_response(existing, user) -> Dict:
+        if existing.user_id != user.id:
             return {
-                'name': shop_name,
-                'location': location,
-                'tin': tin,
+                'success': False,
+                'error': 'This receipt has already been claimed by another user',
+                'already_scanned': True
             }
+        return {
+            'success': False,
+            'error': 'This receipt has already been scanned',
+            'already_scanned': True,
+            'scanned_at': existing.scanned_at.isoformat(),
+            'points_earned': existing.total_points
+        }
 
-        except Exception as e:
-            print(f"Error extracting store info: {e}")
+    @classmethod
+    def fetch_failed_response(cls) -> Dict:
+        """
+        Error result for a receipt that could not be fetched. While the SUF circuit
+        breaker is open the result says so, with the seconds until SUF is retried.
+        """
+        retry_after = cls.get_client().breaker.retry_after()
+        if retry_after:
             return {
-                'name': 'Unknown Store',
-                'location': '',
-                'tin': '',
+                'success': False,
+                'error': 'The fiscal system is temporarily unavailable, please try again later',
+                'suf_unavailable': True,
+                'retry_after': math.ceil(retry_after)
             }
+        return {
+            'success': False,
+            'error': 'Could not fetch receipt data from fiscal system'
+        }
 
     @staticmethod
-    def match_product_by_name(product_name: str, products_db) -> Tuple[Optional[object], int]:
+    def persist_receipt(user, store, matched_items: List[Dict], total_points: int,
+                        total_amount: Optional[float] = None, receipt_url: Optional[str] = None,
+                        receipt_data: Optional[Dict] = None, receipt_fingerprint: Optional[str] = None):
         """
-        Match a product from receipt with products in database or previously approved items.
-        Returns (matched_product, points) or (None, 0).
-        Uses fuzzy matching for better results.
+        Save a matched receipt in one database transaction with a constant number of queries:
+        the transaction row, a single bulk insert of all items, and an F() increment
+        of the user's balance (no read-modify-write, so concurrent scans cannot lose points).
+        The raw `receipt_data` goes compressed into its own TransactionReceipt row,
+        and an analytics event is logged in the same transaction.
+        Returns (transaction, transaction_items).
+
+        Raises IntegrityError (and saves nothing) if the receipt of
+        `receipt_fingerprint` was claimed by a concurrent scan.
         """
-        from products.models import Product
-        from .models import TransactionItem
-        from difflib import SequenceMatcher
+        from analytics.events import AnalyticsEventService
+        from users.models import User
+        from .models import Transaction, TransactionItem, TransactionReceipt
 
-        # Normalize product name
-        normalized_name = product_name.lower().strip()
+        with get_pipeline_metrics().span('persist'), db_transaction.atomic():
+            claimed_globally = bool(receipt_fingerprint) and ReceiptProcessingService.claim_receipt(
+                receipt_fingerprint, user
+            )
+            transaction = Transaction.objects.create(
+                user=user,
+                store=store,
+                total_points=total_points,
+                total_amount=total_amount,
+                receipt_url=receipt_url,
+                receipt_fingerprint=receipt_fingerprint,
+                claimed_globally=claimed_globally
+            )
+            if receipt_data is not None:
+                TransactionReceipt.build(transaction, receipt_data).save(force_insert=True)
 
-        # First, try exact match in Product database
-        exact_match = products_db.filter(name__iexact=normalized_name, status='ACTIVE').first()
-        if exact_match:
-            return exact_match, exact_match.points
+            transaction_items = TransactionItem.objects.bulk_create([
+                TransactionItem(
+                    transaction=transaction,
+                    product_id=item_data['product_id'],
+                    product_name=item_data['product_name'],
+                    gtin=item_data.get('gtin'),
+                    quantity=item_data['quantity'],
+                    price=item_data['price'],
+                    unit_price=item_data.get('unit_price'),
+                    points=item_data['points'],
+                    matched=item_data['matched']
+                )
+                for item_data in matched_items
+            ])
 
-        # Try partial match in Product database
-        for product in products_db.filter(status='ACTIVE'):
-            product_name_lower = product.name.lower()
+            if total_points:
+                User.objects.filter(pk=user.pk).update(points=F('points') + total_points)
 
-            # Check if either name contains the other
-            if normalized_name in product_name_lower or product_name_lower in normalized_name:
-                return product, product.points
+            # Durable change log for the incremental analytics, committed with the scan
+            AnalyticsEventService.record_scan(transaction, transaction_items)
 
-            # Use fuzzy matching
-            similarity = SequenceMatcher(None, normalized_name, product_name_lower).ratio()
-            if similarity > 0.8:  # 80% similarity threshold
-                return product, product.points
+        if total_points:
+            user.refresh_from_db(fields=['points'])
 
-        # No match found
-        return None, 0
+        return transaction, transaction_items
 
     @classmethod
-    def process_receipt(cls, qr_data: str, user) -> Dict:
+    def process_receipt(cls, qr_data: str, user, progress: Optional[Callable[[str], None]] = None) -> Dict:
         """
         Main method to process receipt from QR code.
         Returns processed receipt data with matched products and points.
+
+        `progress`, if given, is called with the name of each pipeline stage
+        ('fetching', 'matching', 'saving') as it starts. Every call is timed
+        as the 'scan' stage and its outcome counted (see metrics.py).
         """
-        from products.models import Product, Store
-        from .models import Transaction, TransactionItem
+        metrics = get_pipeline_metrics()
+        with metrics.span('scan') as span:
+            result = cls._scan(qr_data, user, progress)
+            if not result.get('success'):
+                span.fail()
+        metrics.count_outcome(result)
+        return result
+
+    @classmethod
+    def _scan(cls, qr_data: str, user, progress: Optional[Callable[[str], None]] = None) -> Dict:
+        report = progress or (lambda stage: None)
 
         # TESTING MODE: If QR data starts with "TEST:", use mock data
         if qr_data.startswith("TEST:"):
-            return cls.process_mock_receipt(qr_data, user)
+            return cls.process_mock_receipt(qr_data, user, progress=progress)
 
         # Extract URL from QR code
         receipt_url = cls.extract_url_from_qr(qr_data)
@@ -342,28 +717,44 @@ class ReceiptProcessingService:
                 'error': 'Invalid QR code - could not extract receipt URL'
             }
 
-        # Check if this receipt has already been scanned by this user
-        existing_transaction = Transaction.objects.filter(
-            user=user,
-            receipt_url=receipt_url
-        ).first()
-
+        # Check if this receipt has already been claimed (by this user, or by anyone
+        # under the 'global' policy) before generating any SUF traffic
+        fingerprint = cls.receipt_fingerprint(receipt_url)
+        existing_transaction = cls.find_duplicate(fingerprint, user)
         if existing_transaction:
-            return {
-                'success': False,
-                'error': 'This receipt has already been scanned',
-                'already_scanned': True,
-                'scanned_at': existing_transaction.scanned_at.isoformat(),
-                'points_earned': existing_transaction.total_points
-            }
+            return cls.already_scanned_response(existing_transaction, user)
 
-        # Fetch receipt data from Serbian fiscal system
-        receipt_data = cls.fetch_receipt_data(receipt_url)
-        if not receipt_data:
-            return {
-                'success': False,
-                'error': 'Could not fetch receipt data from fiscal system'
-            }
+        report('fetching')
+
+        # Fetch receipt data and store info from the Serbian fiscal system
+        # (or the receipt cache); the receipt page is fetched and parsed once
+        fetched = cls.fetch_receipt(receipt_url)
+        if not fetched:
+            return cls.fetch_failed_response()
+
+        prepared = cls.prepare_receipt(fetched, progress=progress)
+        if not prepared['success']:
+            return prepared
+
+        report('saving')
+
+        # Create transaction, items and points update as one atomic unit
+        return cls.save_receipt(user, receipt_url, fingerprint, prepared)
+
+    @classmethod
+    def prepare_receipt(cls, fetched: Dict, progress: Optional[Callable[[str], None]] = None) -> Dict:
+        """
+        Parse a fetched receipt, resolve its store and match its items.
+        Returns {'success': True, 'store', 'matched_items', 'total_points',
+        'total_amount', 'receipt_data'} or an error result.
+        """
+        with get_pipeline_metrics().span('match'):
+            return cls._prepare_receipt(fetched, progress)
+
+    @classmethod
+    def _prepare_receipt(cls, fetched: Dict, progress: Optional[Callable[[str], None]] = None) -> Dict:
+        report = progress or (lambda stage: None)
+        receipt_data = fetched['receipt_data']
 
         # Parse items from receipt
         items = cls.parse_receipt_items(receipt_data)
@@ -373,26 +764,23 @@ class ReceiptProcessingService:
                 'error': 'No items found in receipt'
             }
 
-        # Extract store information from the HTML page
-        store_info = cls.extract_store_info(receipt_url)
+        # Store information comes from the already parsed HTML page
+        store_info = fetched['store_info']
 
-        # Get or create store
-        store, created = Store.objects.get_or_create(
-            name=store_info['name'],
-            defaults={'location': store_info['location']}
-        )
+        # Resolve the store by TIN + shop code (falls back to the name without a TIN)
+        store = StoreResolver.resolve(store_info)
+
+        report('matching')
 
-        # Match products and calculate points
-        products_db = Product.objects.all()
+        # Match products (GTIN first, then name) and calculate points
         matched_items = []
         total_points = 0
         total_amount = 0.0
 
-        for item in items:
-            matched_product, points = cls.match_product_by_name(item['name'], products_db)
-
+        for item, (matched_product, points) in zip(items, cls.match_receipt_items(items, store=store)):
             matched_items.append({
                 'product_name': item['name'],
+                'gtin': normalize_gtin(item['gtin']),
                 'quantity': item['quantity'],
                 'price': item['total'],  # Total price for this line item
                 'unit_price': item['unit_price'],  # Price per unit
@@ -404,34 +792,36 @@ class ReceiptProcessingService:
             total_points += points * item['quantity']
             total_amount += item['total']
 
-        # Create transaction
-        transaction = Transaction.objects.create(
-            user=user,
-            store=store,
-            total_points=total_points,
-            total_amount=total_amount,
-            receipt_url=receipt_url,
-            receipt_data=receipt_data
-        )
+        return {
+            'success': True,
+            'store': store,
+            'matched_items': matched_items,
+            'total_points': total_points,
+            'total_amount': total_amount,
+            'receipt_data': receipt_data
+        }
 
-        # Create transaction items
-        transaction_items = []
-        for item_data in matched_items:
-            item = TransactionItem.objects.create(
-                transaction=transaction,
-                product_id=item_data['product_id'],
-                product_name=item_data['product_name'],
-                quantity=item_data['quantity'],
-                price=item_data['price'],
-                unit_price=item_data['unit_price'],
-                points=item_data['points'],
-                matched=item_data['matched']
+    @classmethod
+    def save_receipt(cls, user, receipt_url: str, fingerprint: str, prepared: Dict) -> Dict:
+        """Persist a prepared receipt and build the scan result."""
+        store = prepared['store']
+        try:
+            transaction, transaction_items = cls.persist_receipt(
+                user=user,
+                store=store,
+                matched_items=prepared['matched_items'],
+                total_points=prepared['total_points'],
+                total_amount=prepared['total_amount'],
+                receipt_url=receipt_url,
+                receipt_data=prepared['receipt_data'],
+                receipt_fingerprint=fingerprint
             )
-            transaction_items.append(item)
-
-        # Update user points
-        user.points += total_points
-        user.save()
+        except IntegrityError:
+            # A concurrent scan of the same receipt claimed it first
+            existing_transaction = cls.find_duplicate(fingerprint, user)
+            if existing_transaction is None:
+                raise
+            return cls.already_scanned_response(existing_transaction, user)
 
         # Serialize transaction items to include IDs
         from .serializers import TransactionItemSerializer
@@ -445,22 +835,151 @@ class ReceiptProcessingService:
                 'name': store.name,
                 'location': store.location
             },
-            'total_points': total_points,
+            'total_points': prepared['total_points'],
             'items': serialized_items,
             'unmatched_items': [item for item in serialized_items if not item['matched']]
         }
 
     @classmethod
-    def process_mock_receipt(cls, qr_data: str, user) -> Dict:
+    def process_receipts(cls, qr_list: List[str], user, max_workers: Optional[int] = None) -> List[Dict]:
+        """
+        Process several receipts at once (e.g. after a shopping trip).
+
+        Duplicates are checked for the whole batch in one query, the new
+        receipts are fetched from SUF concurrently by a bounded thread pool,
+        and each resulting transaction is saved in its own atomic block, so a
+        receipt that fails to save only fails its own entry. Returns one result
+        per QR code, in input order, shaped like process_receipt's result.
+        Every receipt is timed as a 'scan' from the start of the batch, when
+        its response is ready, and its outcome counted.
+        """
+        started = time.perf_counter()
+        results: List[Optional[Dict]] = [None] * len(qr_list)
+        pending = {}  # position -> (receipt_url, fingerprint)
+        claimed = {}  # fingerprint -> position of its first occurrence in the batch
+
+        for position, qr_data in enumerate(qr_list):
+            if qr_data.startswith("TEST:"):
+                continue
+
+            receipt_url = cls.extract_url_from_qr(qr_data)
+            if not receipt_url:
+                results[position] = {
+                    'success': False,
+                    'error': 'Invalid QR code - could not extract receipt URL'
+                }
+                continue
+
+            fingerprint = cls.receipt_fingerprint(receipt_url)
+            if fingerprint in claimed:
+                results[position] = {
+                    'success': False,
+                    'error': 'This receipt appears more than once in the batch',
+                    'already_scanned': True
+                }
+                continue
+
+            claimed[fingerprint] = position
+            pending[position] = (receipt_url, fingerprint)
+
+        # One query for every duplicate in the batch
+        for existing_transaction in cls.claimed_receipts(list(claimed), user):
+            position = claimed[existing_transaction.receipt_fingerprint]
+            if pending.pop(position, None) is not None:
+                results[position] = cls.already_scanned_response(existing_transaction, user)
+
+        # Serve what we can from the receipt cache, fetch the rest from SUF concurrently.
+        # Worker threads only do network I/O; all database work stays on this thread.
+        fetched = {}
+        to_download = {}
+        for position, (receipt_url, _) in pending.items():
+            entry = ReceiptCache.get(receipt_url=receipt_url)
+            if entry is None:
+                to_download[position] = receipt_url
+                continue
+            fetched[position] = {
+                'receipt_data': entry.receipt_data,
+                'store_info': entry.store_info,
+                'invoice_number': entry.invoice_number,
+                'cached': True,
+            }
+
+        if to_download:
+            workers = max_workers or getattr(settings, 'RECEIPT_BATCH_FETCH_WORKERS', 5)
+            workers = max(1, min(workers, len(to_download)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='receipt-fetch') as pool:
+                futures = {
+                    position: pool.submit(cls._download_receipt, receipt_url)
+                    for position, receipt_url in to_download.items()
+                }
+                downloads = {position: future.result() for position, future in futures.items()}
+
+            for position, download in downloads.items():
+                fetched[position] = download and cls._store_fetched(to_download[position], *download)
+
+        # Match on this thread, then save everything together
+        prepared = {}
+        for position, fetched_receipt in fetched.items():
+            if not fetched_receipt:
+                results[position] = cls.fetch_failed_response()
+                continue
+            prepared_receipt = cls.prepare_receipt(fetched_receipt)
+            if prepared_receipt['success']:
+                prepared[position] = prepared_receipt
+            else:
+                results[position] = prepared_receipt
+
+        for position, prepared_receipt in prepared.items():
+            receipt_url, fingerprint = pending[position]
+            try:
+                with db_transaction.atomic():
+                    results[position] = cls.save_receipt(user, receipt_url, fingerprint, prepared_receipt)
+            except Exception:
+                logger.exception('Error saving receipt %s', receipt_url)
+                results[position] = {
+                    'success': False,
+                    'error': 'Could not save the receipt, please try again'
+                }
+
+        for position, qr_data in enumerate(qr_list):
+            if qr_data.startswith("TEST:"):
+                results[position] = cls.process_mock_receipt(qr_data, user)
+
+        metrics = get_pipeline_metrics()
+        seconds = time.perf_counter() - started
+        for result in results:
+            metrics.observe('scan', seconds, failed=not result.get('success'))
+            metrics.count_outcome(result)
+        return results
+
+    @classmethod
+    def _download_receipt(cls, receipt_url: str) -> Optional[Tuple['ReceiptPage', Dict]]:
+        """Fetch a receipt page and its specifications from SUF (network only, safe to run in a thread)."""
+        try:
+            page = cls.fetch_receipt_page(receipt_url)
+            if page is None:
+                return None
+            receipt_data = cls._post_specifications(receipt_url, page)
+            if not receipt_data:
+                return None
+            # The page was parsed by fetch_receipt_page, so the request thread only does database work
+            return page, receipt_data
+        except Exception:
+            logger.exception('Error fetching receipt %s', receipt_url)
+            return None
+
+    @classmethod
+    def process_mock_receipt(cls, qr_data: str, user, progress: Optional[Callable[[str], None]] = None) -> Dict:
         """
         Process a mock receipt for testing purposes.
         QR data format: TEST:store_name:item1_name:item1_qty:item1_price,item2_name:item2_qty:item2_price
         Example: TEST:Maxi:Mleko:2:150.00,Hleb:1:80.00
         """
-        from products.models import Product, Store
-        from .models import Transaction, TransactionItem
+        from products.models import Store
         import random
 
+        report = progress or (lambda stage: None)
+
         try:
             # Parse mock QR data
             parts = qr_data.split(':')
@@ -492,14 +1011,13 @@ class ReceiptProcessingService:
                 defaults={'location': 'Test Location'}
             )
 
+            report('matching')
+
             # Match products
-            products_db = Product.objects.all()
             matched_items = []
             total_points = 0
 
-            for item in items:
-                matched_product, points = cls.match_product_by_name(item['name'], products_db)
-
+            for item, (matched_product, points) in zip(items, cls.match_receipt_items(items, store=store)):
                 matched_items.append({
                     'product_name': item['name'],
                     'quantity': item['quantity'],
@@ -511,34 +1029,19 @@ class ReceiptProcessingService:
 
                 total_points += points * item['quantity']
 
+            report('saving')
+
             # Create transaction with unique test URL
             test_url = f"TEST_{random.randint(100000, 999999)}"
-            transaction = Transaction.objects.create(
+            transaction, transaction_items = cls.persist_receipt(
                 user=user,
                 store=store,
+                matched_items=matched_items,
                 total_points=total_points,
                 receipt_url=test_url,
                 receipt_data={'test': True, 'original_qr': qr_data}
             )
 
-            # Create transaction items
-            transaction_items = []
-            for item_data in matched_items:
-                item = TransactionItem.objects.create(
-                    transaction=transaction,
-                    product_id=item_data['product_id'],
-                    product_name=item_data['product_name'],
-                    quantity=item_data['quantity'],
-                    price=item_data['price'],
-                    points=item_data['points'],
-                    matched=item_data['matched']
-                )
-                transaction_items.append(item)
-
-            # Update user points
-            user.points += total_points
-            user.save()
-
             # Serialize transaction items to include IDs
             from .serializers import TransactionItemSerializer
             serialized_items = TransactionItemSerializer(transaction_items, many=True).data
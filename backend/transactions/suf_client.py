@@ -0,0 +1,341 @@
+"""
+Shared HTTP client for the Serbian Tax Authority (SUF) system.
+
+All SUF traffic goes through a single requests.Session per process so that
+TCP/TLS connections to suf.purs.gov.rs are pooled and kept alive between
+scans instead of being re-established for every call.
+
+Every call also goes through a CircuitBreaker: while SUF is failing, calls
+are rejected immediately with SUFUnavailable instead of tying up a worker
+for the full timeout, and read timeouts follow the observed SUF latency.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+DEFAULT_SUF_CLIENT_SETTINGS = {
+    'BASE_URL': 'https://suf.purs.gov.rs',
+    # Fetch receipt pages from BASE_URL instead of the host in the QR code
+    # (e.g. a local `run_fake_suf` server)
+    'REDIRECT_RECEIPT_URLS': False,
+    'POOL_CONNECTIONS': 4,
+    'POOL_MAXSIZE': 10,
+    'POOL_BLOCK': False,
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'GET_RETRIES': 2,
+    'RETRY_BACKOFF': 0.3,
+    'RETRY_JITTER': 0.5,
+    'USER_AGENT': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+}
+
+
+DEFAULT_CIRCUIT_BREAKER_SETTINGS = {
+    'ENABLED': True,
+    'WINDOW_SECONDS': 60,         # rolling window for the error rate
+    'MIN_CALLS': 10,              # calls in the window before the breaker can trip
+    'ERROR_RATE': 0.5,            # trip when at least this share of calls failed
+    'OPEN_SECONDS': 30,           # how long to fail fast before probing SUF again
+    'HALF_OPEN_MAX_CALLS': 1,     # concurrent probe calls while half-open
+    'LATENCY_SAMPLES': 200,       # successful call latencies kept for percentiles
+    'TIMEOUT_PERCENTILE': 0.99,
+    'TIMEOUT_MULTIPLIER': 3.0,    # read timeout = multiplier x latency percentile...
+    'MIN_READ_TIMEOUT': 2.0,      # ...clamped to [MIN_READ_TIMEOUT, SUF_CLIENT READ_TIMEOUT]
+}
+
+
+class SUFUnavailable(requests.RequestException):
+    """Raised without contacting SUF while the circuit breaker is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f'SUF circuit breaker is open, retry in {retry_after:.0f}s')
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker with latency tracking.
+
+    - closed: calls pass; trips to open when the error rate over the last
+      WINDOW_SECONDS reaches ERROR_RATE (with at least MIN_CALLS calls)
+    - open: calls are rejected for OPEN_SECONDS
+    - half_open: up to HALF_OPEN_MAX_CALLS probes pass; a success closes
+      the breaker, a failure opens it again
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, max_read_timeout: float, **overrides):
+        config = dict(DEFAULT_CIRCUIT_BREAKER_SETTINGS)
+        config.update(getattr(settings, 'SUF_CIRCUIT_BREAKER', {}))
+        config.update(overrides)
+        self.config = config
+        self.max_read_timeout = max_read_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._calls = deque()  # (monotonic time, succeeded)
+        self._latencies = deque(maxlen=config['LATENCY_SAMPLES'])
+        self.counters = {'calls': 0, 'successes': 0, 'failures': 0, 'rejected': 0, 'trips': 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == self.OPEN and now - self._opened_at >= self.config['OPEN_SECONDS']:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def _prune(self, now: float):
+        cutoff = now - self.config['WINDOW_SECONDS']
+        while self._calls and self._calls[0][0] < cutoff:
+            self._calls.popleft()
+
+    def _error_rate(self) -> float:
+        if not self._calls:
+            return 0.0
+        return sum(1 for _, succeeded in self._calls if not succeeded) / len(self._calls)
+
+    def _trip(self, now: float):
+        self._state = self.OPEN
+        self._opened_at = now
+        self.counters['trips'] += 1
+
+    def allow_request(self) -> bool:
+        """Whether a call may go to SUF now (counts a rejection if not)."""
+        if not self.config['ENABLED']:
+            return True
+
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._probes < self.config['HALF_OPEN_MAX_CALLS']:
+                self._probes += 1
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def record(self, succeeded: bool, latency: float):
+        """Record the outcome and duration (seconds) of a call that went to SUF."""
+        now = time.monotonic()
+        with self._lock:
+            self.counters['calls'] += 1
+            self.counters['successes' if succeeded else 'failures'] += 1
+            if succeeded:
+                self._latencies.append(latency)
+
+            self._calls.append((now, succeeded))
+            self._prune(now)
+
+            state = self._current_state(now)
+            if state == self.HALF_OPEN:
+                self._probes = max(self._probes - 1, 0)
+                if succeeded:
+                    self._state = self.CLOSED
+                    self._calls.clear()
+                else:
+                    self._trip(now)
+            elif (state == self.CLOSED and len(self._calls) >= self.config['MIN_CALLS']
+                  and self._error_rate() >= self.config['ERROR_RATE']):
+                self._trip(now)
+
+    def retry_after(self) -> float:
+        """Seconds until the breaker lets a probe through (0 unless open)."""
+        with self._lock:
+            now = time.monotonic()
+            if self._current_state(now) != self.OPEN:
+                return 0.0
+            return max(self.config['OPEN_SECONDS'] - (now - self._opened_at), 0.0)
+
+    def _percentile(self, fraction: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+    def read_timeout(self) -> float:
+        """
+        Read timeout derived from observed latency: TIMEOUT_MULTIPLIER x the
+        TIMEOUT_PERCENTILE latency, clamped between MIN_READ_TIMEOUT and the
+        configured READ_TIMEOUT. Uses READ_TIMEOUT until MIN_CALLS samples exist.
+        """
+        with self._lock:
+            if len(self._latencies) < self.config['MIN_CALLS']:
+                return self.max_read_timeout
+            observed = self._percentile(self.config['TIMEOUT_PERCENTILE']) * self.config['TIMEOUT_MULTIPLIER']
+        return min(max(observed, self.config['MIN_READ_TIMEOUT']), self.max_read_timeout)
+
+    def snapshot(self) -> Dict:
+        """Breaker state, rolling error rate, latency percentiles and counters for monitoring."""
+        read_timeout = self.read_timeout()
+        retry_after = self.retry_after()
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            percentiles = {
+                f'p{int(fraction * 100)}_ms': (
+                    round(value * 1000, 1) if (value := self._percentile(fraction)) is not None else None
+                )
+                for fraction in (0.5, 0.95, 0.99)
+            }
+            return {
+                'enabled': self.config['ENABLED'],
+                'state': self._current_state(now),
+                'window_calls': len(self._calls),
+                'error_rate': round(self._error_rate(), 4),
+                'latency': percentiles,
+                'read_timeout': round(read_timeout, 3),
+                'retry_after': round(retry_after, 1),
+                **self.counters,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._probes = 0
+            self._calls.clear()
+            self._latencies.clear()
+            for key in self.counters:
+                self.counters[key] = 0
+
+
+class SUFClient:
+    """
+    Keep-alive, connection-pooled HTTP client for SUF.
+
+    - bounded pool per host (POOL_MAXSIZE connections)
+    - separate connect and read timeouts
+    - jittered exponential-backoff retries for idempotent GETs only;
+      POSTs are never retried automatically
+    - circuit breaker with latency-derived read timeouts (see CircuitBreaker)
+    """
+
+    def __init__(self, **overrides):
+        config = dict(DEFAULT_SUF_CLIENT_SETTINGS)
+        config.update(getattr(settings, 'SUF_CLIENT', {}))
+        config.update(overrides)
+        self.config = config
+
+        self.base_url = config['BASE_URL'].rstrip('/')
+        self.timeout = (config['CONNECT_TIMEOUT'], config['READ_TIMEOUT'])
+
+        retry = Retry(
+            total=config['GET_RETRIES'],
+            connect=config['GET_RETRIES'],
+            read=config['GET_RETRIES'],
+            status=config['GET_RETRIES'],
+            backoff_factor=config['RETRY_BACKOFF'],
+            backoff_jitter=config['RETRY_JITTER'],
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=config['POOL_CONNECTIONS'],
+            pool_maxsize=config['POOL_MAXSIZE'],
+            pool_block=config['POOL_BLOCK'],
+            max_retries=retry,
+        )
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'User-Agent': config['USER_AGENT']})
+
+        self.breaker = CircuitBreaker(max_read_timeout=config['READ_TIMEOUT'])
+
+    def url(self, path: str) -> str:
+        """Absolute SUF URL for a path such as '/specifications'."""
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def resolve_url(self, receipt_url: str) -> str:
+        """
+        URL to fetch a receipt page from: the QR code URL itself, or with
+        REDIRECT_RECEIPT_URLS the same path and query on BASE_URL.
+        """
+        if not self.config['REDIRECT_RECEIPT_URLS']:
+            return receipt_url
+        parts = urlsplit(receipt_url)
+        path = f'{parts.path}?{parts.query}' if parts.query else parts.path
+        return self.url(path)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send a request through the circuit breaker.
+        Raises SUFUnavailable without any network traffic while the breaker is open;
+        connection errors, timeouts and 5xx responses count as failures.
+        """
+        if not self.breaker.allow_request():
+            raise SUFUnavailable(self.breaker.retry_after())
+
+        kwargs.setdefault('timeout', (self.config['CONNECT_TIMEOUT'], self.breaker.read_timeout()))
+        started = time.monotonic()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.breaker.record(False, time.monotonic() - started)
+            raise
+
+        self.breaker.record(response.status_code < 500, time.monotonic() - started)
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_client: Optional[SUFClient] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
+
+def get_suf_client() -> SUFClient:
+    """
+    Return the process-wide SUF client, creating it on first use.
+
+    The client is rebuilt after a fork so that worker processes never share
+    pooled sockets with their parent.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = SUFClient()
+                _client_pid = pid
+    return _client
+
+
+def reset_suf_client():
+    """Drop the cached client (e.g. after changing SUF_CLIENT settings)."""
+    global _client, _client_pid
+
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _client_pid = None
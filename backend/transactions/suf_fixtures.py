@@ -0,0 +1,78 @@
+"""
+Record/replay fixtures of SUF receipts.
+
+A fixture is a pair of files in a fixtures directory (by default
+transactions/fixtures/suf/):
+
+    <name>.html   the receipt page exactly as SUF served it
+    <name>.json   {
+                      "url": "https://suf.purs.gov.rs/v/?vl=...",
+                      "page": "<name>.html",
+                      "specifications": {... /specifications JSON response ...},
+                      "recorded_at": "2024-11-05T18:45:00+00:00"
+                  }
+
+`python manage.py record_suf_receipt <url>` writes fixtures from the live
+system and `python manage.py run_fake_suf` replays them.
+"""
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from django.utils import timezone
+
+from .models import normalize_receipt_key
+from .services import ReceiptPage
+
+
+DEFAULT_FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures' / 'suf'
+
+
+class SUFFixture:
+    """One recorded receipt: its URL, page HTML and specifications response."""
+
+    def __init__(self, name: str, url: str, html: str, specifications: Dict, recorded_at: Optional[str] = None):
+        self.name = name
+        self.url = url
+        self.html = html
+        self.specifications = specifications
+        self.recorded_at = recorded_at
+
+        page = ReceiptPage(url, html)
+        self.invoice_number = page.invoice_number
+        self.token = page.token
+
+    @property
+    def key(self) -> str:
+        """Receipt identity used for lookups (the `vl` parameter of the URL)."""
+        return normalize_receipt_key(self.url)
+
+    @classmethod
+    def load(cls, path: Path) -> 'SUFFixture':
+        data = json.loads(path.read_text(encoding='utf-8'))
+        html = (path.parent / data['page']).read_text(encoding='utf-8')
+        return cls(path.stem, data['url'], html, data['specifications'], data.get('recorded_at'))
+
+    def save(self, directory: Path) -> Path:
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / f'{self.name}.html').write_text(self.html, encoding='utf-8')
+
+        path = directory / f'{self.name}.json'
+        path.write_text(json.dumps({
+            'url': self.url,
+            'page': f'{self.name}.html',
+            'specifications': self.specifications,
+            'recorded_at': self.recorded_at or timezone.now().isoformat(),
+        }, ensure_ascii=False, indent=2) + '\n', encoding='utf-8')
+        return path
+
+
+def load_fixtures(directory: Path = DEFAULT_FIXTURES_DIR) -> List[SUFFixture]:
+    """All fixtures (*.json with their pages) in `directory`, sorted by name."""
+    return [SUFFixture.load(path) for path in sorted(Path(directory).glob('*.json'))]
+
+
+def fixture_name(invoice_number: str) -> str:
+    """File-system safe fixture name derived from an invoice number."""
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', invoice_number).strip('_').lower() or 'receipt'
@@ -1,3 +1,675 @@
-from django.test import TestCase
+import io
+import threading
+from datetime import date, timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from products.matching import reset_product_matcher
+from products.models import CatalogVersion, Product, ProductAlias, ProductBarcode, Store
+from products.stores import StoreResolver
+from users.models import User
+from .fake_suf import FakeSUF, make_server
+from .jobs import ScanJobService
+from .metrics import get_pipeline_metrics
+from .models import ReceiptScanJob, SUFReceiptCache, Transaction, TransactionItem, receipt_fingerprint
+from .receipt_cache import ReceiptCache
+from .services import ReceiptPage, ReceiptProcessingService
+from .suf_client import CircuitBreaker, SUFClient, SUFUnavailable, get_suf_client, reset_suf_client
+from .suf_fixtures import load_fixtures
+
+RECEIPT_URL = 'https://suf.purs.gov.rs/v/?vl=A1B2C3%2BD4%3D'
+
+
+class SUFClientTests(TestCase):
+
+    def setUp(self):
+        reset_suf_client()
+        self.addCleanup(reset_suf_client)
+
+    def test_one_client_per_process_until_reset(self):
+        client = get_suf_client()
+        self.assertIs(get_suf_client(), client)
+
+        reset_suf_client()
+        self.assertIsNot(get_suf_client(), client)
+
+    def test_only_gets_are_retried(self):
+        client = SUFClient(GET_RETRIES=3)
+        retry = client.session.get_adapter('https://suf.purs.gov.rs').max_retries
+        self.assertEqual(retry.total, 3)
+        self.assertEqual(retry.allowed_methods, {'GET', 'HEAD'})
+        client.close()
+
+    @override_settings(SUF_CLIENT={'BASE_URL': 'http://127.0.0.1:8765/', 'REDIRECT_RECEIPT_URLS': True})
+    def test_receipt_urls_can_be_redirected_to_the_base_url(self):
+        client = get_suf_client()
+        self.assertEqual(client.url('/specifications'), 'http://127.0.0.1:8765/specifications')
+        self.assertEqual(client.resolve_url(RECEIPT_URL), 'http://127.0.0.1:8765/v/?vl=A1B2C3%2BD4%3D')
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('transactions.suf_client.time.monotonic', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(
+            max_read_timeout=10, ENABLED=True, WINDOW_SECONDS=60, MIN_CALLS=4, ERROR_RATE=0.5, OPEN_SECONDS=30,
+            HALF_OPEN_MAX_CALLS=1, MIN_READ_TIMEOUT=2.0, TIMEOUT_MULTIPLIER=3.0
+        )
+
+    def record(self, *outcomes, latency=0.1):
+        for succeeded in outcomes:
+            self.breaker.record(succeeded, latency)
+
+    def test_trips_on_the_error_rate_after_min_calls(self):
+        self.record(False, False, False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+        self.assertEqual(self.breaker.retry_after(), 30)
+        self.assertEqual(self.breaker.counters['rejected'], 1)
+
+    def test_failures_outside_the_window_do_not_count(self):
+        self.record(False, False, False)
+        self.now += 61
+        self.record(True, True, True, False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probe_closes_or_reopens(self):
+        self.record(False, False, False, False)
+        self.now += 30
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+
+        self.record(False)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.counters['trips'], 2)
+
+        self.now += 30
+        self.assertTrue(self.breaker.allow_request())
+        self.record(True)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.snapshot()['window_calls'], 0)
+
+    def test_read_timeout_follows_latency(self):
+        self.assertEqual(self.breaker.read_timeout(), 10)
+        self.record(True, True, True, True, latency=1.0)
+        self.assertEqual(self.breaker.read_timeout(), 3.0)
+        self.record(True, True, True, True, latency=0.01)
+        self.assertEqual(self.breaker.read_timeout(), 3.0)
+        self.record(*[True] * 200, latency=0.01)
+        self.assertEqual(self.breaker.read_timeout(), 2.0)
+
+    def test_open_client_fails_without_network_traffic(self):
+        client = SUFClient()
+        client.breaker = self.breaker
+        self.record(False, False, False, False)
+
+        with mock.patch.object(client.session, 'request') as request:
+            with self.assertRaises(SUFUnavailable) as raised:
+                client.get('https://suf.purs.gov.rs/v/?vl=A1')
+        request.assert_not_called()
+        self.assertEqual(raised.exception.retry_after, 30)
+        client.close()
+
+    def test_server_errors_count_as_failures(self):
+        client = SUFClient()
+        client.breaker = self.breaker
+
+        with mock.patch.object(client.session, 'request', return_value=mock.Mock(status_code=503)):
+            for _ in range(4):
+                client.get('https://suf.purs.gov.rs/v/?vl=A1')
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        client.close()
+
+
+class ReceiptPageTests(TestCase):
+
+    def test_fast_path_agrees_with_the_soup_fallback(self):
+        for fixture in load_fixtures():
+            with self.subTest(fixture.name):
+                page = ReceiptPage(fixture.url, fixture.html)
+                page.invoice_params, page.store_info
+                self.assertNotIn('soup', page.__dict__)
+                self.assertEqual(page.fast_fields, page.soup_fields)
+
+    def test_reads_the_invoice_and_store(self):
+        fixture = {fixture.name: fixture for fixture in load_fixtures()}['maxi_receipt']
+        page = ReceiptPage(fixture.url, fixture.html)
+
+        self.assertEqual(page.invoice_params, {
+            'invoiceNumber': 'M4XG7WCS-M4XG7WCS-56123', 'token': '8e9b6f78-3747-4929-ad10-0f3fe5391755'
+        })
+        self.assertEqual(page.store_info, {
+            'name': '1228831-Maxi 123',
+            'location': 'Bulevar kralja Aleksandra 1, Beograd',
+            'tin': '100000001',
+            'shop_code': '1228831',
+        })
+
+    def test_falls_back_to_other_invoice_number_sources(self):
+        page = ReceiptPage('https://suf.purs.gov.rs/v/?vl=X', """
+            <html><body><script>
+                var data = {invoiceNumber: 'INV-1', token: '8e9b6f78-3747-4929-ad10-0f3fe5391755'};
+            </script></body></html>
+        """)
+        self.assertEqual(page.invoice_number, 'INV-1')
+        self.assertEqual(page.token, '8e9b6f78-3747-4929-ad10-0f3fe5391755')
+        self.assertEqual(page.store_info['name'], 'Unknown Store')
+
+
+class ReceiptFingerprintTests(TestCase):
+
+    def test_fingerprint_is_the_signed_invoice(self):
+        self.assertEqual(
+            receipt_fingerprint(RECEIPT_URL),
+            receipt_fingerprint('https://SUF.purs.gov.rs/v/?lang=en&vl=A1B2C3%2BD4%3D#top')
+        )
+        self.assertNotEqual(receipt_fingerprint(RECEIPT_URL), receipt_fingerprint(RECEIPT_URL + 'E5'))
+        self.assertEqual(len(receipt_fingerprint('https://example.com/receipt/1')), 64)
+
+
+class DuplicatePolicyTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(email='alice@example.com', password='x', name='Alice')
+        cls.bob = User.objects.create_user(email='bob@example.com', password='x', name='Bob')
+        cls.store = Store.objects.create(name='Maxi')
+        cls.fingerprint = receipt_fingerprint(RECEIPT_URL)
+
+    def persist(self, user):
+        return ReceiptProcessingService.persist_receipt(
+            user, self.store, [], 0, receipt_url=RECEIPT_URL, receipt_fingerprint=self.fingerprint
+        )[0]
+
+    @override_settings(RECEIPT_DUPLICATE_POLICY='per_user')
+    def test_per_user_policy(self):
+        claimed = self.persist(self.alice)
+
+        self.assertEqual(ReceiptProcessingService.find_duplicate(self.fingerprint, self.alice), claimed)
+        self.assertIsNone(ReceiptProcessingService.find_duplicate(self.fingerprint, self.bob))
+        self.persist(self.bob)
+        with self.assertRaises(IntegrityError):
+            self.persist(self.alice)
+        self.assertEqual(Transaction.objects.filter(receipt_fingerprint=self.fingerprint).count(), 2)
+
+    @override_settings(RECEIPT_DUPLICATE_POLICY='global')
+    def test_global_policy(self):
+        claimed = self.persist(self.alice)
+
+        self.assertEqual(ReceiptProcessingService.find_duplicate(self.fingerprint, self.bob), claimed)
+        with self.assertRaises(IntegrityError):
+            self.persist(self.bob)
+        self.assertEqual(Transaction.objects.filter(receipt_fingerprint=self.fingerprint).count(), 1)
+
+        response = ReceiptProcessingService.already_scanned_response(claimed, self.bob)
+        self.assertFalse(response['success'])
+        self.assertTrue(response['already_scanned'])
+
+    @override_settings(RECEIPT_DUPLICATE_POLICY='global')
+    def test_database_rejects_a_concurrent_global_claim(self):
+        self.persist(self.alice)
+
+        # As if bob's scan passed its duplicate check before alice's committed
+        with mock.patch.object(ReceiptProcessingService, 'find_duplicate', return_value=None):
+            with self.assertRaises(IntegrityError):
+                self.persist(self.bob)
+        self.assertEqual(Transaction.objects.filter(receipt_fingerprint=self.fingerprint).count(), 1)
+
+    def test_changing_the_policy_applies_to_past_scans(self):
+        with override_settings(RECEIPT_DUPLICATE_POLICY='per_user'):
+            claimed = self.persist(self.alice)
+        with override_settings(RECEIPT_DUPLICATE_POLICY='global'):
+            self.assertEqual(ReceiptProcessingService.find_duplicate(self.fingerprint, self.bob), claimed)
+
+
+@override_settings(SUF_RECEIPT_CACHE={'MAX_ENTRIES': 1, 'EVICT_EVERY': 3})
+class ReceiptCacheEvictionTests(TestCase):
+
+    def setUp(self):
+        ReceiptCache.reset_counters()
+
+    def put(self, number):
+        return ReceiptCache.put(f'https://suf.purs.gov.rs/v/?vl=R{number}', {'items': []}, {}, f'INV-{number}')
+
+    def test_puts_evict_every_n_entries(self):
+        self.put(1)
+        self.put(2)
+        self.assertEqual(SUFReceiptCache.objects.count(), 2)
+
+        self.put(3)
+        self.assertEqual(list(SUFReceiptCache.objects.values_list('invoice_number', flat=True)), ['INV-3'])
+        self.assertEqual(ReceiptCache.stats()['evictions'], 2)
+
+    @override_settings(SUF_RECEIPT_CACHE={'MAX_ENTRIES': 1, 'EVICT_EVERY': 0})
+    def test_command_evicts_when_puts_do_not(self):
+        for number in range(4):
+            self.put(number)
+        self.assertEqual(SUFReceiptCache.objects.count(), 4)
+
+        call_command('evict_receipt_cache', stdout=io.StringIO())
+        self.assertEqual(SUFReceiptCache.objects.count(), 1)
+
+
+class ScanJobTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='alice@example.com', password='x', name='Alice')
+        cls.store = Store.objects.create(name='Maxi')
+
+    def claimed_job(self, attempts=1):
+        ScanJobService.enqueue(RECEIPT_URL, self.user)
+        job = ScanJobService.claim_next()
+        ReceiptScanJob.objects.filter(pk=job.pk).update(attempts=attempts)
+        job.attempts = attempts
+        return job
+
+    def test_stale_jobs_are_requeued_until_out_of_attempts(self):
+        retried = self.claimed_job(attempts=1)
+        exhausted = self.claimed_job(attempts=ScanJobService.MAX_ATTEMPTS)
+        fresh = self.claimed_job(attempts=1)
+        stale = timezone.now() - timedelta(seconds=ScanJobService.STALE_AFTER_SECONDS + 1)
+        ReceiptScanJob.objects.filter(pk__in=[retried.pk, exhausted.pk]).update(started_at=stale, heartbeat_at=stale)
+
+        with self.assertLogs('transactions.jobs', level='WARNING'):
+            self.assertEqual(ScanJobService.requeue_stale_jobs(), 1)
+        statuses = dict(ReceiptScanJob.objects.values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[retried.pk], statuses[exhausted.pk], statuses[fresh.pk]], ['pending', 'failed', 'running']
+        )
+
+    def test_slow_jobs_of_a_live_worker_are_not_requeued(self):
+        slow = self.claimed_job()
+        crashed = self.claimed_job()
+        long_ago = timezone.now() - timedelta(seconds=ScanJobService.STALE_AFTER_SECONDS + 1)
+        ReceiptScanJob.objects.filter(pk=slow.pk).update(started_at=long_ago, heartbeat_at=long_ago)
+        ReceiptScanJob.objects.filter(pk=crashed.pk).update(
+            started_at=long_ago, heartbeat_at=long_ago, worker='other-host:1'
+        )
+
+        self.assertEqual(ScanJobService.heartbeat(), 1)
+        with self.assertLogs('transactions.jobs', level='WARNING'):
+            self.assertEqual(ScanJobService.requeue_stale_jobs(), 1)
+        statuses = dict(ReceiptScanJob.objects.values_list('pk', 'status'))
+        self.assertEqual([statuses[slow.pk], statuses[crashed.pk]], ['running', 'pending'])
+
+    def test_retry_of_a_saved_receipt_succeeds(self):
+        job = self.claimed_job(attempts=2)
+        saved, _ = ReceiptProcessingService.persist_receipt(
+            self.user, self.store, [], 7, receipt_url=RECEIPT_URL, receipt_fingerprint=receipt_fingerprint(RECEIPT_URL)
+        )
+
+        with mock.patch.object(ReceiptProcessingService, 'process_receipt') as process_receipt:
+            process_receipt.return_value = ReceiptProcessingService.already_scanned_response(saved, self.user)
+            ScanJobService.run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.transaction_id), ('succeeded', saved.id))
+
+    def test_first_attempt_of_a_scanned_receipt_fails(self):
+        job = self.claimed_job(attempts=1)
+        saved, _ = ReceiptProcessingService.persist_receipt(
+            self.user, self.store, [], 7, receipt_url=RECEIPT_URL, receipt_fingerprint=receipt_fingerprint(RECEIPT_URL)
+        )
+
+        with mock.patch.object(ReceiptProcessingService, 'process_receipt') as process_receipt:
+            process_receipt.return_value = ReceiptProcessingService.already_scanned_response(saved, self.user)
+            ScanJobService.run_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+
+    def test_errors_are_logged_and_retried(self):
+        job = self.claimed_job(attempts=1)
+
+        with mock.patch.object(ReceiptProcessingService, 'process_receipt', side_effect=RuntimeError('boom')), \
+                self.assertLogs('transactions.jobs', level='ERROR') as logs:
+            ScanJobService.run_job(job)
+
+        self.assertIn('Traceback', logs.output[0])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), ('pending', 'Error processing receipt: boom'))
+
+
+class ReviewApprovalTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='alice@example.com', password='x', name='Alice')
+        cls.admin = User.objects.create_superuser(email='admin@example.com', password='x', name='Admin')
+        cls.store = Store.objects.create(name='Maxi')
+        cls.milk = Product.objects.create(name='Mleko 1L', points=3)
+        cls.yogurt = Product.objects.create(name='Jogurt', points=4)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def pending_item(self):
+        transaction, items = ReceiptProcessingService.persist_receipt(self.user, self.store, [dict(
+            product_id=None, product_name='MLK 1L', quantity=1, price=120.0, points=0, matched=False
+        )], 0)
+        TransactionItem.objects.filter(transaction=transaction).update(review_status='pending')
+        return items[0]
+
+    def approve(self, item, product):
+        return self.client.post(
+            f'/api/reviews/{item.id}/approve/', {'points': 5, 'product_id': product.id}, format='json'
+        )
+
+    def test_relinking_an_approval_corrects_the_global_alias(self):
+        ProductAlias.learn('MLK 1L', self.yogurt.id)
+
+        self.assertEqual(self.approve(self.pending_item(), self.milk).status_code, 200)
+        self.assertEqual(
+            dict(ProductAlias.objects.values_list('store_id', 'product_id')),
+            {self.store.id: self.milk.id, None: self.milk.id}
+        )
+
+    def test_alias_is_not_learned_when_the_approval_fails(self):
+        item = self.pending_item()
+
+        with mock.patch('analytics.events.AnalyticsEventService.record_review_approval', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.approve(item, self.milk)
+
+        self.assertFalse(ProductAlias.objects.exists())
+        item.refresh_from_db()
+        self.assertEqual(item.review_status, 'pending')
+
+    def test_approval_adds_points_in_the_database(self):
+        item = TransactionItem.objects.select_related('transaction__user').get(pk=self.pending_item().pk)
+        # Awarded by a concurrent scan after the view loaded the user and the transaction
+        User.objects.filter(pk=self.user.pk).update(points=100)
+        Transaction.objects.filter(pk=item.transaction_id).update(total_points=7)
+
+        loaded = mock.Mock(get=mock.Mock(return_value=item))
+        with mock.patch.object(TransactionItem.objects, 'select_related', return_value=loaded):
+            self.assertEqual(self.approve(item, self.milk).status_code, 200)
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.points, 105)
+        self.assertEqual(Transaction.objects.get(pk=item.transaction_id).total_points, 12)
+
+
+class FakeSUFTests(TestCase):
+
+    def setUp(self):
+        self.fixtures = load_fixtures()
+        self.maxi = next(fixture for fixture in self.fixtures if fixture.name == 'maxi_receipt')
+
+    def test_replays_recorded_receipts(self):
+        suf = FakeSUF(self.fixtures)
+        self.assertEqual(suf.page(self.maxi.key), self.maxi.html)
+        self.assertEqual(suf.specifications(self.maxi.invoice_number, self.maxi.token), self.maxi.specifications)
+        self.assertIsNone(suf.specifications(self.maxi.invoice_number, 'wrong-token'))
+        self.assertIsNone(suf.page('unknown'))
+
+    def test_synthesized_receipts_are_unique_and_answerable(self):
+        suf = FakeSUF(self.fixtures, SYNTHESIZE=True)
+        pages = [ReceiptPage(f'https://suf.purs.gov.rs/v/?vl={vl}', suf.page(vl)) for vl in ('S1', 'S2', 'S1')]
+
+        self.assertNotEqual(pages[0].invoice_number, pages[1].invoice_number)
+        self.assertEqual(pages[0].invoice_number, pages[2].invoice_number)
+        self.assertTrue(suf.specifications(pages[0].invoice_number, pages[0].token)['success'])
+
+    def test_injects_errors_at_the_configured_rate(self):
+        suf = FakeSUF(self.fixtures, ERROR_RATE=0.5, SEED=7)
+        failures = [suf.inject_faults() for _ in range(200)]
+        self.assertEqual(set(failures), {None, 503})
+        self.assertEqual(suf.counters['errors'], failures.count(503))
+        self.assertAlmostEqual(failures.count(503) / 200, 0.5, delta=0.15)
+
+
+class FakeSUFMixin:
+    """Serve the recorded SUF fixtures from a local fake SUF server and point the SUF client at it."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.fixtures = {fixture.name: fixture for fixture in load_fixtures()}
+        cls.server = make_server(list(cls.fixtures.values()), address=('127.0.0.1', 0))
+        thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        thread.start()
+        cls.addClassCleanup(thread.join)
+        cls.addClassCleanup(cls.server.server_close)
+        cls.addClassCleanup(cls.server.shutdown)
+
+    def setUp(self):
+        super().setUp()
+        host, port = self.server.server_address
+        suf_client = override_settings(SUF_CLIENT={
+            'BASE_URL': f'http://{host}:{port}', 'REDIRECT_RECEIPT_URLS': True, 'GET_RETRIES': 0
+        })
+        suf_client.enable()
+        self.addCleanup(suf_client.disable)
+        reset_suf_client()
+        self.addCleanup(reset_suf_client)
+        StoreResolver.clear()
+        reset_product_matcher()
+        for counter in self.server.suf.counters:
+            self.server.suf.counters[counter] = 0
+
+
+class ReceiptPipelineTests(FakeSUFMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(email='alice@example.com', password='x', name='Alice')
+        cls.bob = User.objects.create_user(email='bob@example.com', password='x', name='Bob')
+
+    def test_scan_fetches_the_receipt_page_once(self):
+        result = ReceiptProcessingService.process_receipt(self.fixtures['maxi_receipt'].url, self.alice)
+
+        self.assertTrue(result['success'])
+        self.assertEqual(len(result['items']), 8)
+        self.assertEqual(self.server.suf.counters['pages'], 1)
+        self.assertEqual(self.server.suf.counters['specifications'], 1)
+
+    @override_settings(RECEIPT_DUPLICATE_POLICY='per_user')
+    def test_rescans_do_not_contact_suf(self):
+        url = self.fixtures['maxi_receipt'].url
+        ReceiptProcessingService.process_receipt(url, self.alice)
+
+        self.assertTrue(ReceiptProcessingService.process_receipt(url, self.alice)['already_scanned'])
+        # Another form of the same signed receipt URL hits the cache by URL too
+        variant = url.replace('https://suf.purs.gov.rs', 'https://SUF.purs.gov.rs') + '&lang=en#top'
+        self.assertTrue(ReceiptProcessingService.process_receipt(variant, self.bob)['success'])
+        self.assertEqual(self.server.suf.counters['pages'], 1)
+
+    def test_batch_scan_fetches_new_receipts_and_reports_each(self):
+        maxi, idea = self.fixtures['maxi_receipt'].url, self.fixtures['idea_receipt'].url
+        client = APIClient()
+        client.force_authenticate(self.alice)
+
+        response = client.post('/api/receipts/scan-batch/', {'qr_data': [maxi, idea, maxi, 'no url']}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([result['success'] for result in results], [True, True, False, False])
+        self.assertTrue(results[2]['already_scanned'])
+        self.assertEqual((response.data['succeeded'], response.data['failed']), (2, 2))
+        self.assertEqual(Transaction.objects.filter(user=self.alice).count(), 2)
+        self.assertEqual(self.server.suf.counters['specifications'], 2)
+
+    def test_batch_receipt_that_fails_to_save_only_fails_its_entry(self):
+        maxi, idea = self.fixtures['maxi_receipt'].url, self.fixtures['idea_receipt'].url
+        get_pipeline_metrics().reset()
+        persist_receipt = ReceiptProcessingService.persist_receipt
+
+        def fail_for_idea(user, store, *args, **kwargs):
+            if kwargs['receipt_url'] == idea:
+                raise RuntimeError('database went away')
+            return persist_receipt(user, store, *args, **kwargs)
+
+        with mock.patch.object(ReceiptProcessingService, 'persist_receipt', side_effect=fail_for_idea):
+            results = ReceiptProcessingService.process_receipts([maxi, idea], self.alice)
+
+        self.assertEqual([result['success'] for result in results], [True, False])
+        saved = Transaction.objects.filter(user=self.alice).values_list('receipt_url', flat=True)
+        self.assertEqual(list(saved), [maxi])
+        scan = get_pipeline_metrics().snapshot()['stages']['scan']
+        self.assertEqual((scan['count'], scan['errors']), (2, 1))
+
+    def test_raw_receipt_is_only_returned_on_request(self):
+        fixture = self.fixtures['idea_receipt']
+        transaction_id = ReceiptProcessingService.process_receipt(fixture.url, self.alice)['transaction_id']
+        client = APIClient()
+        client.force_authenticate(self.alice)
+
+        self.assertNotIn('receipt_data', client.get('/api/transactions/').data['results'][0])
+        self.assertNotIn('receipt_data', client.get(f'/api/transactions/{transaction_id}/').data)
+        detail = client.get(f'/api/transactions/{transaction_id}/?include_receipt=true').data
+        self.assertEqual(detail['receipt_data'], fixture.specifications)
+        self.assertEqual(Transaction.objects.get(pk=transaction_id).receipt_data, fixture.specifications)
+
+    def test_pipeline_stages_are_timed_and_exported(self):
+        get_pipeline_metrics().reset()
+        ReceiptProcessingService.process_receipt(self.fixtures['maxi_receipt'].url, self.alice)
+        ReceiptProcessingService.process_receipt(self.fixtures['maxi_receipt'].url, self.alice)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser(email='admin@example.com', password='x', name='Admin'))
+
+        summary = client.get('/api/receipts/metrics/', {'format': 'json'}).data
+        stages = {stage: values['count'] for stage, values in summary['stages'].items()}
+        self.assertEqual(stages, {
+            'scan': 2, 'fetch_page': 1, 'parse': 1, 'fetch_specifications': 1, 'match': 1, 'persist': 1
+        })
+        self.assertEqual(summary['outcomes'], {'ok': 1, 'already_scanned': 1})
+        self.assertEqual(summary['stages']['scan']['errors'], 1)
+
+        exported = client.get('/api/receipts/metrics/').content.decode()
+        self.assertIn('receipt_pipeline_stage_duration_seconds_count{stage="persist"} 1', exported)
+
+
+class MatchReceiptItemsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.maxi = Store.objects.create(name='Maxi')
+        cls.milk = Product.objects.create(name='Mleko 1L', points=3)
+        cls.yogurt = Product.objects.create(name='Jogurt', points=4)
+        cls.retired = Product.objects.create(name='Kafa', points=5, status='INACTIVE')
+        ProductBarcode.objects.create(product=cls.milk, gtin='8600939200112')
+        ProductBarcode.objects.create(product=cls.retired, gtin='8606014370019')
+
+    def setUp(self):
+        reset_product_matcher()
+
+    def match(self, *lines):
+        items = [{'name': name, 'gtin': gtin} for name, gtin in lines]
+        return ReceiptProcessingService.match_receipt_items(items, store=self.maxi)
+
+    def test_barcode_wins_over_the_line_name(self):
+        self.assertEqual(self.match(('Jogurt', ' 8600939200112 ')), [(self.milk, 3)])
+
+    def test_unknown_or_inactive_barcodes_fall_back_to_the_name(self):
+        self.assertEqual(
+            self.match(('Jogurt', '8606014370019'), ('Mleko 1L', 'n/a'), ('Banane/KG', '')),
+            [(self.yogurt, 4), (self.milk, 3), (None, 0)]
+        )
+
+    def test_store_alias_wins_over_the_global_alias(self):
+        ProductAlias.learn('MLK 1L', self.yogurt.id)
+        ProductAlias.objects.create(alias='mlk 1l', store=self.maxi, product=self.milk)
+        self.assertEqual(self.match(('MLK 1L', '')), [(self.milk, 3)])
+
+
+class PersistReceiptTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='alice@example.com', password='x', name='Alice')
+        cls.store = Store.objects.create(name='Maxi')
+        cls.milk = Product.objects.create(name='Mleko 1L', points=3)
+
+    def lines(self):
+        return [
+            dict(product_id=self.milk.id, product_name='MLEKO 1L', quantity=2, price=240.0, points=6, matched=True),
+            dict(product_id=None, product_name='BANANE', quantity=1, price=180.0, points=0, matched=False),
+        ]
+
+    def test_saves_the_receipt_with_a_constant_number_of_queries(self):
+        # Savepoint, transaction, items, balance, analytics event, release, balance refresh
+        with self.assertNumQueries(7):
+            transaction, items = ReceiptProcessingService.persist_receipt(
+                self.user, self.store, self.lines() * 5, 30, total_amount=2100.0
+            )
+
+        self.assertEqual(TransactionItem.objects.filter(transaction=transaction).count(), len(items))
+        self.assertEqual(self.user.points, 30)
+
+    def test_nothing_is_saved_when_a_step_fails(self):
+        with mock.patch('analytics.events.AnalyticsEventService.record_scan', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                ReceiptProcessingService.persist_receipt(self.user, self.store, self.lines(), 6)
+
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(TransactionItem.objects.exists())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.points, 0)
+
+
+class WorkloadGeneratorTests(TestCase):
+
+    OPTIONS = dict(seed=42, users=8, stores=3, products=20, transactions=60, days=14, end_date=date(2026, 1, 15))
+
+    def generate(self, **options):
+        call_command('generate_workload', **{**self.OPTIONS, **options}, stdout=io.StringIO())
+
+    @staticmethod
+    def rows():
+        return (
+            list(Transaction.objects.order_by('id').values_list('id', 'user', 'store', 'scanned_at', 'total_points')),
+            list(TransactionItem.objects.order_by('id').values_list(
+                'id', 'product', 'product_name', 'gtin', 'quantity'
+            )),
+            list(User.objects.order_by('id').values_list('id', 'points')),
+        )
+
+    def test_same_seed_generates_the_same_rows(self):
+        self.generate()
+        first = self.rows()
+        self.assertEqual(len(first[0]), 60)
+        with self.assertRaises(CommandError):
+            self.generate()
+
+        self.generate(clear=True)
+        self.assertEqual(self.rows(), ([], [], []))
+        self.generate()
+        self.assertEqual(self.rows(), first)
+
+    def test_receipts_are_unique_per_user(self):
+        self.generate()
+        fingerprints = Transaction.objects.values_list('user_id', 'receipt_fingerprint')
+        self.assertEqual(len(set(fingerprints)), 60)
+
+    def test_matched_lines_carry_their_product_barcode(self):
+        self.generate(match_rate=0.5, gtin_rate=0.5)
+        barcodes = dict(ProductBarcode.objects.values_list('product_id', 'gtin'))
+        lines = list(TransactionItem.objects.values_list('matched', 'product_id', 'gtin'))
+
+        self.assertFalse([line for line in lines if not line[0] and line[2]])
+        with_gtin = [(product_id, gtin) for matched, product_id, gtin in lines if matched and gtin]
+        self.assertTrue(0 < len(with_gtin) < sum(matched for matched, _, _ in lines))
+        self.assertTrue(all(barcodes[product_id] == gtin for product_id, gtin in with_gtin))
+
+    def test_clear_bumps_the_catalog_version_once(self):
+        self.generate()
+        version = CatalogVersion.current()
+
+        self.generate(clear=True)
+        self.assertFalse(Product.objects.exists())
+        self.assertEqual(CatalogVersion.current(), version + 1)
@@ -11,6 +11,10 @@ urlpatterns = [
 
     # Receipt scanning
     path('receipts/scan/', views.scan_receipt, name='scan_receipt'),
+    path('receipts/scan-batch/', views.scan_receipts_batch, name='scan_receipts_batch'),
+    path('receipts/jobs/<str:job_id>/', views.scan_job_status, name='scan_job_status'),
+    path('receipts/suf-status/', views.suf_status, name='suf_status'),
+    path('receipts/metrics/', views.pipeline_metrics, name='pipeline_metrics'),
 
     # Points balance
     path('points/balance/', views.get_points_balance, name='points_balance'),
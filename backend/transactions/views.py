@@ -3,16 +3,23 @@ from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
 from drf_spectacular.utils import extend_schema, OpenApiResponse, OpenApiParameter
+from django.conf import settings
+from django.http import HttpResponse
 from django.utils import timezone
 
-from .models import Transaction, TransactionItem
+from .models import Transaction, TransactionItem, ReceiptScanJob
 from .serializers import (
     TransactionSerializer,
     TransactionItemSerializer,
     ReceiptScanSerializer,
-    ReceiptScanResponseSerializer
+    ReceiptScanResponseSerializer,
+    ReceiptBatchScanSerializer,
+    ReceiptBatchScanResponseSerializer,
+    ReceiptScanJobSerializer
 )
 from .services import ReceiptProcessingService
+from .jobs import ScanJobService
+from .metrics import get_pipeline_metrics
 
 
 class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
@@ -21,9 +28,21 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = TransactionSerializer
     permission_classes = [IsAuthenticated]
 
+    def include_receipt(self) -> bool:
+        """Raw receipts are opt-in, and only on the detail endpoint."""
+        return self.action == 'retrieve' and self.request.query_params.get('include_receipt', '').lower() in ('1', 'true', 'yes')
+
     def get_queryset(self):
         """Return transactions for the current user."""
-        return Transaction.objects.filter(user=self.request.user).select_related('store').prefetch_related('items')
+        queryset = Transaction.objects.filter(user=self.request.user).select_related('store').prefetch_related('items')
+        if self.include_receipt():
+            queryset = queryset.select_related('receipt')
+        return queryset
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['include_receipt'] = self.include_receipt()
+        return context
 
     @extend_schema(
         summary="List user's transaction history",
@@ -34,7 +53,17 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
 
     @extend_schema(
         summary="Get transaction details",
-        description="Retrieve details of a specific transaction including all items.",
+        description="Retrieve details of a specific transaction including all items. "
+                    "Pass `include_receipt=true` to also get the raw SUF receipt as `receipt_data`.",
+        parameters=[
+            OpenApiParameter(
+                name='include_receipt',
+                type=bool,
+                location=OpenApiParameter.QUERY,
+                required=False,
+                description='Include the raw SUF receipt data (default: false)'
+            ),
+        ],
     )
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(request, *args, **kwargs)
@@ -54,10 +83,18 @@ class TransactionViewSet(viewsets.ReadOnlyModelViewSet):
     6. Update user's points balance
 
     Returns transaction details with matched/unmatched items.
+
+    In asynchronous mode (`async_processing: true`, or the RECEIPT_SCAN_ASYNC
+    setting) only the QR code is validated: a scan job is queued and 202 is
+    returned with its `job_id`. Poll `/api/receipts/jobs/{job_id}/` for the result.
+
+    If the SUF system is unavailable (its circuit breaker is open) a synchronous
+    scan is also queued, to run once SUF is retried, and 202 is returned.
     """,
     request=ReceiptScanSerializer,
     responses={
         200: ReceiptScanResponseSerializer,
+        202: ReceiptScanJobSerializer,
         400: OpenApiResponse(description="Invalid QR data or processing error"),
         401: OpenApiResponse(description="Not authenticated")
     }
@@ -72,16 +109,157 @@ def scan_receipt(request):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
     qr_data = serializer.validated_data['qr_data']
+    async_processing = serializer.validated_data.get(
+        'async_processing',
+        getattr(settings, 'RECEIPT_SCAN_ASYNC', False)
+    )
+
+    if async_processing:
+        # Validate now, fetch from SUF later in the worker pool
+        error = ScanJobService.validate_qr(qr_data)
+        if error:
+            return Response({'success': False, 'error': error}, status=status.HTTP_400_BAD_REQUEST)
+
+        job = ScanJobService.enqueue(qr_data, request.user)
+        return Response(ReceiptScanJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
 
     # Process receipt using service
     result = ReceiptProcessingService.process_receipt(qr_data, request.user)
 
+    if result.get('suf_unavailable'):
+        # Fail fast now, retry in the background once SUF is probed again
+        job = ScanJobService.enqueue(qr_data, request.user, delay=result['retry_after'])
+        return Response(ReceiptScanJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
     if not result['success']:
         return Response(result, status=status.HTTP_400_BAD_REQUEST)
 
     return Response(result, status=status.HTTP_200_OK)
 
 
+@extend_schema(
+    summary="Scan several fiscal receipts at once",
+    description="""
+    Process a batch of Serbian fiscal receipts (e.g. after a shopping trip).
+
+    All receipts are checked for duplicates in one query, the new ones are
+    fetched from the SUF system concurrently, and the resulting transactions
+    are saved together. The response reports each receipt's result in input
+    order, shaped like the single scan response; a failed receipt does not
+    fail the batch.
+    """,
+    request=ReceiptBatchScanSerializer,
+    responses={
+        200: ReceiptBatchScanResponseSerializer,
+        400: OpenApiResponse(description="Invalid request body"),
+        401: OpenApiResponse(description="Not authenticated")
+    }
+)
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def scan_receipts_batch(request):
+    """Process several receipt QR codes and award points."""
+    serializer = ReceiptBatchScanSerializer(data=request.data)
+
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    results = ReceiptProcessingService.process_receipts(serializer.validated_data['qr_data'], request.user)
+    succeeded = [result for result in results if result['success']]
+
+    return Response({
+        'results': results,
+        'succeeded': len(succeeded),
+        'failed': len(results) - len(succeeded),
+        'total_points': sum(result['total_points'] for result in succeeded)
+    }, status=status.HTTP_200_OK)
+
+
+@extend_schema(
+    summary="Get receipt scan job status",
+    description="Report progress and, once finished, the result of an asynchronous receipt scan.",
+    responses={
+        200: ReceiptScanJobSerializer,
+        404: OpenApiResponse(description="Scan job not found")
+    }
+)
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def scan_job_status(request, job_id):
+    """Get the status of a queued receipt scan."""
+    try:
+        job = ReceiptScanJob.objects.get(id=job_id, user=request.user)
+    except ReceiptScanJob.DoesNotExist:
+        return Response(
+            {'error': 'Scan job not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+
+    return Response(ReceiptScanJobSerializer(job).data)
+
+
+@extend_schema(
+    summary="Get SUF connection health (Admin only)",
+    description="""
+    Circuit breaker state, rolling error rate, latency percentiles, the current
+    adaptive read timeout and call counters of this server process's SUF client,
+    plus receipt cache statistics.
+    """,
+    responses={
+        200: {
+            'type': 'object',
+            'properties': {
+                'circuit_breaker': {'type': 'object'},
+                'receipt_cache': {'type': 'object'}
+            }
+        }
+    }
+)
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def suf_status(request):
+    """Report SUF circuit breaker and receipt cache statistics."""
+    from .receipt_cache import ReceiptCache
+
+    return Response({
+        'circuit_breaker': ReceiptProcessingService.get_client().breaker.snapshot(),
+        'receipt_cache': ReceiptCache.stats()
+    })
+
+
+@extend_schema(
+    summary="Get receipt pipeline metrics (Admin only)",
+    description="""
+    Per-stage timing of this server process's receipt scan pipeline (fetch_page,
+    parse, fetch_specifications, match, persist and the whole scan): call and
+    error counters and latency histograms, plus scan outcome counters.
+
+    Returned in the Prometheus text exposition format; pass `format=json` for a
+    JSON summary instead.
+    """,
+    parameters=[
+        OpenApiParameter(
+            name='format',
+            type=str,
+            location=OpenApiParameter.QUERY,
+            required=False,
+            description="'json' for a JSON summary (default: Prometheus text format)"
+        ),
+    ],
+    responses={
+        200: OpenApiResponse(description="Metrics in the Prometheus text format, or a JSON summary")
+    }
+)
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def pipeline_metrics(request):
+    """Export receipt pipeline stage timings and counters."""
+    metrics = get_pipeline_metrics()
+    if request.query_params.get('format') == 'json':
+        return Response(metrics.snapshot())
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @extend_schema(
     summary="Get user's points balance",
     description="Get the current points balance for the authenticated user.",
@@ -259,22 +437,33 @@ def approve_review(request, item_id):
     else:
         print(f"⚠️ Branch 3: Product already linked - {item.product}")
 
-    # Update item
-    item.review_status = 'approved'
-    item.matched = True  # Mark as matched when approved
-    item.points = points
-    item.review_notes = admin_notes
-    item.save()
-
-    # Update user points
-    user = item.transaction.user
-    user.points += points
-    user.save()
+    # Update item, user points, transaction total, the learned alias and the analytics change log together
+    from analytics.events import AnalyticsEventService
+    from django.db import transaction as db_transaction
+    from django.db.models import F
+    from products.models import ProductAlias
+    from users.models import User
+
+    newly_matched = not item.matched
+    with db_transaction.atomic():
+        item.review_status = 'approved'
+        item.matched = True  # Mark as matched when approved
+        item.points = points
+        item.review_notes = admin_notes
+        item.save()
+
+        # Update user points and the transaction total in the database, so concurrent
+        # approvals and scans of the same user or transaction cannot overwrite each other
+        transaction = item.transaction
+        User.objects.filter(pk=transaction.user_id).update(points=F('points') + points)
+        Transaction.objects.filter(pk=transaction.pk).update(total_points=F('total_points') + points)
+
+        # Remember the receipt string so the next scan matches it directly
+        ProductAlias.learn(
+            item.product_name, item.product_id, store_id=transaction.store_id, relink=bool(product_id)
+        )
 
-    # Update transaction total points
-    transaction = item.transaction
-    transaction.total_points += points
-    transaction.save()
+        AnalyticsEventService.record_review_approval(item, points, newly_matched)
 
     return Response({
         'success': True,